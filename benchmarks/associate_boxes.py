@@ -0,0 +1,74 @@
+#Benchmark generate.associate_boxes on a synthetic megaplot of stems and crown boxes, against the previous per group loops of process_plot
+#python benchmarks/associate_boxes.py --stems 20000
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from src import generate
+
+def synthetic_megaplot(stems, boxes_per_stem=1.5, seed=0):
+    """Stems in a square plot and crown boxes scattered over it, with integer heights so that ties are common"""
+    rng = np.random.default_rng(seed)
+    side = np.sqrt(stems) * 5
+    stem_data = gpd.GeoDataFrame({
+        "individual": ["NEON.PLA.{}".format(x) for x in range(stems)],
+        "plotID": "MEGAPLOT",
+        "height": rng.integers(3, 30, stems).astype(float),
+        "CHM_height": rng.integers(3, 30, stems).astype(float)},
+        geometry=gpd.points_from_xy(rng.uniform(0, side, stems), rng.uniform(0, side, stems)), crs="EPSG:32617")
+
+    n = int(stems * boxes_per_stem)
+    x = rng.uniform(0, side, n)
+    y = rng.uniform(0, side, n)
+    size = rng.uniform(2, 8, n)
+    boxes = gpd.GeoDataFrame({"box_id": np.arange(n), "score": rng.uniform(0.1, 1, n), "xmin": x, "ymin": y, "xmax": x + size, "ymax": y + size},
+                             geometry=[shapely.geometry.box(*b) for b in zip(x, y, x + size, y + size)], crs="EPSG:32617")
+
+    return gpd.sjoin(boxes, stem_data), stem_data
+
+def loop_association(merged_boxes, plot_data):
+    """The per group loops that associate_boxes replaced"""
+    cleaned_boxes = []
+    for value, group in merged_boxes.groupby("individual"):
+        if group.shape[0] == 1:
+            cleaned_boxes.append(group)
+            continue
+        #The box closest to the stem by centroid
+        stem_location = plot_data[plot_data["individual"] == value].geometry.iloc[0]
+        closest_stem = group.centroid.distance(stem_location).sort_values().index[0]
+        cleaned_boxes.append(group.loc[[closest_stem]])
+    merged_boxes = gpd.GeoDataFrame(pd.concat(cleaned_boxes), crs=merged_boxes.crs)
+
+    cleaned_points = []
+    for value, group in merged_boxes.groupby("box_id"):
+        if group.shape[0] > 1:
+            selected_point = group[group.height == group.height.max()]
+            if selected_point.shape[0] > 1:
+                selected_point = selected_point[selected_point.CHM_height == selected_point.CHM_height.max()]
+            cleaned_points.append(selected_point)
+        else:
+            cleaned_points.append(group)
+
+    return gpd.GeoDataFrame(pd.concat(cleaned_points), crs=merged_boxes.crs)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Benchmark generate.associate_boxes")
+    parser.add_argument("--stems", type=int, default=20000)
+    args = parser.parse_args()
+
+    merged_boxes, stems = synthetic_megaplot(args.stems)
+    start = time.perf_counter()
+    associated = generate.associate_boxes(merged_boxes, stems)
+    vectorized = time.perf_counter() - start
+
+    start = time.perf_counter()
+    expected = loop_association(merged_boxes, stems)
+    loop = time.perf_counter() - start
+
+    #The loops keep every stem tied on both heights, associate_boxes keeps the first
+    expected = expected.drop_duplicates(["plotID", "box_id"])
+    assert set(associated.box_id) == set(expected.box_id)
+    print("{} stems, {} box stem pairs, {} associated".format(args.stems, merged_boxes.shape[0], associated.shape[0]))
+    print("vectorized: {:.3f}s, loops: {:.1f}s, {:.0f}x".format(vectorized, loop, loop / vectorized))
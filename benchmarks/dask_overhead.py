@@ -0,0 +1,105 @@
+#Benchmark dask task overhead of generate.points_to_crowns on a local cluster.
+#Compares shipping the whole field data and the rgb tile index to every plot task, one task per rgb tile with only its own plots,
+#and one task per tile with the tile index scattered to the workers once.
+#With --model, also compares building DeepForest in every task against the per worker generate.load_deepforest
+#python benchmarks/dask_overhead.py --plots 2000 --points 30 --workers 4
+#On one core with --plots 200 --workers 1 --tiles 500: 88.4ms per plot with the field data and tile index in every plot task,
+#3.6ms with one task per tile and 2.1ms with the tile index scattered once
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from distributed import Client, LocalCluster, wait
+from src import generate
+
+def synthetic_field_data(plots, points, plots_per_tile=20, seed=0):
+    """Stem points of plots laid out on a grid, plots_per_tile plots share each 1km tile"""
+    rng = np.random.default_rng(seed)
+    plot_index = np.repeat(np.arange(plots), points)
+    tile = plot_index // plots_per_tile
+    x = 400000 + tile * 1000 + (plot_index % plots_per_tile) * 40 + rng.uniform(0, 40, plot_index.size)
+    y = 3280000 + rng.uniform(0, 40, plot_index.size)
+    df = pd.DataFrame({
+        "plotID": ["PLOT_{}".format(x) for x in plot_index],
+        "individual": ["NEON.PLA.{}".format(x) for x in range(plot_index.size)],
+        "taxonID": rng.choice(["PINUS", "QULA2", "ACRU"], plot_index.size),
+        "height": rng.uniform(3, 30, plot_index.size)})
+
+    return gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(x, y), crs="EPSG:32617")
+
+def synthetic_rgb_pool(tiles, years=4):
+    """Tile index the size of the NEON camera mosaics of all sites and years"""
+    paths = ["/NeonData/SITE/DP3.30010.001/{}/FullSite/L3/Camera/Mosaic/{}_SITE_{}_{}000_{}000_image.tif".format(year, year, year - 2014, 400 + x % 100, 3200 + x // 100)
+             for year in range(2016, 2016 + years) for x in range(tiles)]
+
+    return generate.TileIndex(paths)
+
+def count_plot(plot, df, rgb_pool=None):
+    """Stand in for generate.run, the per plot filter without the detector"""
+    return df[df.plotID == plot].shape[0]
+
+def count_tile(plots, df, rgb_pool=None):
+    """Stand in for generate.run_tile"""
+    return sum(count_plot(plot, df) for plot in plots)
+
+def fresh_model(index):
+    from deepforest import main
+    deepforest_model = main.deepforest()
+    deepforest_model.use_release(check_release=False)
+
+    return index
+
+def resident_model(index):
+    generate.load_deepforest()
+
+    return index
+
+def time_tasks(client, submit):
+    start = time.perf_counter()
+    futures = submit()
+    wait(futures)
+    elapsed = time.perf_counter() - start
+    client.cancel(futures)
+
+    return elapsed, len(futures)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Benchmark dask task overhead of points_to_crowns")
+    parser.add_argument("--plots", type=int, default=2000)
+    parser.add_argument("--points", type=int, default=30, help="stems per plot")
+    parser.add_argument("--plots_per_tile", type=int, default=20)
+    parser.add_argument("--tiles", type=int, default=10000, help="rgb tiles per year in the tile index")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--model", action="store_true", help="also time loading DeepForest per task against once per worker")
+    args = parser.parse_args()
+
+    df = synthetic_field_data(args.plots, args.points, args.plots_per_tile)
+    rgb_pool = synthetic_rgb_pool(args.tiles)
+    plot_names = df.plotID.unique()
+    plot_tiles = pd.Series(generate.bounds_to_geoindex(np.stack([df[df.plotID == x].total_bounds for x in plot_names])), index=plot_names)
+    tile_plots = [list(group.index) for geo_index, group in plot_tiles.groupby(plot_tiles)]
+    print("{} plots, {} stems, {} tiles".format(len(plot_names), df.shape[0], len(tile_plots)))
+
+    cluster = LocalCluster(n_workers=args.workers, threads_per_worker=1, processes=True)
+    client = Client(cluster)
+
+    elapsed, tasks = time_tasks(client, lambda: [client.submit(count_plot, plot, df, rgb_pool, pure=False) for plot in plot_names])
+    print("whole field data and tile index per plot: {} tasks, {:.2f}s, {:.1f}ms per plot".format(tasks, elapsed, elapsed / len(plot_names) * 1000))
+    elapsed, tasks = time_tasks(client, lambda: [client.submit(count_tile, plots, df[df.plotID.isin(plots)], rgb_pool, pure=False) for plots in tile_plots])
+    print("own plots and tile index per tile: {} tasks, {:.2f}s, {:.1f}ms per plot".format(tasks, elapsed, elapsed / len(plot_names) * 1000))
+    def scattered():
+        rgb_pool_future = client.scatter(rgb_pool, broadcast=True)
+        return [client.submit(count_tile, plots, df[df.plotID.isin(plots)], rgb_pool_future, pure=False) for plots in tile_plots]
+    elapsed, tasks = time_tasks(client, scattered)
+    print("own plots per tile, tile index scattered once: {} tasks, {:.2f}s, {:.1f}ms per plot".format(tasks, elapsed, elapsed / len(plot_names) * 1000))
+
+    if args.model:
+        tasks = args.workers * 4
+        elapsed, tasks = time_tasks(client, lambda: [client.submit(fresh_model, x, pure=False) for x in range(tasks)])
+        print("DeepForest built in every task: {} tasks, {:.2f}s".format(tasks, elapsed))
+        elapsed, tasks = time_tasks(client, lambda: [client.submit(resident_model, x, pure=False) for x in range(tasks)])
+        print("DeepForest loaded once per worker: {} tasks, {:.2f}s".format(tasks, elapsed))
+
+    client.close()
+    cluster.close()
@@ -0,0 +1,55 @@
+#Benchmark CHM.height_rules on a synthetic frame of field and CHM heights, against the previous row by row filter
+#python benchmarks/height_rules.py --rows 1000000
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from src import CHM
+
+def synthetic_heights(rows, seed=0):
+    """Field and CHM heights with missing values in both columns"""
+    rng = np.random.default_rng(seed)
+    height = rng.uniform(0, 40, rows)
+    CHM_height = height + rng.normal(0, 5, rows)
+    height[rng.random(rows) < 0.1] = np.nan
+    CHM_height[rng.random(rows) < 0.05] = np.nan
+    
+    return pd.DataFrame({"CHM_height": CHM_height, "height": height})
+
+def iterrows_rules(df, min_CHM_height=1, max_CHM_diff=4, CHM_height_limit=8):
+    """The row by row filter that height_rules replaced"""
+    keep = []
+    for index, row in df.iterrows():
+        if np.isnan(row["CHM_height"]):
+            keep.append(False)
+        elif np.isnan(row["height"]):
+            keep.append(True)
+        elif row.CHM_height < min_CHM_height:
+            keep.append(False)
+        elif row.CHM_height > row.height:
+            keep.append((row.CHM_height - row.height) < max_CHM_diff)
+        else:
+            keep.append((row.height - row.CHM_height) < CHM_height_limit)
+    
+    return df[keep]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Benchmark CHM.height_rules")
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--iterrows_rows", type=int, default=20000, help="rows for the row by row filter, its time is scaled to --rows")
+    args = parser.parse_args()
+    
+    df = synthetic_heights(args.rows)
+    start = time.perf_counter()
+    filtered = CHM.height_rules(df.copy())
+    vectorized = time.perf_counter() - start
+    
+    subset = df.head(args.iterrows_rows)
+    start = time.perf_counter()
+    expected = iterrows_rules(subset)
+    iterrows = (time.perf_counter() - start) * args.rows / len(subset)
+    
+    #Same rows kept
+    assert filtered.index[filtered.index < len(subset)].equals(expected.index)
+    print("{} rows, {} kept".format(args.rows, filtered.shape[0]))
+    print("vectorized: {:.3f}s, iterrows: {:.1f}s (scaled from {} rows), {:.0f}x".format(vectorized, iterrows, len(subset), iterrows / vectorized))
@@ -0,0 +1,73 @@
+#Benchmark converted hyperspectral tile layouts: file size and random crown window read latency
+#python benchmarks/raster_layout.py --h5 /orange/ewhite/NeonData/.../NEON_D03_OSBS_DP3_404000_3285000_reflectance.h5
+import argparse
+import os
+import tempfile
+import time
+import h5py
+import numpy as np
+import rasterio
+from src import Hyperspectral
+
+def synthetic_h5(path, size=500, bands=426):
+    """Write a NEON shaped reflectance tile with smooth spectra so compression behaves like real data"""
+    rng = np.random.default_rng(0)
+    spectra = 1000 + 3000 * np.sin(np.linspace(0, 3, bands))
+    canopy = rng.uniform(0.5, 1.5, (size, size, 1))
+    reflectance = (canopy * spectra + rng.normal(0, 50, (size, size, bands))).astype(np.int16)
+    with h5py.File(path, "w") as f:
+        group = f.create_group("OSBS/Reflectance")
+        data = group.create_dataset("Reflectance_Data", data=reflectance, chunks=(73, 73, bands), compression="gzip")
+        data.attrs["Data_Ignore_Value"] = -9999.0
+        data.attrs["Scale_Factor"] = 10000.0
+        group["Metadata/Coordinate_System/EPSG Code"] = np.bytes_("32617")
+        group["Metadata/Coordinate_System/Map_Info"] = np.bytes_("UTM,  1.000,  1.000,  404000.00,  {}.00,  1.0000000000e+00,  1.0000000000e+00, 17,  North, WGS-84, units=Meters, 0".format(3285000 + size))
+        group["Metadata/Spectral_Data/Wavelength"] = np.linspace(383.9, 2511.9, bands)
+    
+    return path
+
+def read_windows(path, n, crown_size, seed=1):
+    """Open the tile and read one crown window per call, like patches.crop"""
+    with rasterio.open(path) as src:
+        height, width = src.shape
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, height - crown_size, n)
+    cols = rng.integers(0, width - crown_size, n)
+    latency = []
+    for row, col in zip(rows, cols):
+        start = time.perf_counter()
+        with rasterio.open(path) as src:
+            src.read(window=rasterio.windows.Window(col, row, crown_size, crown_size))
+        latency.append(time.perf_counter() - start)
+    
+    return np.array(latency) * 1000
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Compare striped and tiled hyperspectral layouts")
+    parser.add_argument("--h5", help="NEON reflectance .h5 tile, a synthetic tile is used if omitted")
+    parser.add_argument("--size", type=int, default=500, help="synthetic tile width in pixels")
+    parser.add_argument("--n", type=int, default=200, help="number of crown windows to read")
+    parser.add_argument("--crown_size", type=int, default=11)
+    parser.add_argument("--blocksize", type=int, nargs="+", default=[32, 64, 128])
+    parser.add_argument("--savedir", default=tempfile.mkdtemp())
+    args = parser.parse_args()
+    
+    h5_path = args.h5 or synthetic_h5("{}/synthetic_reflectance.h5".format(args.savedir), size=args.size)
+    layouts = {"striped": None}
+    for blocksize in args.blocksize:
+        layout = dict(Hyperspectral.COG_LAYOUT)
+        layout["blocksize"] = blocksize
+        layouts["tiled_{}".format(blocksize)] = layout
+    
+    print("Reads are warm after the first pass, drop the page cache between runs for cold GPFS numbers")
+    print("{:<12}{:>12}{:>14}{:>14}{:>14}".format("layout", "size (MB)", "convert (s)", "median (ms)", "p95 (ms)"))
+    for name, layout in layouts.items():
+        savedir = "{}/{}".format(args.savedir, name)
+        os.makedirs(savedir, exist_ok=True)
+        start = time.perf_counter()
+        tilename = Hyperspectral.generate_raster(h5_path, save_dir=savedir, rgb_filename="{}_image.tif".format(name), block_rows=128, layout=layout)
+        convert_time = time.perf_counter() - start
+        path = "{}/{}".format(savedir, tilename)
+        latency = read_windows(path, n=args.n, crown_size=args.crown_size)
+        print("{:<12}{:>12.1f}{:>14.1f}{:>14.2f}{:>14.2f}".format(
+            name, os.path.getsize(path) / 1e6, convert_time, np.median(latency), np.percentile(latency, 95)))
@@ -1,8 +1,8 @@
 #OSBS mining
 from src import predict
 from src import data
+from src import catalog
 from src import neon_paths
-from glob import glob
 import pandas as pd
 import geopandas as gpd
 from src.start_cluster import start
@@ -15,22 +15,19 @@ import traceback
 crop_sensor = True
 
 def find_rgb_files(site, year, config):
-    tiles = glob(config["rgb_sensor_pool"], recursive=True)
+    tiles = catalog.find_files(config["rgb_sensor_pool"], config["file_catalog"])
     tiles = [x for x in tiles if site in x]
     tiles = [x for x in tiles if "/{}/".format(year) in x]
     
     return tiles
     
-def convert(rgb_path, hyperspectral_pool, year, savedir):
+def convert(rgb_path, hyperspectral_pool, year, savedir, bin_size=1):
     #convert .h5 hyperspec tile if needed
     basename = os.path.basename(rgb_path)
     geo_index = re.search("(\d+_\d+)_image", basename).group(1)
     hyperspectral_h5_path = [x for x in hyperspectral_pool if geo_index in x]
     hyperspectral_h5_path = [x for x in hyperspectral_h5_path if year in x][0]
-    tif_basename = os.path.splitext(os.path.basename(rgb_path))[0] + "_hyperspectral.tif"
-    tif_path = "{}/{}".format(savedir, tif_basename)
-    if not os.path.exists(tif_path):
-        tif_path = neon_paths.convert_h5(hyperspectral_h5_path, rgb_path, savedir)
+    tif_path = neon_paths.convert_h5_once(hyperspectral_h5_path, rgb_path, savedir, bin_size=bin_size)
     
     return tif_path
 
@@ -38,12 +35,12 @@ config = data.read_config("config.yml")
 tiles = find_rgb_files(site="OSBS", config=config, year="2019")
 
 #generate HSI_tif data if needed.
-hyperspectral_pool = glob(config["HSI_sensor_pool"], recursive=True)
-rgb_pool = glob(config["rgb_sensor_pool"], recursive=True)
+hyperspectral_pool = catalog.find_files(config["HSI_sensor_pool"], config["file_catalog"])
+rgb_pool = catalog.find_files(config["rgb_sensor_pool"], config["file_catalog"])
 
 cpu_client = start(cpus=50)
 
-tif_futures = cpu_client.map(convert, tiles, hyperspectral_pool=hyperspectral_pool, savedir = config["HSI_tif_dir"], year="2019")
+tif_futures = cpu_client.map(convert, tiles, hyperspectral_pool=hyperspectral_pool, savedir = config["HSI_tif_dir"], year="2019", bin_size=config.get("bin_size", 1))
 wait(tif_futures)
 
 species_model_path = "/blue/ewhite/b.weinstein/DeepTreeAttention/snapshots/0abd4a52fcb2453da44ae59740b4a9c8.pl"
@@ -91,7 +88,7 @@ if crop_sensor:
     predictions["plotID"] = None
     predictions["box_id"] = None
     predictions["siteID"] = None
-    annotations = generate.generate_crops(predictions, sensor_glob=config["HSI_sensor_pool"], savedir="/orange/idtrees-collab/DeepTreeAttention/prediction_crops/HSI/", rgb_glob=config["rgb_sensor_pool"], client=None, convert_h5=True, HSI_tif_dir=config["HSI_tif_dir"])
+    annotations = generate.generate_crops(predictions, sensor_glob=config["HSI_sensor_pool"], savedir="/orange/idtrees-collab/DeepTreeAttention/prediction_crops/HSI/", rgb_glob=config["rgb_sensor_pool"], client=None, convert_h5=True, HSI_tif_dir=config["HSI_tif_dir"], bin_size=config.get("bin_size", 1))
     generate.generate_crops(predictions, sensor_glob=config["rgb_sensor_pool"], savedir="/orange/idtrees-collab/DeepTreeAttention/prediction_crops/RGB/", rgb_glob=config["rgb_sensor_pool"], client=client)
     generate.generate_crops(predictions, sensor_glob=config["CHM_pool"], savedir="/orange/idtrees-collab/DeepTreeAttention/prediction_crops/CHM/", rgb_glob=config["rgb_sensor_pool"], client=client)
     
@@ -1,56 +1,273 @@
 #CHM height module. Given a x,y location and a pool of CHM images, find the matching location and extract the crown level CHM measurement
-import glob
+import hashlib
+import math
+import os
+import sqlite3
+import time
 import numpy as np 
+from src import catalog
 from src import neon_paths
-import rasterstats
+import rasterio
+from rasterio import features
 import geopandas as gpd
 import pandas as pd
 
-def non_zero_99_quantile(x):
-    """Get height quantile of all cells that are no zero"""
-    mdata = np.ma.masked_where(x < 0.5, x)
-    mdata = np.ma.filled(mdata, np.nan)
-    percentile = np.nanpercentile(mdata, 99)
-    return (percentile)
+def segment_percentiles(labels, values, quantiles=[99]):
+    """Percentiles of values within each label, in one sort over all labels. Linear interpolation, the same as np.percentile
+    Args:
+        labels: integer label of each value
+        values: values to summarize
+        quantiles: percentiles between 0 and 100
+    Returns:
+        unique_labels: labels with at least one value
+        percentiles: len(unique_labels) x len(quantiles) array
+    """
+    order = np.lexsort((values, labels))
+    labels = labels[order]
+    values = values[order]
+    unique_labels, starts, counts = np.unique(labels, return_index=True, return_counts=True)
+    percentiles = np.zeros((len(unique_labels), len(quantiles)))
+    for index, q in enumerate(quantiles):
+        position = (counts - 1) * q / 100
+        lower = np.floor(position).astype(int)
+        upper = np.ceil(position).astype(int)
+        fraction = position - lower
+        percentiles[:, index] = values[starts + lower] + (values[starts + upper] - values[starts + lower]) * fraction
 
-def postprocess_CHM(df, lookup_pool):
-    """Field measured height must be within min_diff meters of canopy model"""
-    #Extract zonal stats, add a small offset, the min box can go to next tile.
+    return unique_labels, percentiles
+
+def overlap_layers(bounds, pad=0):
+    """Assign geometries to layers in which no two bounding boxes intersect, each layer is rasterized once.
+    Candidates are found through a grid of cells about twice the median box size, so each box is only compared with its neighbors.
+    Args:
+        bounds: n x 4 array of left, bottom, right, top
+        pad: distance added to each side of the boxes, one pixel keeps points that share a pixel apart
+    Returns:
+        layers: list of arrays of row indices into bounds
+    """
+    bounds = np.asarray(bounds, dtype=float) + np.array([-pad, -pad, pad, pad])
+    size = max(np.median(bounds[:, 2] - bounds[:, 0]), np.median(bounds[:, 3] - bounds[:, 1])) * 2
+    size = size if size > 0 else 1
+    grid = {}
+    layer_of = np.zeros(len(bounds), dtype=int)
+    for index, (left, bottom, right, top) in enumerate(bounds):
+        cells = [(x, y) for x in range(math.floor(left / size), math.floor(right / size) + 1) for y in range(math.floor(bottom / size), math.floor(top / size) + 1)]
+        used = set()
+        for cell in cells:
+            for other in grid.get(cell, []):
+                other_left, other_bottom, other_right, other_top = bounds[other]
+                if other_left <= right and other_right >= left and other_bottom <= top and other_top >= bottom:
+                    used.add(layer_of[other])
+        layer = 0
+        while layer in used:
+            layer += 1
+        layer_of[index] = layer
+        for cell in cells:
+            grid.setdefault(cell, []).append(index)
+
+    return [np.flatnonzero(layer_of == x) for x in range(layer_of.max() + 1)]
+
+def zonal_quantiles(geometries, CHM_path, quantiles=[99], min_height=0.5):
+    """Height percentiles of the CHM pixels within each geometry, excluding pixels under min_height and nodata.
+    The CHM window under all geometries is read once, and pixels are assigned to geometries whose boundary contains their center, the same as rasterstats.zonal_stats.
+    Points take the pixel they fall in.
+    Args:
+        geometries: geopandas GeoSeries in the crs of the CHM
+        CHM_path: CHM tile
+        quantiles: percentiles between 0 and 100
+        min_height: pixels under min_height are ground and excluded
+    Returns:
+        percentiles: dataframe with a q{quantile} column per quantile, in the order of geometries. NaN where a geometry has no canopy pixels
+    """
+    percentiles = np.full((len(geometries), len(quantiles)), np.nan)
+    bounds = np.asarray(geometries.bounds.values, dtype=float)
+    columns = ["q{}".format(q) for q in quantiles]
+    if len(geometries) == 0:
+        return pd.DataFrame(percentiles, columns=columns)
+
+    with rasterio.open(CHM_path) as src:
+        #Pixel window under all geometries, including the pixel of a point on the bottom or right edge
+        transform = src.transform
+        row_start, col_start = rasterio.transform.rowcol(transform, bounds[:, 0].min(), bounds[:, 3].max(), op=math.floor)
+        row_stop, col_stop = rasterio.transform.rowcol(transform, bounds[:, 2].max(), bounds[:, 1].min(), op=math.floor)
+        row_stop += 1
+        col_stop += 1
+        window = rasterio.windows.Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+        #Read the part within the tile, the rest is nodata
+        nodata = src.nodata
+        height = np.full((window.height, window.width), np.nan, dtype=np.float64)
+        try:
+            inside = window.intersection(rasterio.windows.Window(0, 0, src.width, src.height))
+        except rasterio.errors.WindowError:
+            inside = None
+        if inside is not None:
+            data = src.read(1, window=inside).astype(np.float64)
+            if nodata is not None:
+                data[data == nodata] = np.nan
+            row_off = int(inside.row_off - window.row_off)
+            col_off = int(inside.col_off - window.col_off)
+            height[row_off:row_off + data.shape[0], col_off:col_off + data.shape[1]] = data
+        window_transform = rasterio.windows.transform(window, transform)
+        res = src.res[0]
+
+    #Ground, nodata and NaN pixels are excluded
+    canopy = height >= min_height
+    for layer in overlap_layers(bounds, pad=res):
+        shapes = [(geometries.iloc[x], x + 1) for x in layer]
+        labels = features.rasterize(shapes, out_shape=height.shape, transform=window_transform, fill=0, dtype="int32")
+        selected = (labels > 0) & canopy
+        if not selected.any():
+            continue
+        unique_labels, values = segment_percentiles(labels[selected], height[selected], quantiles)
+        percentiles[unique_labels - 1] = values
+
+    return pd.DataFrame(percentiles, columns=columns)
+
+def find_CHM_path(df, lookup_pool):
+    """CHM tile of a plot, by the tile of its minimum corner"""
     try:
         CHM_path = neon_paths.find_sensor_path(lookup_pool=lookup_pool, bounds=df.total_bounds)
     except Exception as e:
         raise ValueError("Cannot find CHM path for {} from plot {} in lookup_pool: {}".format(df.total_bounds, df.plotID.unique(),e))
     
-    #buffer slightly, CHM model can be patchy
-    geom = df.geometry
-    draped_boxes = rasterstats.zonal_stats(geom,
-                                           CHM_path,
-                                           add_stats={'q99': non_zero_99_quantile})
-    df["CHM_height"] = [x["q99"] for x in draped_boxes]
+    return CHM_path
+
+def assign_CHM_height(df, CHM_height):
+    """Add the CHM_height column and fill missing field heights with it"""
+    df["CHM_height"] = CHM_height
 
     #if height is null, try to assign it
     try:
-        df.height.fillna(df["CHM_height"], inplace=True)
+        df["height"] = df.height.fillna(df["CHM_height"])
     except:
         print("No height column detected")  
     
     return df
+
+def with_retries(function, retries=5, wait=1):
+    """Call function, retrying with backoff while another writer holds the sqlite lock past the busy timeout"""
+    for attempt in range(retries):
+        try:
+            return function()
+        except sqlite3.OperationalError as e:
+            if not "locked" in str(e) or attempt == retries - 1:
+                raise
+            time.sleep(wait * 2 ** attempt)
+
+def connect_cache(cache_path):
+    """Open the CHM height cache in WAL mode, creating the table on first use, so the workers on a node read while one of them writes"""
+    connection = sqlite3.connect(cache_path, timeout=60)
+    with_retries(lambda: connection.execute("PRAGMA journal_mode=WAL"))
+    with_retries(lambda: connection.execute("""CREATE TABLE IF NOT EXISTS CHM_heights (
+        geometry TEXT, CHM_path TEXT, mtime REAL, height REAL, PRIMARY KEY (geometry, CHM_path, mtime))"""))
+    
+    return connection
+
+def cached_CHM_height(geometries, CHM_path, cache_path=None):
+    """Non zero 99th percentile CHM height of each geometry, looked up in the cache first.
+    Entries are keyed by a hash of the geometry and the CHM path and mtime, so a changed geometry or a reprocessed tile is computed again.
+    Args:
+        geometries: geopandas GeoSeries in the crs of the CHM
+        CHM_path: CHM tile
+        cache_path: sqlite cache, None computes every height
+    Returns:
+        heights: array of heights in the order of geometries
+    """
+    if cache_path is None:
+        return zonal_quantiles(geometries, CHM_path, quantiles=[99])["q99"].values
+    
+    keys = [hashlib.sha1(x.wkb).hexdigest() for x in geometries]
+    mtime = os.path.getmtime(CHM_path)
+    connection = connect_cache(cache_path)
+    cached = {}
+    #Stay under the sqlite limit on query parameters
+    unique_keys = list(set(keys))
+    for start in range(0, len(unique_keys), 500):
+        batch = unique_keys[start:start + 500]
+        rows = connection.execute("SELECT geometry, height FROM CHM_heights WHERE CHM_path = ? AND mtime = ? AND geometry IN ({})".format(",".join("?" * len(batch))),
+                                  [CHM_path, mtime] + batch)
+        cached.update(rows.fetchall())
+    
+    heights = np.array([cached.get(x, np.nan) for x in keys], dtype=float)
+    missing = np.array([x not in cached for x in keys])
+    if missing.any():
+        heights[missing] = zonal_quantiles(geometries[missing], CHM_path, quantiles=[99])["q99"].values
+        rows = [(key, CHM_path, mtime, None if np.isnan(height) else height) for key, height, miss in zip(keys, heights, missing) if miss]
+        def write():
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO CHM_heights VALUES (?, ?, ?, ?)", rows)
+        with_retries(write)
+    connection.close()
+    print("CHM cache {}: {} hits, {} misses".format(os.path.basename(CHM_path), (~missing).sum(), missing.sum()))
+    
+    return heights
+
+def postprocess_CHM(df, lookup_pool, cache_path=None):
+    """Field measured height must be within min_diff meters of canopy model
+    cache_path: optional sqlite cache of CHM heights, see cached_CHM_height
+    """
+    #Extract zonal stats, add a small offset, the min box can go to next tile.
+    CHM_path = find_CHM_path(df, lookup_pool)
+    
+    #buffer slightly, CHM model can be patchy
+    geom = df.geometry
+    df = assign_CHM_height(df, cached_CHM_height(geom, CHM_path, cache_path))
+    
+    return df
+
+def tile_CHM_height(groups, CHM_path, cache_path=None):
+    """CHM height of a list of plots that share a CHM tile, the tile is read once for all of them
+    Returns:
+        results: list of plot dataframes with a CHM_height column, in the order of groups
+    """
+    heights = cached_CHM_height(pd.concat(groups).geometry, CHM_path, cache_path)
+    heights = np.split(heights, np.cumsum([len(x) for x in groups])[:-1])
+    
+    return [assign_CHM_height(group.copy(), height) for group, height in zip(groups, heights)]
         
-def CHM_height(shp, CHM_pool):
+def CHM_height(shp, CHM_pool, file_catalog=None, client=None, cache_path=None):
         """For each plotID extract the heights from LiDAR derived CHM
         Args:
             shp: shapefile of data to filter
-            config: DeepTreeAttention config file dict, parsed, see config.yml
+            CHM_pool: glob to search CHM tiles
+            file_catalog: optional sqlite catalog to list CHM_pool from instead of walking the filesystem, see catalog.find_files
+            client: optional dask client or concurrent.futures executor, plots are sent to workers grouped by CHM tile
+            cache_path: optional sqlite cache of CHM heights, see cached_CHM_height
         """    
-        filtered_results = []
-        lookup_pool = glob.glob(CHM_pool, recursive=True)        
+        lookup_pool = neon_paths.TileIndex(catalog.find_files(CHM_pool, file_catalog))
+        
+        #Group plots by tile so each tile is opened once
+        tiles = {}
+        plot_names = []
         for name, group in shp.groupby("plotID"):
+            plot_names.append(name)
             try:
-                result = postprocess_CHM(group, lookup_pool=lookup_pool)
-                filtered_results.append(result)
+                CHM_path = find_CHM_path(group, lookup_pool)
             except Exception as e:
                 print("plotID {} raised: {}".format(name,e))
-                
+                continue
+            tiles.setdefault(CHM_path, []).append((name, group))
+        
+        if client:
+            futures = {CHM_path: client.submit(tile_CHM_height, [x[1] for x in plots], CHM_path, cache_path) for CHM_path, plots in tiles.items()}
+        
+        results = {}
+        for CHM_path, plots in tiles.items():
+            try:
+                if client:
+                    tile_results = futures[CHM_path].result()
+                else:
+                    tile_results = tile_CHM_height([x[1] for x in plots], CHM_path, cache_path)
+            except Exception as e:
+                for name, group in plots:
+                    print("plotID {} raised: {}".format(name,e))
+                continue
+            for (name, group), result in zip(plots, tile_results):
+                results[name] = result
+        
+        #Same plot order regardless of which worker finished first
+        filtered_results = [results[x] for x in plot_names if x in results]
         filtered_shp = gpd.GeoDataFrame(pd.concat(filtered_results,ignore_index=True))
         
         return filtered_shp
@@ -67,40 +284,25 @@ def height_rules(df, min_CHM_height=1, max_CHM_diff=4, CHM_height_limit=8):
     Returns:
        df: filtered dataframe
     """
-    keep = []
-    for index, row in df.iterrows():
-        if np.isnan(row["CHM_height"]):
-            keep.append(False)
-        elif np.isnan(row["height"]):
-            keep.append(True)
-        elif row.CHM_height < min_CHM_height:
-            keep.append(False)
-        elif row.CHM_height > row.height:
-            if (row.CHM_height - row.height) >= max_CHM_diff:
-                keep.append(False)
-            else:
-                keep.append(True)
-        elif row.CHM_height <= row.height:
-            if (row.height - row.CHM_height) >= CHM_height_limit:
-                keep.append(False)
-            else:
-                keep.append(True)
-        else:
-            print("No conditions applied to CHM_height {}, height {}".format(row.CHM_height,row.height))
-            keep.append(True)
-            
+    CHM_height = pd.to_numeric(df["CHM_height"]).astype(float).values
+    height = pd.to_numeric(df["height"]).astype(float).values
+    
+    #CHM above the field height is subcanopy, below it is mismeasurement and growth
+    within_diff = np.where(CHM_height > height, (CHM_height - height) < max_CHM_diff, (height - CHM_height) < CHM_height_limit)
+    keep = np.where(np.isnan(CHM_height), False, np.where(np.isnan(height), True, (CHM_height >= min_CHM_height) & within_diff))
+    
     df["keep"] = keep
     df = df[df.keep]
     
     return df
 
-def filter_CHM(shp, CHM_pool, min_CHM_height=1, max_CHM_diff=4, CHM_height_limit=8):
+def filter_CHM(shp, CHM_pool, min_CHM_height=1, max_CHM_diff=4, CHM_height_limit=8, file_catalog=None, client=None, cache_path=None):
     """Filter points by height rules"""
     if min_CHM_height is None:
         return shp
     
     #extract CHM height
-    shp = CHM_height(shp, CHM_pool)
-    shp = height_rules(df=shp, min_CHM_height=1, max_CHM_diff=4, CHM_height_limit=8)
+    shp = CHM_height(shp, CHM_pool, file_catalog=file_catalog, client=client, cache_path=cache_path)
+    shp = height_rules(df=shp, min_CHM_height=min_CHM_height, max_CHM_diff=max_CHM_diff, CHM_height_limit=CHM_height_limit)
 
     return shp
\ No newline at end of file
@@ -1,21 +1,29 @@
+import math
 import numpy as np
 import h5py
 import os
 import rasterio
+from rasterio.transform import Affine
 
-def h5refl2array(refl_filename):
+def reflectance_dataset(hdf5_file):
+    """Return the Reflectance_Data dataset of an open NEON h5 object without reading it"""
+    file_attrs_string = str(list(hdf5_file.items()))
+    file_attrs_string_split = file_attrs_string.split("'")
+    sitename = file_attrs_string_split[1]
+
+    return hdf5_file[sitename]['Reflectance']['Reflectance_Data']
+
+def h5_metadata(hdf5_file):
     """
-    Extract metadata from h5 object and reflectance values
-    returns: metadata and a numpy array
+    Extract metadata from an open h5 object, only the header attributes are read
+    returns: metadata dictionary
     """
-    hdf5_file = h5py.File(refl_filename, 'r')
     file_attrs_string = str(list(hdf5_file.items()))
     file_attrs_string_split = file_attrs_string.split("'")
     sitename = file_attrs_string_split[1]
 
     #Extract the reflectance & wavelength datasets
     reflArray = hdf5_file[sitename]['Reflectance']
-    wavelengths = reflArray['Reflectance_Data'][:]
     # get file's EPSG
     epsg = str(reflArray['Metadata']['Coordinate_System']['EPSG Code'][()])
     #reflArray['Metadata']['Coordinate_System'].keys()
@@ -23,7 +31,7 @@ def h5refl2array(refl_filename):
     metadata = {}
     metadata['mapInfo'] = reflArray['Metadata']['Coordinate_System']['Map_Info'][()]
     metadata['wavelength'] = reflArray['Metadata']['Spectral_Data']['Wavelength'][()]
-    metadata['shape'] = wavelengths.shape
+    metadata['shape'] = reflArray['Reflectance_Data'].shape
 
     #Extract no data value & scale factor
     metadata['noDataVal'] = float(
@@ -60,6 +68,17 @@ def h5refl2array(refl_filename):
     metadata['ext_dict']['yMin'] = yMin
     metadata['ext_dict']['yMax'] = yMax
     metadata['epsg'] = epsg
+
+    return metadata
+
+def h5refl2array(refl_filename):
+    """
+    Extract metadata from h5 object and reflectance values
+    returns: metadata and a numpy array
+    """
+    hdf5_file = h5py.File(refl_filename, 'r')
+    metadata = h5_metadata(hdf5_file)
+    wavelengths = reflectance_dataset(hdf5_file)[:]
     hdf5_file.close()
 
     return metadata, wavelengths
@@ -91,34 +110,72 @@ def subset_clean_band(reflArray, reflArray_metadata, clipIndex, bandIndex):
 
 #    array2raster(tilename, hyperspec_raster, sub_meta, clipExtent, save_dir)
 
-def array2raster(newRaster, reflBandArray, reflArray_metadata, extent, ras_dir):
+#Tiled, compressed layout for crown sized random reads. Tiles are pixel interleaved so one tile holds every band of a block.
+#See benchmarks/raster_layout.py
+COG_LAYOUT = {"tiled": True, "blocksize": 32, "compress": "deflate", "predictor": 2, "interleave": "pixel", "overviews": None}
+
+def raster_profile(rows, cols, bands, dtype, reflArray_metadata, extent, layout=None):
+    """Creation options shared by the in-memory and streaming writers
+    rows, cols, bands: shape of the output raster
+    dtype: numpy dtype of the reflectance values
+    reflArray_metadata: Clipped wavelength metadata
+    extent: The UTM coordinate extent
+    layout: optional dict of tiled, blocksize, compress, predictor and interleave options, see COG_LAYOUT. None writes a plain striped GeoTIFF
+    """
+    originX = extent['xMin']
+    originY = extent['yMax']
+    res = reflArray_metadata['res']['pixelWidth']
+    transform = Affine.translation(originX, originY) * Affine.scale(res, -res)
+    profile = dict(
+        driver='GTiff',
+        height=rows,
+        width=cols,
+        count=bands,
+        dtype=dtype,
+        crs=rasterio.crs.CRS.from_dict(init='epsg:'+str(reflArray_metadata["epsg"])),
+        transform=transform)
+    
+    if layout:
+        if layout.get("tiled"):
+            profile["tiled"] = True
+            profile["blockxsize"] = layout.get("blocksize", 256)
+            profile["blockysize"] = layout.get("blocksize", 256)
+        if layout.get("compress"):
+            profile["compress"] = layout["compress"]
+            if layout.get("predictor"):
+                profile["predictor"] = layout["predictor"]
+        if layout.get("interleave"):
+            profile["interleave"] = layout["interleave"]
+
+    return profile
+
+def write_overviews(dst, layout=None):
+    """Add internal overviews to an open raster if the layout asks for them"""
+    if layout and layout.get("overviews"):
+        dst.build_overviews(layout["overviews"], rasterio.enums.Resampling.average)
+        dst.update_tags(ns='rio_overview', resampling='average')
+
+def array2raster(newRaster, reflBandArray, reflArray_metadata, extent, ras_dir, layout=None, wavelength=None, bin_size=1):
     """
     newRaster: filename of the raster object
     reflBandArray: Clipped wavelength data,
     reflArray_metadata: Clipped wavelength metadata
     extent: The UTM coordinate extent
     ras_dir: Where to save the file
+    layout: optional tiling, compression and overview options, see COG_LAYOUT
+    wavelength: optional wavelength of each band, written to the band tags
+    bin_size: number of adjacent bands averaged into each band, recorded in the tags
     """
-    from rasterio.transform import Affine
     cols = reflBandArray.shape[1]
     rows = reflBandArray.shape[0]
     bands = reflBandArray.shape[2]
-    originX = extent['xMin']
-    originY = extent['yMax']
-    res = reflArray_metadata['res']['pixelWidth']
-    transform = Affine.translation(originX, originY) * Affine.scale(res, -res)
+    profile = raster_profile(rows, cols, bands, reflBandArray.dtype, reflArray_metadata, extent, layout=layout)
     reflBandArray = np.moveaxis(reflBandArray,2,0)  
-    with rasterio.open(
-        "{}/{}".format(ras_dir,newRaster),
-         'w',
-         driver='GTiff',
-         height=rows,
-         width=cols,
-         count=bands,
-         dtype=reflBandArray.dtype,
-         crs=rasterio.crs.CRS.from_dict(init='epsg:'+str(reflArray_metadata["epsg"])),
-         transform=transform,) as dst:
+    with rasterio.open("{}/{}".format(ras_dir,newRaster), 'w', **profile) as dst:
         dst.write(reflBandArray)
+        if wavelength is not None:
+            write_band_tags(dst, wavelength, bin_size)
+        write_overviews(dst, layout)
         
     # outRaster = driver.Create(newRaster, cols, rows, bands, gdaltype)
     # outRaster.SetGeoTransform((originX, pixelWidth, 0, originY, 0, pixelHeight))
@@ -148,21 +205,18 @@ def calc_clip_index(clipExtent, h5Extent, xscale=1, yscale=1):
 
     return ind_ext
 
+#Named wavelength ranges in nanometers, resolved against the wavelengths of each tile
+BAND_RANGES = {"vnir": [(380, 1000)]}
 
-def generate_raster(h5_path, save_dir, rgb_filename=None, bands="no_water", bounds = False):
+def select_bands(bands, wavelength=None):
+    """Band indices for a named band combination or for wavelength ranges
+    bands: "all" bands or "false color", "no_water" bands, a name in BAND_RANGES, or a list of (low, high) nanometer ranges
+    wavelength: wavelength of each band in the tile, only needed for wavelength ranges, see h5_metadata
     """
-    h5_path: input path to h5 file on disk
-    bands: "all" bands or "false color", "no_water" bands
-    save_dir: Directory to save raster object
-    rgb_filename= Path to rgb image to draw extent and crs definition
-    
-    returns: True if saved file exists
-    """
-
-    #Get numpy array and metadata
-    metadata, refl = h5refl2array(h5_path)
-    
     #Select nanometers RGB see NeonTreeEvaluation/utilities/neon_aop_bands.csv
+    if isinstance(bands, str) and bands in BAND_RANGES:
+        bands = BAND_RANGES[bands]
+    
     if bands == "no_water":
         #Delete water absorption bands
         rgb = np.r_[0:425]
@@ -173,10 +227,91 @@ def generate_raster(h5_path, save_dir, rgb_filename=None, bands="no_water", boun
         rgb = [16, 54, 112]
     elif bands == "all":
         rgb = np.r_[0:426]
+    elif isinstance(bands, (list, tuple)):
+        if wavelength is None:
+            raise ValueError("wavelength ranges {} need the wavelength of each band".format(bands))
+        wavelength = np.asarray(wavelength)
+        selected = np.zeros(len(wavelength), dtype=bool)
+        for low, high in bands:
+            selected |= (wavelength >= low) & (wavelength <= high)
+        rgb = np.flatnonzero(selected)
+        if len(rgb) == 0:
+            raise ValueError("no bands within {}".format(bands))
     else:
         raise ValueError("no band combination specified")
+
+    return rgb
+
+def read_bands(dataset, row_slice, col_slice, band_index):
+    """Read a rows x cols x bands hyperslab holding only the selected bands
+    Contiguous runs of bands are read one at a time when the band axis is split across chunks, or the data is not chunked.
+    If every chunk holds all bands, the span of the selected bands is read once, a read per run would decompress each chunk again.
+    Args:
+        dataset: h5py reflectance dataset, see reflectance_dataset
+        row_slice, col_slice: slices of the rows and columns to read, clipped to the dataset like numpy slicing
+        band_index: band indices, see select_bands
+    """
+    band_index = np.asarray(band_index)
+    rows = slice(*row_slice.indices(dataset.shape[0])[:2])
+    cols = slice(*col_slice.indices(dataset.shape[1])[:2])
+    if rows.stop <= rows.start or cols.stop <= cols.start or len(band_index) == 0:
+        return np.zeros((max(rows.stop - rows.start, 0), max(cols.stop - cols.start, 0), len(band_index)), dtype=dataset.dtype)
+    
+    if dataset.chunks and dataset.chunks[2] >= dataset.shape[2]:
+        span = dataset[rows, cols, band_index.min():band_index.max() + 1]
+        return span[:, :, band_index - band_index.min()]
     
-    refl = refl[:,:,rgb]
+    #Read sorted runs of consecutive bands, then restore the requested order
+    order = np.argsort(band_index, kind="stable")
+    sorted_index = band_index[order]
+    runs = np.r_[0, np.flatnonzero(np.diff(sorted_index) != 1) + 1, len(sorted_index)]
+    blocks = [dataset[rows, cols, sorted_index[start]:sorted_index[stop - 1] + 1] for start, stop in zip(runs[:-1], runs[1:])]
+    block = np.concatenate(blocks, axis=2)
+    
+    return block[:, :, np.argsort(order, kind="stable")]
+
+def band_bins(band_index, bin_size=1):
+    """Group selected bands into bins of bin_size adjacent bands.
+    A bin never spans a gap in band_index, such as the removed water absorption bands, the last bin of each contiguous run may be narrower.
+    Args:
+        band_index: band indices, see select_bands
+        bin_size: number of adjacent bands averaged into each bin, 1 keeps every band
+    Returns:
+        starts: position in band_index of the first band of each bin
+    """
+    band_index = np.asarray(band_index)
+    if bin_size == 1:
+        return np.arange(len(band_index))
+    #Positions where a new contiguous run of bands begins
+    runs = np.r_[0, np.flatnonzero(np.diff(band_index) != 1) + 1, len(band_index)]
+    starts = [np.arange(start, stop, bin_size) for start, stop in zip(runs[:-1], runs[1:])]
+
+    return np.concatenate(starts)
+
+def bin_reflectance(refl, starts):
+    """Average the bands of a rows x cols x bands array into the bins starting at starts, see band_bins"""
+    if len(starts) == refl.shape[2]:
+        return refl
+    widths = np.diff(np.r_[starts, refl.shape[2]])
+    binned = np.add.reduceat(refl, starts, axis=2, dtype=np.float32) / widths
+
+    return np.round(binned).astype(refl.dtype)
+
+def bin_wavelengths(wavelength, band_index, bin_size=1):
+    """Center wavelength of each bin, the mean wavelength of its bands"""
+    wavelength = np.asarray(wavelength)[band_index]
+    starts = band_bins(band_index, bin_size)
+
+    return np.add.reduceat(wavelength, starts) / np.diff(np.r_[starts, len(wavelength)])
+
+def write_band_tags(dst, wavelength, bin_size=1):
+    """Record the band count, bin size and wavelength of each band of an open raster"""
+    dst.update_tags(bands=len(wavelength), bin_size=bin_size, wavelength=",".join("{:.2f}".format(x) for x in wavelength))
+    for band, x in enumerate(wavelength):
+        dst.set_band_description(band + 1, "{:.2f} nm".format(x))
+
+def clip_extent(metadata, bounds=False):
+    """UTM extent to write, the full tile unless bounds are given"""
     xmin, xmax, ymin, ymax = metadata['extent']
 
     #Optional clip
@@ -193,24 +328,228 @@ def generate_raster(h5_path, save_dir, rgb_filename=None, bands="no_water", boun
         clipExtent['xMax'] = xmax
         clipExtent['yMin'] = ymin
         clipExtent['yMax'] = ymax
+
+    return clipExtent
+
+def clip_slices(clipExtent, metadata):
+    """Row and column slices of the reflectance array that fall within the clip extent"""
     #Get hyperspectral array extent with respect to the pixel index
     subInd = calc_clip_index(clipExtent, metadata['ext_dict'])
     #Turn to integer
     for x in subInd:
         subInd[x] = int(subInd[x])
 
-    #Index numpy array of hyperspec reflectance
-    refl = refl[(subInd['yMin']):subInd['yMax'], (subInd['xMin']):subInd['xMax'], :]
+    rows = slice(subInd['yMin'], subInd['yMax'])
+    cols = slice(subInd['xMin'], subInd['xMax'])
+
+    return rows, cols
+
+def stream_raster(h5_path, newRaster, ras_dir, band_index, bounds=False, block_rows=50, layout=None, bin_size=1, metadata=None):
+    """Convert a .h5 tile to a raster one strip of rows at a time.
+    Each strip is read as a h5py hyperslab and written straight to its window in the output,
+    so peak memory is bounded by block_rows rather than by the tile.
+    h5_path: input path to h5 file on disk
+    newRaster: filename of the raster object
+    ras_dir: Where to save the file
+    band_index: band indices to keep, see select_bands
+    bounds: optional bounds to clip the tile
+    block_rows: number of rows read per strip, rounded down to a multiple of the h5 chunk height and of the tiled layout blocksize, at least one of each
+    layout: optional tiling, compression and overview options, see COG_LAYOUT
+    bin_size: number of adjacent bands averaged into each output band, see band_bins
+    metadata: optional h5_metadata of the tile, e.g. from catalog.h5_metadata, the header is read from the tile if None
+    """
+    starts = band_bins(band_index, bin_size)
+    with h5py.File(h5_path, 'r') as hdf5_file:
+        if metadata is None:
+            metadata = h5_metadata(hdf5_file)
+        refl = reflectance_dataset(hdf5_file)
+        clipExtent = clip_extent(metadata, bounds)
+        row_slice, col_slice = clip_slices(clipExtent, metadata)
+
+        #Same clipping semantics as slicing the full array in memory
+        row_start, row_stop, _ = row_slice.indices(refl.shape[0])
+        col_start, col_stop, _ = col_slice.indices(refl.shape[1])
+        rows = max(row_stop - row_start, 0)
+        cols = max(col_stop - col_start, 0)
+
+        #Don't split h5 chunks across strips, each chunk would be decompressed twice, and write tiled outputs in whole rows of tiles.
+        #Strips are a multiple of both, the least common multiple of the chunk height and the blocksize
+        step = refl.chunks[0] if refl.chunks else 1
+        if layout and layout.get("tiled"):
+            step = math.lcm(step, layout.get("blocksize", 256))
+        block_rows = max(block_rows // step, 1) * step
+
+        profile = raster_profile(rows, cols, len(starts), refl.dtype, metadata, clipExtent, layout=layout)
+        with rasterio.open("{}/{}".format(ras_dir, newRaster), 'w', **profile) as dst:
+            for row in range(0, rows, block_rows):
+                nrows = min(block_rows, rows - row)
+                block = read_bands(refl, slice(row_start + row, row_start + row + nrows), slice(col_start, col_stop), band_index)
+                block = bin_reflectance(block, starts)
+                block = np.moveaxis(block, 2, 0)
+                dst.write(block, window=rasterio.windows.Window(0, row, cols, nrows))
+            write_band_tags(dst, bin_wavelengths(metadata['wavelength'], band_index, bin_size), bin_size)
+            write_overviews(dst, layout)
+
+    return newRaster
+
+def bands_tag(bands="no_water"):
+    """Part of the tile name for a band selection, empty for the default no_water bands, e.g. _vnir or _400-450nm_800-810nm"""
+    if bands == "no_water":
+        return ""
+    if isinstance(bands, str):
+        return "_{}".format(bands)
+    
+    return "".join("_{:g}-{:g}nm".format(low, high) for low, high in bands)
+
+def hyperspectral_suffix(bin_size=1, bands="no_water"):
+    """End of the name of converted .tif tiles, filter a pool of tiles by it so tiles of other band selections or bin sizes are never mixed"""
+    suffix = "_hyperspectral" + bands_tag(bands)
+    if bin_size == 1:
+        return suffix + ".tif"
+    
+    return "{}_bin{}.tif".format(suffix, bin_size)
+
+def hyperspectral_name(rgb_filename, bin_size=1, bands="no_water"):
+    """Basename of the .tif converted from the .h5 matching an rgb tile. Other band selections and binned tiles are named
+    _hyperspectral{bands_tag}_bin{bin_size}.tif, so they never overwrite, or get mistaken for, the full no_water tile"""
+    basename = os.path.splitext(os.path.basename(rgb_filename))[0]
+    
+    return basename + hyperspectral_suffix(bin_size, bands)
+
+def band_count(bands="no_water", bin_size=1):
+    """Number of bands of a converted tile, the input size of the model"""
+    return len(band_bins(select_bands(bands), bin_size))
+
+def generate_raster(h5_path, save_dir, rgb_filename=None, bands="no_water", bounds = False, block_rows=None, layout=None, bin_size=1, metadata=None):
+    """
+    h5_path: input path to h5 file on disk
+    bands: "all" bands or "false color", "no_water" bands, or wavelength ranges, see select_bands
+    save_dir: Directory to save raster object
+    rgb_filename= Path to rgb image to draw extent and crs definition
+    block_rows: optional, stream the conversion in strips of block_rows rows instead of loading the full tile into memory
+    layout: optional tiling, compression and overview options, see COG_LAYOUT. None writes a plain striped GeoTIFF
+    bin_size: optional, average every bin_size adjacent bands into one, e.g. 2 writes 185 instead of 369 no_water bands.
+        The band count and center wavelengths are recorded in the tif tags.
+    metadata: optional h5_metadata of the tile, e.g. from catalog.h5_metadata, the header is read from the tile if None
+    
+    returns: True if saved file exists
+    """
+    #Resolve the band selection against the wavelengths of this tile
+    if metadata is None:
+        with h5py.File(h5_path, 'r') as hdf5_file:
+            metadata = h5_metadata(hdf5_file)
+    rgb = select_bands(bands, metadata['wavelength'])
 
     #Create new filepath
     if bands == "false_color":
         tilename = os.path.splitext(
             os.path.basename(rgb_filename))[0] + "_false_color.tif"
     else:
-        tilename = os.path.splitext(
-            os.path.basename(rgb_filename))[0] + "_hyperspectral.tif"
+        tilename = hyperspectral_name(rgb_filename, bin_size, bands)
+
+    if block_rows:
+        stream_raster(h5_path, tilename, save_dir, band_index=rgb, bounds=bounds, block_rows=block_rows, layout=layout, bin_size=bin_size, metadata=metadata)
+        return tilename
+
+    clipExtent = clip_extent(metadata, bounds)
+
+    #Index numpy array of hyperspec reflectance, only the selected bands are read
+    row_slice, col_slice = clip_slices(clipExtent, metadata)
+    with h5py.File(h5_path, 'r') as hdf5_file:
+        refl = read_bands(reflectance_dataset(hdf5_file), row_slice, col_slice, rgb)
+    refl = bin_reflectance(refl, band_bins(rgb, bin_size))
 
     #Save georeference crop to file
-    array2raster(tilename, refl, metadata, clipExtent, save_dir)
+    wavelength = bin_wavelengths(metadata['wavelength'], rgb, bin_size)
+    array2raster(tilename, refl, metadata, clipExtent, save_dir, layout=layout, wavelength=wavelength, bin_size=bin_size)
 
     return tilename
+
+def window_indices(window, height, width):
+    """Row and column indices sampled by a rasterio read of a window.
+    Fractional windows are clipped to the dataset and nearest sampled, the same as rasterio.
+    Returns:
+        rows, cols: integer index arrays, empty if the window falls outside the dataset
+    """
+    def axis_indices(offset, length, size):
+        start = max(offset, 0)
+        stop = min(offset + length, size)
+        n = int(round(stop - start)) if stop > start else 0
+        if n == 0:
+            return np.zeros(0, dtype=int)
+        return np.floor(start + (np.arange(n) + 0.5) * (stop - start) / n).astype(int)
+
+    rows = axis_indices(window.row_off, window.height, height)
+    cols = axis_indices(window.col_off, window.width, width)
+
+    return rows, cols
+
+class H5Reader():
+    """Windowed reads straight from a NEON reflectance .h5 tile, mimicking a rasterio dataset.
+    Only the hyperslab under the window is read and the band subset is applied at read time, 
+    so crops match the converted _hyperspectral.tif without writing it.
+    Args:
+        h5_path: input path to h5 file on disk
+        bands: "all" bands or "false color", "no_water" bands, or wavelength ranges, see select_bands
+    """
+    def __init__(self, h5_path, bands="no_water"):
+        self.name = h5_path
+        self.hdf5_file = h5py.File(h5_path, 'r')
+        self.metadata = h5_metadata(self.hdf5_file)
+        self.dataset = reflectance_dataset(self.hdf5_file)
+        self.band_index = np.asarray(select_bands(bands, self.metadata['wavelength']))
+        
+        self.height, self.width = self.dataset.shape[:2]
+        self.count = len(self.band_index)
+        self.dtypes = tuple([str(self.dataset.dtype)] * self.count)
+        self.nodata = self.metadata['noDataVal']
+        self.res = (self.metadata['res']['pixelWidth'], self.metadata['res']['pixelHeight'])
+        self.transform = Affine.translation(self.metadata['ext_dict']['xMin'], self.metadata['ext_dict']['yMax']) * Affine.scale(self.res[0], -self.res[0])
+        self.crs = rasterio.crs.CRS.from_dict(init='epsg:'+str(self.metadata["epsg"]))
+        xmin, xmax, ymin, ymax = self.metadata['extent']
+        self.bounds = rasterio.coords.BoundingBox(xmin, ymin, xmax, ymax)
+    
+    @property
+    def shape(self):
+        return (self.height, self.width)
+    
+    @property
+    def closed(self):
+        return not self.hdf5_file.id.valid
+    
+    def window_transform(self, window):
+        return rasterio.windows.transform(window, self.transform)
+    
+    def read(self, indexes=None, window=None):
+        """Read a window as a bands x rows x cols array
+        Args:
+            indexes: optional 1-based band index or list of band indices within the band subset
+            window: rasterio.windows.Window, the full tile if None
+        """
+        if window is None:
+            window = rasterio.windows.Window(0, 0, self.width, self.height)
+        band_index = self.band_index
+        if indexes is not None:
+            band_index = band_index[np.atleast_1d(indexes) - 1]
+        
+        rows, cols = window_indices(window, self.height, self.width)
+        if rows.size == 0 or cols.size == 0:
+            img = np.zeros((len(band_index), rows.size, cols.size), dtype=self.dataset.dtype)
+        else:
+            block = read_bands(self.dataset, slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1), band_index)
+            block = block[rows - rows[0]][:, cols - cols[0]]
+            img = np.moveaxis(block, 2, 0)
+        
+        if np.isscalar(indexes):
+            return img[0]
+        
+        return img
+    
+    def close(self):
+        self.hdf5_file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,37 @@
+#Atomic writes for files shared between workers. Output is written under a hidden temporary name in the target directory and renamed into place,
+#so a reader sees the previous file or the complete new one, never a partial write.
+import contextlib
+import os
+import shutil
+import tempfile
+
+@contextlib.contextmanager
+def atomic_write(path, suffix="", directory=False):
+    """Yield a temporary path next to path, renamed to path when the block exits without error and removed otherwise
+    Args:
+        path: output file, or output directory if directory is True
+        suffix: suffix of the temporary name, for writers that pick a format from the extension
+        directory: create a temporary directory instead of a file, an existing directory at path is replaced
+    Yields:
+        tmp_path: write here instead of path. Files are synced to disk before the rename
+    """
+    parent = os.path.dirname(path) or "."
+    if directory:
+        tmp_path = tempfile.mkdtemp(dir=parent, prefix=".", suffix=suffix)
+    else:
+        fd, tmp_path = tempfile.mkstemp(dir=parent, prefix=".", suffix=suffix)
+        os.close(fd)
+    try:
+        yield tmp_path
+        if directory:
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            with open(tmp_path, "rb") as f:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if directory:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
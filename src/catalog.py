@@ -0,0 +1,344 @@
+#Persistent catalog of NEON sensor tile metadata. Scan the sensor pools once and look up extent, crs, resolution and wavelengths without opening the rasters.
+#The same file holds a listing of the sensor directories, so globs over the NeonData tree don't walk the filesystem each time, see find_files
+import glob
+import json
+import os
+import re
+import sqlite3
+import time
+import h5py
+import numpy as np
+import pandas as pd
+import rasterio
+from src import Hyperspectral
+from src import neon_paths
+
+COLUMNS = ["path", "sensor", "mtime", "geo_index", "year", "site", "crs", "left", "bottom", "right", "top",
+           "res", "width", "height", "bands", "dtype", "nodata", "wavelengths", "elevation"]
+
+def connect(catalog_path):
+    """Open the catalog, creating the tables on first use"""
+    connection = sqlite3.connect(catalog_path, timeout=60)
+    connection.execute("""CREATE TABLE IF NOT EXISTS tiles (
+        path TEXT PRIMARY KEY, sensor TEXT, mtime REAL, geo_index TEXT, year INTEGER, site TEXT, crs TEXT,
+        left REAL, bottom REAL, right REAL, top REAL, res REAL, width INTEGER, height INTEGER, bands INTEGER,
+        dtype TEXT, nodata REAL, wavelengths TEXT, elevation REAL)""")
+    connection.execute("CREATE INDEX IF NOT EXISTS tiles_geo_index ON tiles (sensor, geo_index)")
+    connection.execute("CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, parent TEXT, mtime REAL)")
+    connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, directory TEXT)")
+    connection.execute("CREATE INDEX IF NOT EXISTS files_directory ON files (directory)")
+    connection.execute("CREATE TABLE IF NOT EXISTS roots (path TEXT PRIMARY KEY, refreshed REAL)")
+
+    return connection
+
+def read_tile_metadata(path, sensor):
+    """Read the header of a single sensor tile
+    Args:
+        path: .h5 reflectance tile or a raster readable by rasterio
+        sensor: name of the sensor pool, e.g. "HSI", "RGB" or "CHM"
+    Returns:
+        record: dict with an entry for each of COLUMNS
+    """
+    record = {"path": path, "sensor": sensor, "mtime": os.path.getmtime(path)}
+    record["geo_index"] = neon_paths.geoindex_from_path(path)
+    record["year"] = neon_paths.year_from_path(path)
+    try:
+        record["site"] = neon_paths.site_from_path(path)
+    except AttributeError:
+        record["site"] = None
+
+    if path.endswith(".h5"):
+        with h5py.File(path, 'r') as hdf5_file:
+            metadata = Hyperspectral.h5_metadata(hdf5_file)
+            dataset = Hyperspectral.reflectance_dataset(hdf5_file)
+            ancillary = dataset.parent["Metadata"]["Ancillary_Imagery"]
+            elevation = float(np.mean(ancillary["Smooth_Surface_Elevation"][()]))
+            record["dtype"] = str(dataset.dtype)
+        xmin, xmax, ymin, ymax = metadata["extent"]
+        record.update({
+            "crs": "EPSG:{}".format(metadata["epsg"]), "left": xmin, "bottom": ymin, "right": xmax, "top": ymax,
+            "res": metadata["res"]["pixelWidth"], "height": metadata["shape"][0], "width": metadata["shape"][1],
+            "bands": metadata["shape"][2], "nodata": metadata["noDataVal"],
+            "wavelengths": json.dumps(metadata["wavelength"].tolist()), "elevation": elevation})
+    else:
+        with rasterio.open(path) as src:
+            record.update({
+                "crs": src.crs.to_string() if src.crs else None, "left": src.bounds.left, "bottom": src.bounds.bottom,
+                "right": src.bounds.right, "top": src.bounds.top, "res": src.res[0], "height": src.height,
+                "width": src.width, "bands": src.count, "dtype": src.dtypes[0], "nodata": src.nodata,
+                "wavelengths": None, "elevation": None})
+
+    return record
+
+def build_catalog(catalog_path, pools):
+    """Scan sensor pools and record tile metadata. Only new files, or files whose mtime changed, are opened.
+    Files that are no longer in a pool are removed. The pools are listed through the same catalog, see find_files
+    Args:
+        catalog_path: sqlite file to create or update
+        pools: dict of sensor name -> glob, e.g. {"HSI": config["HSI_sensor_pool"]}
+    Returns:
+        counts: dict with the number of added, updated, unchanged, removed and failed tiles
+    """
+    counts = {"added": 0, "updated": 0, "unchanged": 0, "removed": 0, "failed": 0}
+    connection = connect(catalog_path)
+    for sensor, pool in pools.items():
+        paths = find_files(pool, catalog_path)
+        known = dict(connection.execute("SELECT path, mtime FROM tiles WHERE sensor = ?", (sensor,)).fetchall())
+        for path in paths:
+            mtime = os.path.getmtime(path)
+            if known.get(path) == mtime:
+                counts["unchanged"] += 1
+                continue
+            try:
+                record = read_tile_metadata(path, sensor)
+            except Exception as e:
+                print("{} failed to read tile metadata: {}".format(path, e))
+                counts["failed"] += 1
+                continue
+            connection.execute("INSERT OR REPLACE INTO tiles VALUES ({})".format(",".join("?" * len(COLUMNS))),
+                               [record[x] for x in COLUMNS])
+            if path in known:
+                counts["updated"] += 1
+            else:
+                counts["added"] += 1
+
+        removed = set(known) - set(paths)
+        connection.executemany("DELETE FROM tiles WHERE path = ?", [(x,) for x in removed])
+        counts["removed"] += len(removed)
+        connection.commit()
+    connection.close()
+
+    return counts
+
+def query(catalog_path, sensor=None, geo_index=None, year=None):
+    """Tile metadata as a pandas dataframe, optionally filtered by sensor, geo_index and year"""
+    clauses = []
+    values = []
+    for column, value in [("sensor", sensor), ("geo_index", geo_index), ("year", year)]:
+        if value is not None:
+            clauses.append("{} = ?".format(column))
+            values.append(value)
+    sql = "SELECT * FROM tiles"
+    if clauses:
+        sql = "{} WHERE {}".format(sql, " AND ".join(clauses))
+    connection = connect(catalog_path)
+    df = pd.read_sql_query(sql, connection, params=values)
+    connection.close()
+
+    return df
+
+def tile_metadata(catalog_path, path):
+    """Metadata for a single tile, wavelengths are decoded to a numpy array
+    Returns:
+        record: dict, None if the tile is not in the catalog
+    """
+    connection = connect(catalog_path)
+    row = connection.execute("SELECT * FROM tiles WHERE path = ?", (path,)).fetchone()
+    connection.close()
+    if row is None:
+        return None
+
+    record = dict(zip(COLUMNS, row))
+    if record["wavelengths"] is not None:
+        record["wavelengths"] = np.array(json.loads(record["wavelengths"]))
+
+    return record
+
+def h5_metadata(catalog_path, path):
+    """Metadata of a .h5 tile in the form of Hyperspectral.h5_metadata, only the header fields the conversion needs
+    Returns:
+        metadata: dict, None if the tile is not in the catalog or changed since it was scanned
+    """
+    record = tile_metadata(catalog_path, path)
+    if record is None or record["wavelengths"] is None or not record["mtime"] == os.path.getmtime(path):
+        return None
+
+    metadata = {
+        "wavelength": record["wavelengths"],
+        "shape": (record["height"], record["width"], record["bands"]),
+        "noDataVal": record["nodata"],
+        "res": {"pixelWidth": record["res"], "pixelHeight": record["res"]},
+        "epsg": record["crs"].split(":")[1],
+        "extent": (record["left"], record["right"], record["bottom"], record["top"]),
+        "ext_dict": {"xMin": record["left"], "xMax": record["right"], "yMin": record["bottom"], "yMax": record["top"]}}
+
+    return metadata
+
+def pattern_to_regex(pattern):
+    """Compile a glob pattern to a regex over full paths, ** matches any number of directories as in glob.glob(recursive=True)"""
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:[^/]*/)*"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 1:]:
+            end = pattern.index("]", i + 2 if pattern[i + 1] == "]" else i + 1)
+            body = pattern[i + 1:end]
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            regex += "[{}]".format(body.replace("\\", "\\\\"))
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    #Repeated slashes, e.g. a directory with a trailing slash joined to /*.tif, match a single slash
+    regex = re.sub("/+", "/", regex)
+
+    return re.compile(regex + "$")
+
+def pattern_root(pattern):
+    """Deepest directory of a glob pattern without wildcards, the directory that is listed"""
+    parts = pattern.split("/")
+    for index, part in enumerate(parts):
+        if glob.has_magic(part):
+            return "/".join(parts[:index]) or "/"
+
+    return os.path.dirname(pattern)
+
+def below(root):
+    """Range of paths below a directory, for BETWEEN queries on the primary key"""
+    prefix = root.rstrip("/") + "/"
+
+    return prefix, prefix + "\uffff"
+
+def read_listing(connection, root):
+    """Directory mtimes and subdirectories below root as last listed
+    Returns:
+        known: dict of directory -> mtime
+        children: dict of directory -> list of subdirectories
+    """
+    known = dict(connection.execute("SELECT path, mtime FROM directories WHERE path = ? OR path BETWEEN ? AND ?",
+                                    (root, *below(root))).fetchall())
+    children = {}
+    for path, parent in connection.execute("SELECT path, parent FROM directories WHERE path BETWEEN ? AND ?", below(root)):
+        children.setdefault(parent, []).append(path)
+
+    return known, children
+
+def walk(root, known, children):
+    """Walk root and the directories below it. A directory is listed again only if its mtime changed,
+    unchanged directories are only stat'ed on the way to their subdirectories. Touches the filesystem only, not the catalog
+    Returns:
+        changed: list of (directory, mtime, files) of directories that were listed
+        seen: set of directories that exist
+    """
+    changed = []
+    seen = set()
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            continue
+        seen.add(directory)
+        if known.get(directory) == mtime:
+            stack.extend(children.get(directory, []))
+            continue
+
+        #Hidden entries are skipped, the same as glob wildcards, this includes partial conversions in HSI_tif_dir
+        files = []
+        subdirectories = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir():
+                        subdirectories.append(entry.path)
+                    else:
+                        files.append(entry.path)
+        except OSError:
+            continue
+        changed.append((directory, mtime, files))
+        stack.extend(subdirectories)
+
+    return changed, seen
+
+def update_listing(connection, changed, removed):
+    """Replace the listing of changed directories and drop removed ones"""
+    for directory, mtime, files in changed:
+        connection.execute("DELETE FROM files WHERE directory = ?", (directory,))
+        connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?)", [(x, directory) for x in files])
+        connection.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?)", (directory, os.path.dirname(directory), mtime))
+    removed = [(x,) for x in removed]
+    connection.executemany("DELETE FROM files WHERE directory = ?", removed)
+    connection.executemany("DELETE FROM directories WHERE path = ?", removed)
+
+def refresh_files(connection, root):
+    """Update the listing of root and the directories below it. The walk runs outside any transaction,
+    the write lock is only held to replace the listing, so concurrent workers are not serialized behind one walk.
+    Returns:
+        refreshed: whether this call replaced the listing, False if another worker refreshed root after the walk started
+    """
+    root = root.rstrip("/") or "/"
+    started = time.time()
+    known, children = read_listing(connection, root)
+    changed, seen = walk(root, known, children)
+
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        refreshed = connection.execute("SELECT refreshed FROM roots WHERE path = ?", (root,)).fetchone()
+        if refreshed is not None and refreshed[0] >= started:
+            connection.rollback()
+            return False
+        update_listing(connection, changed, set(known) - seen)
+        connection.execute("INSERT OR REPLACE INTO roots VALUES (?, ?)", (root, started))
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+
+    return True
+
+def find_files(pattern, catalog_path=None, max_age=600):
+    """Drop in replacement for glob.glob(pattern, recursive=True) backed by the catalog
+    The listing below the pattern root is refreshed at most every max_age seconds, and only changed directories are listed again.
+    Relative patterns are resolved against the working directory and return relative paths, as glob does.
+    The catalog relies on sqlite file locking, which is unreliable on NFS and Lustre. Keep catalog_path on local disk,
+    one catalog per node, rather than on shared scratch space.
+    Args:
+        pattern: glob, recursive ** allowed
+        catalog_path: sqlite catalog, None falls back to glob.glob
+        max_age: seconds before the listing is refreshed, 0 refreshes on every call
+    Returns:
+        paths: list of matching file paths
+    """
+    if catalog_path is None:
+        return glob.glob(pattern, recursive=True)
+
+    relative = not os.path.isabs(pattern)
+    if relative:
+        pattern = os.path.join(os.getcwd(), pattern)
+    root = pattern_root(pattern).rstrip("/") or "/"
+    connection = connect(catalog_path)
+    try:
+        refreshed = connection.execute("SELECT refreshed FROM roots WHERE path = ?", (root,)).fetchone()
+        if refreshed is None or time.time() - refreshed[0] >= max_age:
+            refresh_files(connection, root)
+        paths = [x[0] for x in connection.execute("SELECT path FROM files WHERE path BETWEEN ? AND ?", below(root))]
+    finally:
+        connection.close()
+
+    regex = pattern_to_regex(pattern)
+    paths = [x for x in paths if regex.match(x)]
+    if relative:
+        paths = [os.path.relpath(x) for x in paths]
+
+    return paths
+
+if __name__ == "__main__":
+    from src.utils import read_config
+    config = read_config("config.yml")
+    counts = build_catalog(config["tile_catalog"], pools={"HSI": config["HSI_sensor_pool"], "RGB": config["rgb_sensor_pool"], "CHM": config["CHM_pool"]})
+    print(counts)
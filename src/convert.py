@@ -0,0 +1,125 @@
+#Convert NEON .h5 reflectance tiles to .tif for a site, in parallel and resumable
+#python -m src.convert --site OSBS --year 2019 --workers 10 --memory 2000
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from src import catalog
+from src import Hyperspectral
+from src import neon_paths
+
+MANIFEST = "conversion_manifest.csv"
+
+def match_tiles(rgb_pool, hyperspectral_pool, site=None, year=None):
+    """Pair each rgb tile with the .h5 tile of the same geoindex and year
+    Args:
+        rgb_pool: list of rgb tile paths
+        hyperspectral_pool: list of .h5 paths
+        site: optional siteID to filter rgb tiles
+        year: optional year to filter rgb tiles
+    Returns:
+        tiles: list of (h5_path, rgb_path)
+    """
+    h5_lookup = {}
+    for path in hyperspectral_pool:
+        h5_lookup[(neon_paths.geoindex_from_path(path), neon_paths.year_from_path(path))] = path
+
+    tiles = []
+    for rgb_path in rgb_pool:
+        if site and not site in rgb_path:
+            continue
+        rgb_year = neon_paths.year_from_path(rgb_path)
+        if year and not rgb_year == int(year):
+            continue
+        h5_path = h5_lookup.get((neon_paths.geoindex_from_path(rgb_path), rgb_year))
+        if h5_path is None:
+            print("No .h5 tile matches {}".format(rgb_path))
+            continue
+        tiles.append((h5_path, rgb_path))
+
+    return tiles
+
+def block_rows_for_budget(memory, cols=1000, bands=426, itemsize=2):
+    """Rows per streamed strip that keep a worker within memory MB.
+    A strip is held three times, the h5 read, the band subset and the band first copy written to disk.
+    """
+    row_bytes = cols * bands * itemsize * 3
+
+    return max(int(memory * 1e6 // row_bytes), 1)
+
+def convert_tile(h5_path, rgb_path, savedir, block_rows=50, layout=None, bin_size=1, tile_catalog=None):
+    """Convert one tile through a temporary directory in savedir and rename it into place,
+    a crash never leaves a partial .tif under the final name. Shares the lock and .done marker of neon_paths.lookup_and_convert,
+    so a site conversion and a crop generation run can work on the same directory."""
+    return neon_paths.convert_h5_once(h5_path, rgb_path, savedir, block_rows=block_rows, layout=layout, bin_size=bin_size, tile_catalog=tile_catalog)
+
+def read_manifest(savedir):
+    """tif paths of completed conversions"""
+    manifest = "{}/{}".format(savedir, MANIFEST)
+    if not os.path.exists(manifest):
+        return set()
+    with open(manifest) as f:
+        completed = [x.strip().split(",")[0] for x in f if x.strip()]
+
+    return set(completed)
+
+def convert_tiles(tiles, savedir, workers=1, memory=2000, layout=None, bin_size=1, tile_catalog=None):
+    """Convert tiles across a process pool, skipping tiles recorded in the manifest of a previous run
+    Args:
+        tiles: list of (h5_path, rgb_path), see match_tiles
+        savedir: directory for .tif files and the manifest
+        workers: number of processes
+        memory: per worker memory budget in MB, sets the streamed strip height
+        layout: optional tiling and compression of the .tif, see Hyperspectral.COG_LAYOUT
+        bin_size: number of adjacent bands averaged into each band, see Hyperspectral.band_bins
+        tile_catalog: optional tile metadata catalog, .h5 headers are read from it instead of the tiles, see catalog.build_catalog
+    Returns:
+        converted: list of tif paths written in this run
+    """
+    completed = read_manifest(savedir)
+    remaining = []
+    for h5_path, rgb_path in tiles:
+        tif_path = "{}/{}".format(savedir, Hyperspectral.hyperspectral_name(rgb_path, bin_size))
+        if tif_path in completed and os.path.exists(tif_path):
+            continue
+        remaining.append((h5_path, rgb_path))
+    print("{} of {} tiles already converted, converting {}".format(len(tiles) - len(remaining), len(tiles), len(remaining)))
+
+    block_rows = block_rows_for_budget(memory)
+    converted = []
+    with ProcessPoolExecutor(max_workers=workers) as executor, open("{}/{}".format(savedir, MANIFEST), "a") as manifest:
+        futures = {executor.submit(convert_tile, h5_path, rgb_path, savedir, block_rows, layout, bin_size, tile_catalog): h5_path for h5_path, rgb_path in remaining}
+        for future in as_completed(futures):
+            try:
+                tif_path = future.result()
+            except Exception as e:
+                print("{} failed with {}".format(futures[future], e))
+                continue
+            #Record each tile as soon as it lands so a restart picks up from here
+            manifest.write("{},{},{}\n".format(tif_path, futures[future], time.strftime("%Y-%m-%dT%H:%M:%S")))
+            manifest.flush()
+            converted.append(tif_path)
+
+    return converted
+
+if __name__ == "__main__":
+    from src.utils import read_config
+    parser = argparse.ArgumentParser("Convert NEON .h5 reflectance tiles to .tif")
+    parser.add_argument("--site", help="siteID, e.g. OSBS")
+    parser.add_argument("--year", help="flight year, e.g. 2019")
+    parser.add_argument("--glob", help="glob of rgb tiles to convert, defaults to rgb_sensor_pool in config.yml")
+    parser.add_argument("--savedir", help="defaults to HSI_tif_dir in config.yml")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--memory", type=int, default=2000, help="MB per worker")
+    parser.add_argument("--cog", action="store_true", help="write tiled, compressed tifs, see Hyperspectral.COG_LAYOUT")
+    parser.add_argument("--bin_size", type=int, help="average adjacent bands, 2 writes 185 bands, 4 writes 93. Defaults to bin_size in config.yml")
+    args = parser.parse_args()
+
+    config = read_config("config.yml")
+    rgb_pool = catalog.find_files(args.glob or config["rgb_sensor_pool"], config.get("file_catalog"))
+    rgb_pool = [x for x in rgb_pool if not "point_cloud" in x]
+    hyperspectral_pool = catalog.find_files(config["HSI_sensor_pool"], config.get("file_catalog"))
+    tiles = match_tiles(rgb_pool, hyperspectral_pool, site=args.site, year=args.year)
+    layout = Hyperspectral.COG_LAYOUT if args.cog else None
+    converted = convert_tiles(tiles, savedir=args.savedir or config["HSI_tif_dir"], workers=args.workers, memory=args.memory, layout=layout, bin_size=args.bin_size or config.get("bin_size", 1), tile_catalog=config.get("tile_catalog"))
+    print("Converted {} tiles".format(len(converted)))
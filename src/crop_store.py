@@ -0,0 +1,164 @@
+#Crop store, every crown crop in one contiguous binary file with an index table, read back through numpy.memmap.
+#Replaces one small .tif per crown, which is slow to open by the ten thousand on networked storage.
+#Each generate_crops task appends a shard of its own, consolidate moves finished shards into the data file, crops.bin until replaced crops are compacted away.
+import glob
+import os
+import shutil
+import uuid
+import numpy as np
+import pandas as pd
+from src.atomic import atomic_write
+
+DATA = "crops.bin"
+INDEX = "index.csv"
+COLUMNS = ["individual", "file", "offset", "bands", "height", "width", "dtype", "tile", "left", "bottom", "right", "top"]
+
+def crop_path(store, individual):
+    """image_path of a crop in the store, the basename is the individual as for a .tif crop"""
+    return "{}/{}".format(store.rstrip("/"), individual)
+
+def write_shard(store, key, crops, individuals, tile, bounds):
+    """Append crops to the store as shard key
+    Args:
+        store: crop store directory
+        key: shard name, e.g. the geo_index of the tile the crops were cut from
+        crops: list of bands x rows x cols arrays
+        individuals: individual of each crop
+        tile: sensor tile the crops were cut from
+        bounds: n x 4 array of left, bottom, right, top of each crop
+    Returns:
+        index: dataframe of the shard, see COLUMNS
+    """
+    shard_dir = "{}/shards".format(store)
+    os.makedirs(shard_dir, exist_ok=True)
+    records = []
+    offset = 0
+    #Write to temporary names and rename the index last, a shard without an index is never read
+    with atomic_write("{}/{}.bin".format(shard_dir, key), suffix=".bin") as tmp_path:
+        with open(tmp_path, "wb") as f:
+            for crop, individual, (left, bottom, right, top) in zip(crops, individuals, bounds):
+                crop = np.ascontiguousarray(crop)
+                f.write(crop.tobytes())
+                records.append([individual, "shards/{}.bin".format(key), offset, crop.shape[0], crop.shape[1], crop.shape[2], str(crop.dtype), tile, left, bottom, right, top])
+                offset += crop.nbytes
+
+    index = pd.DataFrame(records, columns=COLUMNS)
+    with atomic_write("{}/{}.csv".format(shard_dir, key), suffix=".csv") as tmp_path:
+        index.to_csv(tmp_path, index=False)
+
+    return index
+
+def read_index(store):
+    """Index of every crop in the store, consolidated and in shards. An individual written more than once keeps its latest crop"""
+    paths = ["{}/{}".format(store, INDEX)] + sorted(glob.glob("{}/shards/*.csv".format(store)))
+    index = [pd.read_csv(x, dtype={"individual": str}) for x in paths if os.path.exists(x)]
+    if len(index) == 0:
+        return pd.DataFrame(columns=COLUMNS)
+    index = pd.concat(index, ignore_index=True)
+
+    return index.drop_duplicates("individual", keep="last").reset_index(drop=True)
+
+def crop_nbytes(index):
+    """Bytes of each crop of an index"""
+    itemsize = index["dtype"].map(lambda x: np.dtype(x).itemsize)
+
+    return (index["bands"] * index["height"] * index["width"] * itemsize).astype(int)
+
+def consolidate(store):
+    """Move the crops of every shard into the store data file and drop the shards. Run from a single process once the writers are done.
+    Shards are appended to the data file. If they replace crops already in the store, the data file is instead rewritten with only the latest crop
+    of each individual, so replaced crops don't pile up.
+    Returns:
+        index: dataframe of the consolidated store, see COLUMNS
+    """
+    shards = sorted(glob.glob("{}/shards/*.csv".format(store)))
+    if len(shards) == 0:
+        return read_index(store)
+
+    index_path = "{}/{}".format(store, INDEX)
+    index = pd.read_csv(index_path, dtype={"individual": str}) if os.path.exists(index_path) else pd.DataFrame(columns=COLUMNS)
+    data_file = index["file"].iloc[0] if not index.empty else DATA
+    shard_indices = []
+    for shard in shards:
+        shard_index = pd.read_csv(shard, dtype={"individual": str})
+        shard_index["file"] = "shards/{}.bin".format(os.path.splitext(os.path.basename(shard))[0])
+        shard_indices.append(shard_index)
+    merged = pd.concat([index] + shard_indices, ignore_index=True)
+    latest = merged.drop_duplicates("individual", keep="last")
+    
+    if latest.shape[0] == merged.shape[0]:
+        #Nothing is replaced, append the shards
+        with open("{}/{}".format(store, data_file), "ab") as data:
+            for shard_index in shard_indices:
+                bin_path = "{}/{}".format(store, shard_index["file"].iloc[0])
+                shard_index["offset"] += data.tell()
+                shard_index["file"] = data_file
+                with open(bin_path, "rb") as f:
+                    shutil.copyfileobj(f, data)
+        index = pd.concat([index] + shard_indices, ignore_index=True)
+        old_data_file = None
+    else:
+        #Copy the latest crops to a new data file, readers keep the old one until the index points to the new one
+        index = latest.copy()
+        new_data_file = "crops-{}.bin".format(uuid.uuid4().hex)
+        offsets = []
+        sources = {}
+        with atomic_write("{}/{}".format(store, new_data_file), suffix=".bin") as tmp_path:
+            with open(tmp_path, "wb") as data:
+                for source, offset, nbytes in zip(index["file"], index["offset"], crop_nbytes(index)):
+                    if not source in sources:
+                        sources[source] = open("{}/{}".format(store, source), "rb")
+                    sources[source].seek(offset)
+                    offsets.append(data.tell())
+                    data.write(sources[source].read(nbytes))
+        for f in sources.values():
+            f.close()
+        index["offset"] = offsets
+        index["file"] = new_data_file
+        old_data_file = data_file if os.path.exists("{}/{}".format(store, data_file)) else None
+
+    #The index is replaced in one rename, shards and a rewritten data file are removed only after it is in place
+    with atomic_write(index_path, suffix=".csv") as tmp_path:
+        index.to_csv(tmp_path, index=False)
+    for shard in shards:
+        os.remove(shard)
+        os.remove("{}.bin".format(os.path.splitext(shard)[0]))
+    if old_data_file is not None:
+        os.remove("{}/{}".format(store, old_data_file))
+
+    return index.reset_index(drop=True)
+
+class CropReader():
+    """Zero copy reads of crops from a store
+    Args:
+        store: crop store directory
+    """
+    def __init__(self, store):
+        self.store = store
+        self.index = read_index(store).set_index("individual")
+        self.maps = {}
+
+    def __getstate__(self):
+        #Memory maps are opened again in each DataLoader worker rather than copied into it
+        state = self.__dict__.copy()
+        state["maps"] = {}
+
+        return state
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def __contains__(self, individual):
+        return str(individual) in self.index.index
+
+    def read(self, individual):
+        """Crop of an individual as a read only bands x rows x cols view of the store"""
+        record = self.index.loc[str(individual)]
+        if not record["file"] in self.maps:
+            self.maps[record["file"]] = np.memmap("{}/{}".format(self.store, record["file"]), dtype=np.uint8, mode="r")
+        shape = (int(record["bands"]), int(record["height"]), int(record["width"]))
+        dtype = np.dtype(record["dtype"])
+        offset = int(record["offset"])
+        crop = self.maps[record["file"]][offset:offset + int(np.prod(shape)) * dtype.itemsize].view(dtype)
+
+        return crop.reshape(shape)
@@ -0,0 +1,109 @@
+#Cache of DeepForest crown detections for whole RGB tiles, shared by training (generate.points_to_crowns) and prediction (predict.predict_crowns).
+#Boxes are stored as GeoParquet, one file per tile in a directory per model release, so a new release never reads boxes of the old one.
+import os
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+from src.atomic import atomic_write
+
+def boxes_to_utm(boxes, left, top, res):
+    """Convert boxes in image coordinates of a window to a geodataframe in the crs of the tile
+    Args:
+        boxes: deepforest prediction dataframe with xmin, ymin, xmax, ymax in pixels
+        left, top: utm origin of the window
+        res: pixelSizeX, pixelSizeY of the tile
+    """
+    pixelSizeX, pixelSizeY = res
+
+    #subtract origin. Recall that numpy origin is top left! Not bottom left.
+    boxes["xmin"] = (boxes["xmin"] *pixelSizeX) + left
+    boxes["xmax"] = (boxes["xmax"] * pixelSizeX) + left
+    boxes["ymin"] = top - (boxes["ymin"] * pixelSizeY)
+    boxes["ymax"] = top - (boxes["ymax"] * pixelSizeY)
+
+    # combine column to a shapely Box() object, save shapefile
+    boxes['geometry'] = boxes.apply(lambda x: shapely.geometry.box(x.xmin,x.ymin,x.xmax,x.ymax), axis=1)
+    boxes = gpd.GeoDataFrame(boxes, geometry='geometry')
+
+    #Give an id field
+    boxes["box_id"] = np.arange(boxes.shape[0])
+
+    return boxes
+
+def model_release(deepforest_model):
+    """Cache key of a deepforest model, its release tag and score threshold. None for a model that is not a release, which is never cached"""
+    release = getattr(deepforest_model, "__release_version__", None)
+    if release is None:
+        return None
+
+    return "{}_score{}".format(release, deepforest_model.config["score_thresh"])
+
+def cache_path(cache_dir, rgb_path, release):
+    """GeoParquet file of the crowns of an rgb tile, NEON tile names are unique across sites and years"""
+    return "{}/{}/{}.parquet".format(cache_dir, release, os.path.splitext(os.path.basename(rgb_path))[0])
+
+def detect_tile(deepforest_model, rgb_path):
+    """Predict crowns for a whole rgb tile
+    Returns:
+        boxes: geodataframe with xmin, ymin, xmax, ymax, label, score and box_id in the crs of the tile
+    """
+    boxes = deepforest_model.predict_tile(rgb_path)
+    with rasterio.open(rgb_path) as src:
+        left, top = src.bounds.left, src.bounds.top
+        res = src.res
+        crs = src.crs
+
+    if boxes is None or boxes.empty:
+        boxes = gpd.GeoDataFrame(pd.DataFrame({"xmin": [], "ymin": [], "xmax": [], "ymax": [], "label": [], "score": [], "box_id": []}), geometry=[])
+    else:
+        boxes = boxes_to_utm(boxes, left, top, res)
+    boxes = boxes.set_crs(crs, allow_override=True)
+
+    return boxes
+
+def tile_crowns(rgb_path, deepforest_model, cache_dir=None):
+    """Crowns of a whole rgb tile, read from the cache, or detected and written to the cache
+    Args:
+        rgb_path: rgb tile
+        deepforest_model: deepforest model used for detection, its release is part of the cache key
+        cache_dir: directory of the crown cache, None always detects
+    Returns:
+        boxes: geodataframe, see detect_tile
+    """
+    release = model_release(deepforest_model)
+    if cache_dir is None or release is None:
+        return detect_tile(deepforest_model, rgb_path)
+
+    path = cache_path(cache_dir, rgb_path, release)
+    if os.path.exists(path):
+        return gpd.read_parquet(path)
+
+    boxes = detect_tile(deepforest_model, rgb_path)
+
+    #Write to a temporary name and rename so a partial file is never read, workers that detect the same tile write the same boxes
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with atomic_write(path, suffix=".parquet") as tmp_path:
+        boxes.to_parquet(tmp_path)
+
+    return boxes
+
+def window_crowns(tile_boxes, bounds):
+    """Crowns that intersect a window, the cached counterpart of generate.predict_trees
+    Args:
+        tile_boxes: list of tile_crowns geodataframes of the tiles under the window
+        bounds: left, bottom, right, top of the window
+    Returns:
+        boxes: geodataframe with a box_id for the window, None if there are no crowns
+    """
+    left, bottom, right, top = bounds
+    boxes = [x.cx[left:right, bottom:top] for x in tile_boxes]
+    boxes = [x for x in boxes if not x.empty]
+    if len(boxes) == 0:
+        return None
+
+    boxes = gpd.GeoDataFrame(pd.concat(boxes, ignore_index=True), crs=boxes[0].crs)
+    boxes["box_id"] = np.arange(boxes.shape[0])
+
+    return boxes
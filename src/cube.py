@@ -0,0 +1,155 @@
+#Chunked spectral cube store. A converted tile is a directory of small (y, x, all bands) chunks, each compressed on its own,
+#so reading a crown window decodes only the handful of chunks under it.
+import json
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import rasterio
+from rasterio.transform import Affine
+from src import Hyperspectral
+from src.atomic import atomic_write
+
+def chunk_path(path, row, col):
+    return "{}/chunks/{}_{}".format(path, row, col)
+
+def write_cube(src, path, chunk_size=32, level=1):
+    """Write an open raster, or a Hyperspectral.H5Reader, to a chunked cube directory
+    Args:
+        src: dataset with read(window=...), transform, crs, count, height, width and nodata
+        path: output directory, usually ending in .cube
+        chunk_size: chunk height and width in pixels, every chunk holds all bands
+        level: zlib compression level
+    Returns:
+        path: cube directory
+    """
+    #Write to a temporary name and rename so a partial cube is never read
+    with atomic_write(path, suffix=".cube", directory=True) as tmp_path:
+        os.makedirs("{}/chunks".format(tmp_path))
+        dtype = None
+        #Read one row of chunks at a time
+        for row_off in range(0, src.height, chunk_size):
+            nrows = min(chunk_size, src.height - row_off)
+            strip = src.read(window=rasterio.windows.Window(0, row_off, src.width, nrows))
+            strip = np.moveaxis(strip, 0, 2)
+            dtype = strip.dtype
+            for col_off in range(0, src.width, chunk_size):
+                chunk = np.ascontiguousarray(strip[:, col_off:col_off + chunk_size, :])
+                with open(chunk_path(tmp_path, row_off // chunk_size, col_off // chunk_size), "wb") as f:
+                    f.write(zlib.compress(chunk.tobytes(), level))
+
+        metadata = {
+            "height": src.height,
+            "width": src.width,
+            "count": src.count,
+            "dtype": str(dtype),
+            "chunk_size": chunk_size,
+            "transform": list(src.transform)[:6],
+            "crs": src.crs.to_wkt() if src.crs else None,
+            "nodata": src.nodata
+        }
+        with open("{}/cube.json".format(tmp_path), "w") as f:
+            json.dump(metadata, f)
+
+    return path
+
+def h5_to_cube(h5_path, save_dir, rgb_filename, bands="no_water", chunk_size=32):
+    """Convert a NEON .h5 tile to a cube named after its rgb tile, the counterpart of Hyperspectral.generate_raster"""
+    cubename = os.path.splitext(os.path.basename(rgb_filename))[0] + "_hyperspectral{}.cube".format(Hyperspectral.bands_tag(bands))
+    with Hyperspectral.H5Reader(h5_path, bands=bands) as src:
+        write_cube(src, "{}/{}".format(save_dir, cubename), chunk_size=chunk_size)
+
+    return cubename
+
+class CubeReader():
+    """Windowed reads from a chunked cube with the same interface as a rasterio dataset
+    Args:
+        path: cube directory
+        threads: number of threads decoding chunks in parallel
+    """
+    def __init__(self, path, threads=4):
+        self.name = path
+        with open("{}/cube.json".format(path)) as f:
+            self.metadata = json.load(f)
+        self.height = self.metadata["height"]
+        self.width = self.metadata["width"]
+        self.count = self.metadata["count"]
+        self.dtype = np.dtype(self.metadata["dtype"])
+        self.dtypes = tuple([self.metadata["dtype"]] * self.count)
+        self.chunk_size = self.metadata["chunk_size"]
+        self.nodata = self.metadata["nodata"]
+        self.transform = Affine(*self.metadata["transform"])
+        self.res = (self.transform.a, -self.transform.e)
+        self.crs = rasterio.crs.CRS.from_wkt(self.metadata["crs"]) if self.metadata["crs"] else None
+        self.bounds = rasterio.coords.BoundingBox(*rasterio.transform.array_bounds(self.height, self.width, self.transform))
+        self.threads = threads
+        self.executor = None
+        self.closed = False
+
+    @property
+    def shape(self):
+        return (self.height, self.width)
+
+    def window_transform(self, window):
+        return rasterio.windows.transform(window, self.transform)
+
+    def decoder(self):
+        """Thread pool for chunk decoding, created in the process that reads so forked DataLoader workers get their own"""
+        if self.executor is None or self.executor_pid != os.getpid():
+            self.executor = ThreadPoolExecutor(max_workers=self.threads)
+            self.executor_pid = os.getpid()
+
+        return self.executor
+
+    def read_chunk(self, row, col):
+        """Decode a single chunk to a rows x cols x bands array"""
+        rows = min(self.chunk_size, self.height - row * self.chunk_size)
+        cols = min(self.chunk_size, self.width - col * self.chunk_size)
+        with open(chunk_path(self.name, row, col), "rb") as f:
+            chunk = np.frombuffer(zlib.decompress(f.read()), dtype=self.dtype)
+
+        return chunk.reshape(rows, cols, self.count)
+
+    def read(self, indexes=None, window=None):
+        """Read a window as a bands x rows x cols array
+        Args:
+            indexes: optional 1-based band index or list of band indices
+            window: rasterio.windows.Window, the full cube if None
+        """
+        if window is None:
+            window = rasterio.windows.Window(0, 0, self.width, self.height)
+        rows, cols = Hyperspectral.window_indices(window, self.height, self.width)
+        if rows.size == 0 or cols.size == 0:
+            img = np.zeros((self.count, rows.size, cols.size), dtype=self.dtype)
+        else:
+            #Decode every chunk under the window in parallel and stitch them
+            row_start = rows[0] - rows[0] % self.chunk_size
+            col_start = cols[0] - cols[0] % self.chunk_size
+            chunk_rows = range(rows[0] // self.chunk_size, rows[-1] // self.chunk_size + 1)
+            chunk_cols = range(cols[0] // self.chunk_size, cols[-1] // self.chunk_size + 1)
+            keys = [(row, col) for row in chunk_rows for col in chunk_cols]
+            chunks = self.decoder().map(lambda x: self.read_chunk(*x), keys)
+            block = np.zeros((len(chunk_rows) * self.chunk_size, len(chunk_cols) * self.chunk_size, self.count), dtype=self.dtype)
+            for (row, col), chunk in zip(keys, chunks):
+                row_off = row * self.chunk_size - row_start
+                col_off = col * self.chunk_size - col_start
+                block[row_off:row_off + chunk.shape[0], col_off:col_off + chunk.shape[1]] = chunk
+            img = np.moveaxis(block[rows - row_start][:, cols - col_start], 2, 0)
+
+        if indexes is not None:
+            img = img[np.atleast_1d(indexes) - 1]
+            if np.isscalar(indexes):
+                return img[0]
+
+        return img
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -8,7 +8,11 @@ import os
 import pandas as pd
 from pytorch_lightning import LightningDataModule
 from src import generate
+from src import Hyperspectral
 from src import CHM
+from src import crop_store
+from src import partitions
+from src import shards
 from src import augmentation
 from src import megaplot
 from src.models import dead
@@ -193,6 +197,7 @@ class TreeDataset(Dataset):
     """A csv file with a path to image crop and label
     Args:
        csv_file: path to csv file with image_path and label
+       config: crops are read from the crop store config["crop_store"] if set, see crop_store.py
     """
     def __init__(self, csv_file, image_size=10, config=None, train=True, HSI=True, metadata=False):
         self.annotations = pd.read_csv(csv_file)
@@ -209,11 +214,16 @@ class TreeDataset(Dataset):
         #Create augmentor
         self.transformer = augmentation.train_augmentation(image_size=image_size)
         
+        if self.config and self.config.get("crop_store"):
+            self.crop_reader = crop_store.CropReader(self.config["crop_store"])
+        else:
+            self.crop_reader = None
+        
         #Pin data to memory if desired
         if self.config["preload_images"]:
             self.image_dict = {}
             for index, row in self.annotations.iterrows():
-                self.image_dict[index] = load_image(row["image_path"], image_size=image_size)
+                self.image_dict[index] = load_image(row["image_path"], image_size=image_size, crop_reader=self.crop_reader)
         
     def __len__(self):
         #0th based index
@@ -228,7 +238,7 @@ class TreeDataset(Dataset):
                 inputs["HSI"] = self.image_dict[index]
             else:
                 image_path = self.annotations.image_path.loc[index]            
-                image = load_image(image_path, image_size=self.image_size)
+                image = load_image(image_path, image_size=self.image_size, crop_reader=self.crop_reader)
                 inputs["HSI"] = image
             
         if self.metadata:
@@ -256,6 +266,11 @@ def filter_dead_annotations(crowns, config):
     label, score = dead.predict_dead_dataloader(dead_model=dead_model, dataset=ds, config=config)
     
     return label, score
+
+#Config values the crowns and crops depend on, checkpoints written with other values are not reused
+CHECKPOINT_SETTINGS = ["min_stem_diameter", "min_CHM_height", "max_CHM_diff", "CHM_height_limit", "convert_h5", "crop_store", "bin_size"]
+#Config values the training shards are preprocessed with, shards written with others are rewritten
+SHARD_SETTINGS = ["image_size", "bands", "bin_size"]
     
 class TreeData(LightningDataModule):
     """
@@ -292,7 +307,20 @@ class TreeData(LightningDataModule):
             self.config = read_config("{}/config.yml".format(self.ROOT))   
         else:
             self.config = config
+        
+        #The band count of the model follows the bin size of the converted tiles
+        if self.config.get("bands") is None:
+            self.config["bands"] = Hyperspectral.band_count(bin_size=self.config.get("bin_size", 1))
                 
+    def checkpoint(self, name):
+        """Checkpoint directory of a generation step, see partitions.reset. Cleared if replace is set or it was written with other CHECKPOINT_SETTINGS"""
+        if not self.config.get("checkpoint_dir"):
+            return None
+        directory = "{}/{}".format(self.config["checkpoint_dir"], name)
+        partitions.reset(directory, settings={x: self.config.get(x) for x in CHECKPOINT_SETTINGS}, replace=self.config["replace"])
+        
+        return directory
+    
     def setup(self,stage=None):
         #Clean data from raw csv, regenerate from scratch or check for progress and complete
         if self.config["regenerate"]:
@@ -311,7 +339,7 @@ class TreeData(LightningDataModule):
                     
                 #load any megaplot data
                 if not self.config["megaplot_dir"] is None:
-                    megaplot_data = megaplot.load(directory=self.config["megaplot_dir"], config=self.config)
+                    megaplot_data = megaplot.load(directory=self.config["megaplot_dir"], config=self.config, client=self.client)
                     megaplot_data = megaplot_data[megaplot_data.siteID=="OSBS"]
                     df = pd.concat([megaplot_data, df])
                 
@@ -329,7 +357,10 @@ class TreeData(LightningDataModule):
                 df = CHM.filter_CHM(df, CHM_pool=self.config["CHM_pool"],
                                     min_CHM_height=self.config["min_CHM_height"], 
                                     max_CHM_diff=self.config["max_CHM_diff"], 
-                                    CHM_height_limit=self.config["CHM_height_limit"])  
+                                    CHM_height_limit=self.config["CHM_height_limit"],
+                                    file_catalog=self.config["file_catalog"],
+                                    client=self.client,
+                                    cache_path=self.config["CHM_cache"])  
                 
                 df.to_file("{}/processed/canopy_points.shp".format(self.data_dir))
                 
@@ -343,7 +374,10 @@ class TreeData(LightningDataModule):
                     rgb_dir=self.config["rgb_sensor_pool"],
                     savedir="{}/interim/".format(self.data_dir),
                     raw_box_savedir="{}/interim/".format(self.data_dir), 
-                    client=self.client
+                    client=self.client,
+                    file_catalog=self.config["file_catalog"],
+                    crown_cache_dir=self.config["crown_cache_dir"],
+                    checkpoint_dir=self.checkpoint("crowns")
                 )
                 
                 if self.comet_logger:
@@ -362,7 +396,12 @@ class TreeData(LightningDataModule):
                 rgb_glob=self.config["rgb_sensor_pool"],
                 HSI_tif_dir=self.config["HSI_tif_dir"],
                 client=self.client,
-                replace=self.config["replace"]
+                replace=self.config["replace"],
+                file_catalog=self.config["file_catalog"],
+                checkpoint_dir=self.checkpoint("crops"),
+                crop_store=self.config.get("crop_store"),
+                tile_catalog=self.config.get("tile_catalog"),
+                bin_size=self.config.get("bin_size", 1)
             )
             annotations.to_csv("{}/processed/annotations.csv".format(self.data_dir))
             
@@ -443,6 +482,9 @@ class TreeData(LightningDataModule):
             #Create dataloaders
             self.train_ds = TreeDataset(csv_file = self.train_file, config=self.config, HSI=self.HSI, metadata=self.metadata)
             self.val_ds = TreeDataset(csv_file = "{}/processed/test.csv".format(self.data_dir), config=self.config, HSI=self.HSI, metadata=self.metadata)
+            
+            if self.config.get("shard_dir"):
+                self.write_shards()
              
         else:
             print("Loading previous run")
@@ -474,9 +516,32 @@ class TreeData(LightningDataModule):
             #Create dataloaders
             self.train_ds = TreeDataset(csv_file = self.train_file, config=self.config, HSI=self.HSI, metadata=self.metadata)
             self.val_ds = TreeDataset(csv_file = "{}/processed/test.csv".format(self.data_dir), config=self.config, HSI=self.HSI, metadata=self.metadata)            
+            
+            #Rewrite the shards if the crops changed since they were written
+            if self.config.get("shard_dir") and not shards.is_current("{}/train".format(self.config["shard_dir"]), self.train_file, self.config.get("crop_store"), settings=self.shard_settings()):
+                self.write_shards()
 
+    def write_shards(self):
+        """Write the training crops to config["shard_dir"]/train, see shards.py"""
+        shards.write_shards(self.train_file, "{}/train".format(self.config["shard_dir"]), image_size=self.config["image_size"], crop_store_dir=self.config.get("crop_store"), settings=self.shard_settings())
+    
+    def shard_settings(self):
+        return {x: self.config.get(x) for x in SHARD_SETTINGS}
+    
     def train_dataloader(self):
         """Load a training file. The default location is saved during self.setup(), to override this location, set self.train_file before training"""               
+        if self.config.get("shard_dir"):
+            #Stream shards, classes are balanced by the draws of the dataset instead of a sampler
+            shard_dir = "{}/train".format(self.config["shard_dir"])
+            label_rates = shards.balanced_rates(shards.read_index(shard_dir).label)
+            ds = shards.ShardDataset(shard_dir, image_size=self.config["image_size"], metadata=self.metadata, label_rates=label_rates)
+            data_loader = torch.utils.data.DataLoader(
+                ds,
+                batch_size=self.config["batch_size"],
+                num_workers=self.config["workers"])
+            
+            return data_loader
+        
         #get class weights
         train = pd.read_csv(self.train_file)
         class_weights = train.label.value_counts().to_dict()     
@@ -1,28 +1,26 @@
 #Convert NEON field sample points into bounding boxes of cropped image data for model training
-import glob
 import geopandas as gpd
 import rasterio
 import numpy as np
-import shapely
 import os
 import pandas as pd
-from src.neon_paths import find_sensor_path, lookup_and_convert, bounds_to_geoindex
+from src.neon_paths import find_sensor_path, lookup_and_convert, bounds_to_geoindex, TileIndex, year_from_path
+from src.crop_store import consolidate, crop_path, read_index, write_shard
+from src import catalog
+from src import crowns
+from src import mosaic
+from src import partitions
 from src import patches
-from distributed import wait   
-from deepforest import main    
+from distributed import as_completed
+from deepforest import main, predict, visualize
+import torch
+import threading
 import traceback
 import warnings
 warnings.filterwarnings('ignore')
 
-def predict_trees(deepforest_model, rgb_path, bounds, expand=40):
-    """Predict an rgb path at specific utm bounds
-    Args:
-        deepforest_model: a deepforest model object used for prediction
-        rgb_path: full path to image
-        bounds: utm extent given by geopandas.total_bounds
-        expand: numeric meters to add to edges to reduce edge effects
-        """
-    #DeepForest is trained on 400m crops, easiest to mantain this approximate size centered on points
+def window_bounds(bounds, expand=40):
+    """Square window of expand meters centered on bounds, see predict_trees"""
     left, bottom, right, top = bounds
     expand_width = (expand - (right - left))/2
     left = left - expand_width
@@ -32,10 +30,28 @@ def predict_trees(deepforest_model, rgb_path, bounds, expand=40):
     bottom = bottom - expand_height
     top = top + expand_height 
     
-    src = rasterio.open(rgb_path)
-    pixelSizeX, pixelSizeY  = src.res    
-    img = src.read(window=rasterio.windows.from_bounds(left, bottom, right, top, transform=src.transform))
-    src.close()
+    return left, bottom, right, top
+
+def predict_trees(deepforest_model, rgb_path, bounds, expand=40, mosaic_reader=None):
+    """Predict an rgb path at specific utm bounds
+    Args:
+        deepforest_model: a deepforest model object used for prediction
+        rgb_path: full path to image
+        bounds: utm extent given by geopandas.total_bounds
+        expand: numeric meters to add to edges to reduce edge effects
+        mosaic_reader: optional mosaic.MosaicReader of the rgb pool, windows that cross a tile edge are read from all tiles instead of rgb_path
+        """
+    #DeepForest is trained on 400m crops, easiest to mantain this approximate size centered on points
+    left, bottom, right, top = window_bounds(bounds, expand)
+    
+    if mosaic_reader is None:
+        src = rasterio.open(rgb_path)
+        res = src.res    
+        img = src.read(window=rasterio.windows.from_bounds(left, bottom, right, top, transform=src.transform))
+        src.close()
+    else:
+        img = mosaic_reader.read_bounds((left, bottom, right, top))
+        res = mosaic_reader.res
     
     #roll to channels last
     img = np.rollaxis(img, 0,3)
@@ -43,32 +59,86 @@ def predict_trees(deepforest_model, rgb_path, bounds, expand=40):
     
     if boxes is None:
         return boxes
+    
+    return crowns.boxes_to_utm(boxes, left, top, res)
 
-    #subtract origin. Recall that numpy origin is top left! Not bottom left.
-    boxes["xmin"] = (boxes["xmin"] *pixelSizeX) + left
-    boxes["xmax"] = (boxes["xmax"] * pixelSizeX) + left
-    boxes["ymin"] = top - (boxes["ymin"] * pixelSizeY) 
-    boxes["ymax"] = top - (boxes["ymax"] * pixelSizeY)
+def predict_batch(deepforest_model, images):
+    """Predict a list of bands x rows x cols rgb arrays, images of the same shape share a forward pass.
+    Follows deepforest_model.predict_image, see deepforest.predict.predict_image of the pinned deepforest release, and gives the same boxes for each image.
+    The model transform pads the images of a pass to a common size, which changes the boxes near the padded edges, so only images of one shape are batched together.
+    Returns:
+        predictions: list of boxes dataframes in image coordinates, None for images without trees
+    """
+    deepforest_model.model.eval()
+    deepforest_model.model.score_thresh = deepforest_model.config["score_thresh"]
+    shapes = {}
+    for index, image in enumerate(images):
+        #Windows that fall off the tile have no pixels to predict
+        if image.shape[1] > 0 and image.shape[2] > 0:
+            shapes.setdefault(image.shape, []).append(index)
+    
+    predictions = [None] * len(images)
+    for indices in shapes.values():
+        tensors = [torch.tensor(images[x][:3].astype("float32") / 255, device=deepforest_model.device) for x in indices]
+        with torch.no_grad():
+            for index, prediction in zip(indices, deepforest_model.model(tensors)):
+                predictions[index] = prediction
+    
+    results = []
+    for prediction in predictions:
+        if prediction is None or len(prediction["boxes"]) == 0:
+            results.append(None)
+            continue
+        boxes = visualize.format_boxes(prediction)
+        boxes = predict.across_class_nms(boxes, iou_threshold=deepforest_model.config["nms_thresh"])
+        boxes["label"] = boxes.label.apply(lambda x: deepforest_model.numeric_to_label_dict[x])
+        results.append(boxes)
+    
+    return results
 
-    # combine column to a shapely Box() object, save shapefile
-    boxes['geometry'] = boxes.apply(lambda x: shapely.geometry.box(x.xmin,x.ymin,x.xmax,x.ymax), axis=1)
-    boxes = gpd.GeoDataFrame(boxes, geometry='geometry')    
+def predict_trees_batch(deepforest_model, windows, expand=40, batch_size=8, mosaic_reader=None):
+    """Predict the windows of many plots, batch_size windows per forward pass, see predict_trees
+    Args:
+        deepforest_model: a deepforest model object used for prediction
+        windows: list of (rgb_path, bounds), bounds given by geopandas.total_bounds
+        expand: numeric meters to add to edges to reduce edge effects
+        batch_size: number of windows read and predicted together, windows of the same shape share a forward pass, see predict_batch
+        mosaic_reader: optional mosaic.MosaicReader of the rgb pool, windows that cross a tile edge are read from all tiles
+    Returns:
+        results: list of boxes geodataframes in the order of windows, None for windows without trees
+    """
+    #Read windows tile by tile so each tile is opened once
+    order = sorted(range(len(windows)), key=lambda x: windows[x][0])
+    results = [None] * len(windows)
+    src = None
+    for batch_start in range(0, len(order), batch_size):
+        batch = order[batch_start:batch_start + batch_size]
+        images = []
+        origins = []
+        for index in batch:
+            rgb_path, bounds = windows[index]
+            left, bottom, right, top = window_bounds(bounds, expand)
+            if mosaic_reader is None:
+                if src is None or not src.name == rgb_path:
+                    if src is not None:
+                        src.close()
+                    src = rasterio.open(rgb_path)
+                img = src.read(window=rasterio.windows.from_bounds(left, bottom, right, top, transform=src.transform))
+                res = src.res
+            else:
+                img = mosaic_reader.read_bounds((left, bottom, right, top))
+                res = mosaic_reader.res
+            images.append(img)
+            origins.append((left, top, res))
         
-    #Give an id field
-    boxes["box_id"] = np.arange(boxes.shape[0])
+        for index, boxes, (left, top, res) in zip(batch, predict_batch(deepforest_model, images), origins):
+            if boxes is not None:
+                results[index] = crowns.boxes_to_utm(boxes, left, top, res)
     
-    return boxes
-
-def choose_box(group, plot_data):
-    """Given a set of overlapping bounding boxes and predictions, just choose the closest to stem box by centroid if there are multiples"""
-    if group.shape[0] == 1:
-        return  group
-    else:
-        #Find centroid
-        individual_id = group.individual.unique()[0]
-        stem_location = plot_data[plot_data["individual"]==individual_id].geometry.iloc[0]
-        closest_stem = group.centroid.distance(stem_location).sort_values().index[0]
-        return group.loc[[closest_stem]]
+    if src is not None:
+        src.close()
+    
+    return results
 
 def create_boxes(plot_data, size=1):
     """If there are no deepforest boxes, fall back on selecting a fixed area around stem point"""
@@ -89,21 +159,56 @@ def create_boxes(plot_data, size=1):
     
     return fixed_boxes
     
-def process_plot(plot_data, rgb_pool, deepforest_model=None):
+def associate_boxes(merged_boxes, stems):
+    """Keep one box per stem and one stem per box, for any number of plots at once
+    The box closest to the stem by centroid is chosen for each individual. Where several stems then share a box,
+    the tallest stem is kept, ties are broken by CHM height.
+    Args:
+        merged_boxes: geodataframe of box and stem pairs, e.g. gpd.sjoin(boxes, plot_data), with individual, plotID, box_id and height
+        stems: geodataframe of stem points with an individual column
+    Returns:
+        merged_boxes: geodataframe with a single row per individual and per plotID and box_id
+    """
+    merged_boxes = merged_boxes.reset_index(drop=True)
+    stem_location = stems.drop_duplicates("individual").set_index("individual").geometry
+    stem_location = gpd.GeoSeries(stem_location.reindex(merged_boxes.individual).values, index=merged_boxes.index, crs=merged_boxes.crs)
+    distance = merged_boxes.centroid.distance(stem_location)
+    
+    #If there are multiple boxes per point, take the center box
+    order = np.lexsort((distance.values, merged_boxes.individual.values))
+    merged_boxes = merged_boxes.iloc[order].drop_duplicates("individual")
+    
+    ##if there are multiple points per box, take the tallest point, then the tallest CHM height
+    tiebreak = [x for x in ["height", "CHM_height"] if x in merged_boxes.columns]
+    selected = merged_boxes.sort_values(tiebreak, ascending=False, na_position="last", kind="stable").drop_duplicates(["plotID", "box_id"])
+    if selected.shape[0] < merged_boxes.shape[0]:
+        print("removing {} points from {} within a shared deepforest box".format(merged_boxes.shape[0] - selected.shape[0], list(merged_boxes.plotID.unique())))
+    
+    return gpd.GeoDataFrame(selected.sort_index(), crs=merged_boxes.crs)
+
+def process_plot(plot_data, rgb_pool, deepforest_model=None, boxes=None):
     """For a given NEON plot, find the correct sensor data, predict trees and associate bounding boxes with field data
     Args:
         plot_data: geopandas dataframe in a utm projection
+        rgb_pool: list of rgb tile paths, or a neon_paths.TileIndex
         deepforest_model: deepforest model used for prediction
+        boxes: optional boxes already predicted for the plot window, see predict_trees_batch. deepforest_model is not used if given
     Returns:
         merged_boxes: geodataframe of bounding box predictions with species labels
     """
     #DeepForest prediction
+    if not isinstance(rgb_pool, TileIndex):
+        rgb_pool = TileIndex(rgb_pool)
+    
     try:
         rgb_sensor_path = find_sensor_path(bounds=plot_data.total_bounds, lookup_pool=rgb_pool)
     except Exception as e:
-        raise ValueError("cannot find RGB sensor for {}".format(plot_data.plotID.unique()))
+        raise ValueError("cannot find RGB sensor for {}".format(plot_data.plotID.unique())) from e
     
-    boxes = predict_trees(deepforest_model=deepforest_model, rgb_path=rgb_sensor_path, bounds=plot_data.total_bounds)
+    if boxes is None:
+        #Neighboring tiles are read from the flight year of the plot tile
+        with mosaic.MosaicReader(rgb_pool, year=year_from_path(rgb_sensor_path)) as mosaic_reader:
+            boxes = predict_trees(deepforest_model=deepforest_model, rgb_path=rgb_sensor_path, bounds=plot_data.total_bounds, mosaic_reader=mosaic_reader)
     
     if boxes is None:
         raise ValueError("No trees predicted in plot: {}, skipping.".format(plot_data.plotID.unique()[0]))
@@ -116,54 +221,41 @@ def process_plot(plot_data, rgb_pool, deepforest_model=None):
     
     if not missing_ids.empty:
         created_boxes= create_boxes(missing_ids)
-        merged_boxes = merged_boxes.append(created_boxes)
-    
-    #If there are multiple boxes per point, take the center box
-    grouped = merged_boxes.groupby("individual")
-    
-    cleaned_boxes = []
-    for value, group in grouped:
-        choosen_box = choose_box(group, plot_data)
-        cleaned_boxes.append(choosen_box)
+        merged_boxes = gpd.GeoDataFrame(pd.concat([merged_boxes, created_boxes]), crs=merged_boxes.crs)
     
-    merged_boxes = gpd.GeoDataFrame(pd.concat(cleaned_boxes),crs=merged_boxes.crs)
+    merged_boxes = associate_boxes(merged_boxes, plot_data)
     merged_boxes = merged_boxes.drop(columns=["xmin","xmax","ymin","ymax"])
     
-    ##if there are multiple points per box, take the tallest point.
-    cleaned_points = []
-    for value, group in merged_boxes.groupby("box_id"):
-        if group.shape[0] > 1:
-            print("removing {} points from {} within a deepforest box {}".format(group.shape[0]-1, group.plotID.unique(),group.box_id.unique()))
-            selected_point = group[group.height == group.height.max()]
-            if selected_point.shape[0] > 1:
-                try:
-                    selected_point = selected_point[selected_point.CHM_height == selected_point.CHM_height.max()]
-                except:
-                    selected_point.head(1)
-            cleaned_points.append(selected_point)
-        else:
-            cleaned_points.append(group)
-     
-    merged_boxes = gpd.GeoDataFrame(pd.concat(cleaned_points),crs=merged_boxes.crs)
-    
     #Add tile information
     boxes["RGB_tile"] = rgb_sensor_path
     merged_boxes["RGB_tile"] = rgb_sensor_path
 
     return merged_boxes, boxes 
 
-def run(plot, df, savedir, raw_box_savedir, rgb_pool=None, saved_model=None, deepforest_model=None):
+#DeepForest models loaded in this process. A dask worker loads the model for its first task and reuses it for the rest
+DEEPFOREST_MODELS = {}
+DEEPFOREST_LOCK = threading.Lock()
+
+def load_deepforest():
+    """Prebuilt DeepForest release model, loaded once per process and shared by the tasks that run in it"""
+    with DEEPFOREST_LOCK:
+        if not "release" in DEEPFOREST_MODELS:
+            deepforest_model = main.deepforest()
+            deepforest_model.use_release(check_release=False)
+            DEEPFOREST_MODELS["release"] = deepforest_model
+    
+    return DEEPFOREST_MODELS["release"]
+
+def run(plot, df, savedir, raw_box_savedir, rgb_pool=None, saved_model=None, deepforest_model=None, boxes=None):
     """wrapper function for dask, see main.py"""
     
-    if deepforest_model is None:
-        from deepforest import main
-        deepforest_model = main.deepforest()
-        deepforest_model.use_release(check_release=False)
+    if deepforest_model is None and boxes is None:
+        deepforest_model = load_deepforest()
 
     #Filter data and process
     plot_data = df[df.plotID == plot]
     try:
-        predicted_trees, raw_boxes = process_plot(plot_data, rgb_pool, deepforest_model)
+        predicted_trees, raw_boxes = process_plot(plot_data, rgb_pool, deepforest_model, boxes=boxes)
     except ValueError as e:
         print(e)
         return None
@@ -180,12 +272,82 @@ def run(plot, df, savedir, raw_box_savedir, rgb_pool=None, saved_model=None, dee
     
     return predicted_trees
 
+def run_tile(plots, df, savedir, raw_box_savedir, rgb_pool, deepforest_model=None, batch_size=8, crown_cache_dir=None):
+    """Predict the windows of plots on the same rgb tile in batches, then process each plot as in run
+    Args:
+        plots: list of plotIDs
+        batch_size: number of plot windows in a deepforest forward pass
+        crown_cache_dir: optional crown cache, plot windows are cut from the crowns of whole tiles, see crowns.tile_crowns
+    Returns:
+        results: list of predicted trees, one for each plot that succeeded
+    """
+    if deepforest_model is None:
+        deepforest_model = load_deepforest()
+    
+    #Index a list pool once for all plots of the tile
+    if not isinstance(rgb_pool, TileIndex):
+        rgb_pool = TileIndex(rgb_pool)
+    
+    plot_data = {plot: df[df.plotID == plot] for plot in plots}
+    windows = {}
+    for plot, data in plot_data.items():
+        try:
+            windows[plot] = (find_sensor_path(bounds=data.total_bounds, lookup_pool=rgb_pool), data.total_bounds)
+        except Exception as e:
+            print("cannot find RGB sensor for {}: {}".format(plot, e))
+    
+    #Neighboring tiles are read from the flight year of each plot tile, one mosaic reader per year
+    years = {}
+    for index, (rgb_path, bounds) in enumerate(windows.values()):
+        years.setdefault(year_from_path(rgb_path), []).append(index)
+    
+    predictions = [None] * len(windows)
+    tile_boxes = {}
+    window_list = list(windows.values())
+    for year, indices in years.items():
+        with mosaic.MosaicReader(rgb_pool, year=year) as mosaic_reader:
+            if crown_cache_dir is None:
+                boxes = predict_trees_batch(deepforest_model, [window_list[x] for x in indices], batch_size=batch_size, mosaic_reader=mosaic_reader)
+                for index, prediction in zip(indices, boxes):
+                    predictions[index] = prediction
+                continue
+            for index in indices:
+                window = window_bounds(window_list[index][1])
+                paths = mosaic_reader.tiles(window)
+                for path in paths:
+                    if path not in tile_boxes:
+                        tile_boxes[path] = crowns.tile_crowns(path, deepforest_model, cache_dir=crown_cache_dir)
+                predictions[index] = crowns.window_crowns([tile_boxes[x] for x in paths], window)
+    
+    results = []
+    for plot, boxes in zip(windows, predictions):
+        if boxes is None:
+            print("No trees predicted in plot: {}, skipping.".format(plot))
+            continue
+        result = run(plot=plot, df=df, savedir=savedir, raw_box_savedir=raw_box_savedir, rgb_pool=rgb_pool, boxes=boxes)
+        if result is not None:
+            results.append(result)
+    
+    return results
+
+def collect(results, key, result, checkpoint_dir=None):
+    """Keep the result of a finished task, written as partition key of checkpoint_dir, or appended to results if there is no checkpoint_dir"""
+    if checkpoint_dir is None:
+        if result is not None:
+            results.append(result)
+    else:
+        partitions.write_partition(checkpoint_dir, key, result)
+
 def points_to_crowns(
     field_data,
     rgb_dir, 
     savedir,
     raw_box_savedir,
-    client=None):
+    client=None,
+    file_catalog=None,
+    batch_size=8,
+    crown_cache_dir=None,
+    checkpoint_dir=None):
     """Prepare NEON field data int
     Args:
         field_data: shp file with location and class of each field collected point
@@ -193,68 +355,117 @@ def points_to_crowns(
         savedir: direcory to save predicted bounding boxes
         raw_box_savedir: directory save all bounding boxes in the image
         client: dask client object to use
+        file_catalog: optional sqlite catalog to list rgb_dir from instead of walking the filesystem, see catalog.find_files
+        batch_size: number of plot windows in a deepforest forward pass, plots are batched within each rgb tile
+        crown_cache_dir: optional crown cache directory shared with predict.predict_crowns, detection only runs for tiles without cached crowns
+        checkpoint_dir: optional directory the crowns of each rgb tile are written to as soon as the tile finishes, tiles already written are skipped on a restart
     Returns:
         None: .shp bounding boxes are written to savedir
     """ 
     df = gpd.read_file(field_data)
     plot_names = df.plotID.unique()
     
-    rgb_pool = glob.glob(rgb_dir, recursive=True)
+    rgb_pool = TileIndex(catalog.find_files(rgb_dir, file_catalog))
+    
+    #Group plots by the rgb tile they are looked up in, one batched task per tile
+    plot_bounds = np.stack([df[df.plotID == plot].total_bounds for plot in plot_names])
+    plot_tiles = pd.Series(bounds_to_geoindex(plot_bounds), index=plot_names)
+    tile_plots = {geo_index: list(group.index) for geo_index, group in plot_tiles.groupby(plot_tiles)}
+    done = partitions.completed(checkpoint_dir)
+    remaining = {key: value for key, value in tile_plots.items() if not key in done}
+    if len(remaining) < len(tile_plots):
+        print("{} of {} tiles already in {}".format(len(tile_plots) - len(remaining), len(tile_plots), checkpoint_dir))
+    
     results = []    
     if client:
-        futures = []
-        for plot in plot_names:
+        #The tile index is sent to every worker once, tasks only carry a reference to it
+        rgb_pool_future = client.scatter(rgb_pool, broadcast=True)
+        futures = {}
+        for geo_index, plots in remaining.items():
+            #Ship each task the rows of its own plots, not the whole field data
             future = client.submit(
-                run,
-                plot=plot,
-                df=df,
-                rgb_pool=rgb_pool,
+                run_tile,
+                plots=plots,
+                df=df[df.plotID.isin(plots)],
+                rgb_pool=rgb_pool_future,
                 savedir=savedir,
-                raw_box_savedir=raw_box_savedir
+                raw_box_savedir=raw_box_savedir,
+                batch_size=batch_size,
+                crown_cache_dir=crown_cache_dir
             )
-            futures.append(future)
-            
-        wait(futures)
+            futures[future] = geo_index
         
-        for x in futures:
+        #Collect tiles as they finish, a tile is released once it is written
+        for future in as_completed(futures):
+            geo_index = futures.pop(future)
             try:
-                result = x.result()
-                results.append(result)
-            except:
+                result = future.result()
+            except Exception as e:
+                print("{} failed with {}".format(tile_plots[geo_index], e))
                 continue
+            collect(results, geo_index, pd.concat(result) if result else None, checkpoint_dir)
     else:
-        #IMPORTS at runtime due to dask pickling, kinda ugly.
-        deepforest_model = main.deepforest()  
-        deepforest_model.use_release(check_release=False)
-        for plot in plot_names:
+        deepforest_model = load_deepforest()
+        for geo_index, plots in remaining.items():
             try:
-                result = run(plot=plot, df=df, savedir=savedir, raw_box_savedir=raw_box_savedir, rgb_pool=rgb_pool, deepforest_model=deepforest_model)
-                results.append(result)
+                result = run_tile(plots=plots, df=df, savedir=savedir, raw_box_savedir=raw_box_savedir, rgb_pool=rgb_pool, deepforest_model=deepforest_model, batch_size=batch_size, crown_cache_dir=crown_cache_dir)
             except Exception as e:
-                print("{} failed with {}".format(plot, e))
+                print("{} failed with {}".format(plots, e))
+                continue
+            collect(results, geo_index, pd.concat(result) if result else None, checkpoint_dir)
+    
+    if checkpoint_dir is not None:
+        results = [partitions.read_partitions(checkpoint_dir)]
     results = pd.concat(results)
     
     #In case any contrib data has the same CHM and height and sitting in the same deepforest box.Should be rare.
-    results = results.groupby(["plotID","box_id"]).apply(lambda x: x.head(1)).reset_index(drop=True)
+    results = results.drop_duplicates(["plotID","box_id"]).reset_index(drop=True)
     
     return results
 
-def write_crop(row, img_path, savedir, replace=True):
-    """Wrapper to write a crop based on size and savedir"""
-    if replace == False:
-        filename = "{}/{}.tif".format(savedir, row["individual"])
-        file_exists = os.path.exists(filename)
-        if file_exists:
-            annotation = pd.DataFrame({"image_path":[filename], "taxonID":[row["taxonID"]], "plotID":[row["plotID"]], "individualID":[row["individual"]], "siteID":[row["siteID"]]})            
-            return annotation            
-        else:
-            filename = patches.crop(bounds=row["geometry"].bounds, sensor_path=img_path, savedir=savedir, basename=row["individual"])  
+def write_tile_crops(rows, img_path, savedir, replace=True, crop_store=None, key=None):
+    """Write the crops of every crown on one sensor tile, the tile is opened once and neighboring crowns are read together, see patches.crop_tile
+    Args:
+        rows: geodataframe of crowns on the tile
+        img_path: sensor tile
+        savedir: location to save crops
+        replace: if False, crowns with an existing crop are not cropped again
+        crop_store: optional crop store directory, crops are appended to the store as shard key instead of written to savedir
+        key: shard name in crop_store, usually the geo_index of the tile
+    Returns:
+        annotations: dataframe of crop filenames, None if no crop was written
+    """
+    if crop_store is None:
+        filenames = pd.Series(["{}/{}.tif".format(savedir, x) for x in rows["individual"]], index=rows.index)
+        exists = [os.path.exists(x) for x in filenames]
     else:
-        filename = patches.crop(bounds=row["geometry"].bounds, sensor_path=img_path, savedir=savedir, basename=row["individual"])
-        annotation = pd.DataFrame({"image_path":[filename], "taxonID":[row["taxonID"]], "plotID":[row["plotID"]], "individualID":[row["individual"]], "RGB_tile":[row["RGB_tile"]], "siteID":[row["siteID"]],"box_id":[row["box_id"]]})
-        return annotation
+        filenames = pd.Series([crop_path(crop_store, x) for x in rows["individual"]], index=rows.index)
+        exists = rows["individual"].astype(str).isin(read_index(crop_store).individual).values
+    if replace:
+        to_crop = rows
+    else:
+        to_crop = rows[np.logical_not(exists)]
+    
+    if not to_crop.empty:
+        if crop_store is None:
+            written = patches.crop_tile(bounds=to_crop.bounds.values, sensor_path=img_path, savedir=savedir, basenames=to_crop["individual"])
+        else:
+            with patches.open_sensor(img_path) as src:
+                crops = patches.crop_many(to_crop.bounds.values, src)
+            #Crowns outside the tile have nothing to store
+            written = [filename if crop.shape[1] > 0 and crop.shape[2] > 0 else None for filename, crop in zip(filenames.loc[to_crop.index], crops)]
+            stored = np.array([x is not None for x in written])
+            write_shard(crop_store, key, [x for x, keep in zip(crops, stored) if keep], to_crop["individual"].values[stored], img_path, to_crop.bounds.values[stored])
+        filenames.loc[to_crop.index] = written
+    rows = rows[filenames.notnull().values]
+    if rows.empty:
+        return None
+    
+    annotations = pd.DataFrame({"image_path":filenames.dropna().values, "taxonID":rows["taxonID"].values, "plotID":rows["plotID"].values, "individualID":rows["individual"].values, "RGB_tile":rows["RGB_tile"].values, "siteID":rows["siteID"].values,"box_id":rows["box_id"].values})
+    
+    return annotations
 
-def generate_crops(gdf, sensor_glob, savedir, rgb_glob, client=None, convert_h5=False, HSI_tif_dir=None, replace=True):
+def generate_crops(gdf, sensor_glob, savedir, rgb_glob, client=None, convert_h5=False, HSI_tif_dir=None, replace=True, file_catalog=None, checkpoint_dir=None, crop_store=None, tile_catalog=None, bin_size=1):
     """
     Given a shapefile of crowns in a plot, create pixel crops and a dataframe of unique names and labels"
     Args:
@@ -262,25 +473,37 @@ def generate_crops(gdf, sensor_glob, savedir, rgb_glob, client=None, convert_h5=
         savedir: path to save image crops
         img_pool: glob to search remote sensing files. This can be either RGB of .tif hyperspectral data, as long as it can be read by rasterio
         client: optional dask client
-        convert_h5: If HSI data is passed, make sure .tif conversion is complete
+        convert_h5: If HSI data is passed, make sure .tif conversion is complete. If False, .h5 tiles in sensor_glob are cropped directly
         rgb_glob: glob to search images to match when converting h5s -> tif.
         HSI_tif_dir: if converting H5 -> tif, where to save .tif files. Only needed if convert_h5 is True
+        file_catalog: optional sqlite catalog to list sensor_glob and rgb_glob from instead of walking the filesystem, see catalog.find_files
+        checkpoint_dir: optional directory the annotations of each sensor tile are written to as soon as its crops finish, tiles already written are skipped on a restart
+        crop_store: optional directory of a crop store, crops are appended to the store instead of written to savedir as .tif, see crop_store.py
+        tile_catalog: optional tile metadata catalog, .h5 headers are read from it when converting, see catalog.build_catalog
+        bin_size: number of adjacent bands averaged into each band when converting, see Hyperspectral.band_bins
     Returns:
        annotations: pandas dataframe of filenames and individual IDs to link with data
     """
     annotations = []
     
-    img_pool = glob.glob(sensor_glob, recursive=True)
-    rgb_pool = glob.glob(rgb_glob, recursive=True)
+    img_pool = catalog.find_files(sensor_glob, file_catalog)
+    rgb_pool = catalog.find_files(rgb_glob, file_catalog)
     
     #There were erroneous point cloud .tif
     img_pool = [x for x in img_pool if not "point_cloud" in x]
     rgb_pool = [x for x in rgb_pool if not "point_cloud" in x]
      
     
+    img_pool = TileIndex(img_pool)
+    rgb_pool = TileIndex(rgb_pool)
+    
     #Looking up the rgb -> HSI tile naming is expensive and repetitive. Create a dictionary first.
-    gdf["geo_index"] = gdf.geometry.apply(lambda x: bounds_to_geoindex(x.bounds))
+    gdf["geo_index"] = bounds_to_geoindex(gdf.bounds.values)
     tiles = gdf["geo_index"].unique()
+    done = partitions.completed(checkpoint_dir)
+    if len(done) > 0:
+        print("{} of {} tiles already in {}".format(len(set(tiles) & done), len(tiles), checkpoint_dir))
+    tiles = [x for x in tiles if not x in done]
     
     tile_to_path = {}
     for geo_index in tiles:
@@ -290,7 +513,7 @@ def generate_crops(gdf, sensor_glob, savedir, rgb_glob, client=None, convert_h5=
                 if rgb_glob is None:
                     raise ValueError("rgb_glob is None, but convert_h5 is True, please supply glob to search for rgb images")
                 else:
-                    img_path = lookup_and_convert(rgb_pool=rgb_pool, hyperspectral_pool=img_pool, savedir=HSI_tif_dir,  geo_index = geo_index)
+                    img_path = lookup_and_convert(rgb_pool=rgb_pool, hyperspectral_pool=img_pool, savedir=HSI_tif_dir,  geo_index = geo_index, tile_catalog=tile_catalog, bin_size=bin_size)
             else:
                 img_path = find_sensor_path(lookup_pool = img_pool, geo_index = geo_index)  
         except:
@@ -298,37 +521,36 @@ def generate_crops(gdf, sensor_glob, savedir, rgb_glob, client=None, convert_h5=
             continue
         tile_to_path[geo_index] = img_path
             
+    #One task per tile
+    tile_gdf = {geo_index: rows for geo_index, rows in gdf[gdf.geo_index.isin(list(tile_to_path))].groupby("geo_index")}
     if client:
-        futures = []
-        for index, row in gdf.iterrows():
+        futures = {}
+        for geo_index, rows in tile_gdf.items():
+            future = client.submit(write_tile_crops, rows=rows, img_path=tile_to_path[geo_index], savedir=savedir, replace=replace, crop_store=crop_store, key=geo_index)
+            futures[future] = geo_index
+        
+        for future in as_completed(futures):
+            geo_index = futures.pop(future)
             try:
-                img_path = tile_to_path[row["geo_index"]]
-            except:
+                annotation = future.result()
+            except Exception as e:
+                print("{} failed with {}".format(geo_index, e))
                 continue
-            future = client.submit(write_crop,row=row,img_path=img_path, savedir=savedir, replace=replace)
-            futures.append(future)
-            
-        wait(futures)
-        for x in futures:
-            try:
-                annotation = x.result()
-                annotations.append(annotation)                
-            except:
-                print("Future failed with {}".format(traceback.print_exc()))
+            collect(annotations, geo_index, annotation, checkpoint_dir)
     else:
-        for index, row in gdf.iterrows():
-            try:
-                img_path = tile_to_path[row["geo_index"]]
-            except:
-                continue
+        for geo_index, rows in tile_gdf.items():
             try:
-                annotation = write_crop(row=row, img_path=img_path, savedir=savedir, replace=replace)
+                annotation = write_tile_crops(rows=rows, img_path=tile_to_path[geo_index], savedir=savedir, replace=replace, crop_store=crop_store, key=geo_index)
             except Exception as e:
-                print("index {} failed with {}".format(index,e))
+                print("{} failed with {}".format(geo_index, e))
                 continue
+            collect(annotations, geo_index, annotation, checkpoint_dir)
     
-            annotations.append(annotation)
+    if crop_store is not None:
+        consolidate(crop_store)
     
+    if checkpoint_dir is not None:
+        annotations = [partitions.read_partitions(checkpoint_dir)]
     annotations = pd.concat(annotations)
         
     return annotations
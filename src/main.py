@@ -1,7 +1,6 @@
 #Lightning Data Module
 from . import __file__
 import geopandas as gpd
-import glob as glob
 from deepforest.main import deepforest
 from descartes import PolygonPatch
 import numpy as np
@@ -18,8 +17,10 @@ import torchmetrics
 import tempfile
 import rasterio
 from rasterio.plot import show
+from src import catalog
 from src import data
 from src import generate
+from src import Hyperspectral
 from src import neon_paths
 from src import patches
 from src import spatial
@@ -56,6 +57,9 @@ class TreeModel(LightningModule):
         top_k_recall = torchmetrics.Accuracy(average="micro",top_k=self.config["top_k"])
         self.metrics = torchmetrics.MetricCollection({"Micro Accuracy":micro_recall,"Macro Accuracy":macro_recall,"Top {} Accuracy".format(self.config["top_k"]): top_k_recall})
         
+        #Sensor tile lookups, built on first use, see sensor_index
+        self.tile_indices = {}
+        
         self.save_hyperparameters()
         
     def training_step(self, batch, batch_idx):
@@ -116,6 +120,15 @@ class TreeModel(LightningModule):
         else:
             return self.index_to_label[index]
                 
+    def sensor_index(self, pool):
+        """TileIndex of a sensor pool glob, listed once from the file catalog and reused across predictions"""
+        if pool not in self.tile_indices:
+            #Older checkpoints were saved with configs that predate file_catalog
+            paths = catalog.find_files(pool, self.config.get("file_catalog"))
+            self.tile_indices[pool] = neon_paths.TileIndex(paths)
+        
+        return self.tile_indices[pool]
+    
     def predict_xy(self, coordinates, fixed_box=True):
         #TODO update for metadata model
         """Given an x,y location, find sensor data and predict tree crown class. If no predicted crown within 5m an error will be raised (fixed_box=False) or a 1m fixed box will created (fixed_box=True)
@@ -127,7 +140,7 @@ class TreeModel(LightningModule):
         """
         #Predict crown
         gdf = gpd.GeoDataFrame(geometry=[Point(coordinates[0],coordinates[1])])
-        img_pool = glob.glob(self.config["rgb_sensor_pool"], recursive=True)
+        img_pool = self.sensor_index(self.config["rgb_sensor_pool"])
         rgb_path = neon_paths.find_sensor_path(lookup_pool=img_pool, bounds=gdf.total_bounds)
         
         #DeepForest model to predict crowns
@@ -147,7 +160,7 @@ class TreeModel(LightningModule):
                 raise ValueError("No predicted tree centroid within 5 m of point {}, to ignore this error and specify fixed_box=True".format(coordinates))
             
         #Create pixel crops
-        img_pool = glob.glob(self.config["HSI_sensor_pool"], recursive=True)        
+        img_pool = self.sensor_index(self.config["HSI_sensor_pool"])
         sensor_path = neon_paths.find_sensor_path(lookup_pool=img_pool, bounds=gdf.total_bounds)        
         crop = patches.crop(
             bounds=boxes["geometry"].values[0].bounds,
@@ -271,7 +284,7 @@ class TreeModel(LightningModule):
             
         if experiment:
             #load image pool and crown predicrions
-            rgb_pool = glob.glob(self.config["rgb_sensor_pool"], recursive=True)
+            rgb_pool = self.sensor_index(self.config["rgb_sensor_pool"])
             test_points = gpd.read_file("{}/data/processed/canopy_points.shp".format(self.ROOT))   
             test_crowns = gpd.read_file("{}/data/processed/crowns.shp".format(self.ROOT))   
             
@@ -324,7 +337,8 @@ class TreeModel(LightningModule):
         crowns = gpd.read_file("{}/data/processed/crowns.shp".format(self.ROOT))   
         results = results.merge(crowns.drop(columns="label"), on="individual")
         results = gpd.GeoDataFrame(results, geometry="geometry")
-        HSI_pool = glob.glob(self.config["HSI_tif_dir"] +"*.tif")
+        #Only tiles converted with the bin size of the model
+        HSI_pool = self.sensor_index("{}*{}".format(self.config["HSI_tif_dir"], Hyperspectral.hyperspectral_suffix(self.config.get("bin_size", 1))))
         neighbors = spatial.spatial_neighbors(
             results,
             buffer=self.config["neighbor_buffer_size"],
@@ -7,7 +7,7 @@ import pandas as pd
 from src import CHM
 import shapely
 
-def read_files(directory, config=None):
+def read_files(directory, config=None, client=None):
     """Read shapefiles and return a dict based on site name"""
     shapefiles = glob.glob("{}/*.shp".format(directory))
     shps = [gpd.read_file(x) for x in shapefiles]
@@ -16,19 +16,20 @@ def read_files(directory, config=None):
     sitedf = []
     for index, x in enumerate(sites):
         print(x)
-        formatted_data = format(site=x, gdf=shps[index], config=config)
+        formatted_data = format(site=x, gdf=shps[index], config=config, client=client)
         sitedf.append(formatted_data)
 
     sitedf = pd.concat(sitedf)
     
     return sitedf
 
-def format(site, gdf, config):
+def format(site, gdf, config, client=None):
     """The goal of this function is to mimic for the format needed to input to generate.points_to_crowns. 
     This requires a plot ID, individual, taxonID and site column. The individual should encode siteID and year
     Args:
         site: siteID
         gdf: site data
+        client: optional dask client or concurrent.futures executor for CHM height extraction, see CHM.CHM_height
     """
     #give each an individual ID
     gdf["individualID"] = gdf.index.to_series().apply(lambda x: "{}.contrib.{}".format(site,x)) 
@@ -43,7 +44,7 @@ def format(site, gdf, config):
     
     if "height" in gdf.columns: 
         #Height filter 
-        gdf = CHM.filter_CHM(gdf, CHM_pool=config["CHM_pool"],max_CHM_diff=config["max_CHM_diff"], min_CHM_height=config["min_CHM_height"], CHM_height_limit=config["CHM_height_limit"])      
+        gdf = CHM.filter_CHM(gdf, CHM_pool=config["CHM_pool"],max_CHM_diff=config["max_CHM_diff"], min_CHM_height=config["min_CHM_height"], CHM_height_limit=config["CHM_height_limit"], file_catalog=config["file_catalog"], client=client, cache_path=config["CHM_cache"])      
         
     return gdf
 
@@ -69,7 +70,7 @@ def create_grid(gdf):
     
     return grid
     
-def load(directory, config):
+def load(directory, config, client=None):
     """Load all the megaplot data and generate crown predictions
     Args:
         directory: location of .csv files of megaplot data
@@ -77,6 +78,6 @@ def load(directory, config):
     Returns:
         crowndf: a geopandas dataframe of crowns for all sites
     """
-    formatted_data = read_files(directory=directory, config=config)
+    formatted_data = read_files(directory=directory, config=config, client=client)
     
     return formatted_data
\ No newline at end of file
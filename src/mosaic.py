@@ -0,0 +1,117 @@
+#Virtual mosaic of NEON 1km sensor tiles. Windows that cross a tile edge are stitched from every tile they touch.
+import math
+from collections import OrderedDict
+import numpy as np
+import rasterio
+from rasterio.transform import Affine
+from src import Hyperspectral
+from src import neon_paths
+from src import patches
+
+class MosaicReader():
+    """Read bounds from a pool of sensor tiles as if they were one raster
+    Args:
+        lookup_pool: list of sensor tile paths, or a neon_paths.TileIndex
+        year: optional flight year, the latest year of each tile is used otherwise
+        max_open: number of tile handles kept open between reads
+    """
+    def __init__(self, lookup_pool, year=None, max_open=8):
+        if not isinstance(lookup_pool, neon_paths.TileIndex):
+            lookup_pool = neon_paths.TileIndex(lookup_pool)
+        self.tile_index = lookup_pool
+        self.year = year
+        self.max_open = max_open
+        self.handles = OrderedDict()
+        self.res = None
+
+    def __getstate__(self):
+        #Open handles stay with the process that opened them, DataLoader workers open their own
+        state = self.__dict__.copy()
+        state["handles"] = OrderedDict()
+
+        return state
+
+    def open(self, path):
+        """Cached handle of a tile, the least recently used handle is closed once max_open are open"""
+        if path in self.handles:
+            self.handles.move_to_end(path)
+            return self.handles[path]
+        src = patches.open_sensor(path)
+        self.handles[path] = src
+        if len(self.handles) > self.max_open:
+            _, oldest = self.handles.popitem(last=False)
+            oldest.close()
+
+        return src
+
+    def tiles(self, bounds):
+        """Paths of the tiles that intersect bounds, missing tiles are left out"""
+        left, bottom, right, top = bounds
+        eastings = range(math.floor(left / 1000), max(math.ceil(right / 1000), math.floor(left / 1000) + 1))
+        northings = range(math.floor(bottom / 1000), max(math.ceil(top / 1000), math.floor(bottom / 1000) + 1))
+        paths = []
+        for easting in eastings:
+            for northing in northings:
+                geo_index = "{}_{}".format(easting * 1000, northing * 1000)
+                matches = self.tile_index.paths(geo_index, year=self.year)
+                if matches:
+                    paths.append(matches[0])
+
+        return paths
+
+    def read_bounds(self, bounds, fill=None):
+        """Read bounds as a bands x rows x cols array
+        Within a single tile this is the same read as src.read(window=from_bounds(...)), across tiles the window is
+        sampled from the grid of all tiles it touches.
+        Args:
+            bounds: left, bottom, right, top in the crs of the tiles
+            fill: value of pixels without a tile, defaults to the nodata value of the tiles, or 0
+        """
+        left, bottom, right, top = bounds
+        paths = self.tiles(bounds)
+        if len(paths) == 0:
+            raise ValueError("No tiles for bounds {} in sensor pool".format(bounds))
+
+        sources = [self.open(x) for x in paths]
+        self.res = sources[0].res
+        if len(sources) == 1:
+            src = sources[0]
+            return src.read(window=rasterio.windows.from_bounds(left, bottom, right, top, transform=src.transform))
+
+        #Grid of the union of the tiles, NEON tiles share a resolution and align on the 1km grid
+        res = sources[0].res[0]
+        mosaic_left = min(x.bounds.left for x in sources)
+        mosaic_top = max(x.bounds.top for x in sources)
+        height = int(round((mosaic_top - min(x.bounds.bottom for x in sources)) / res))
+        width = int(round((max(x.bounds.right for x in sources) - mosaic_left) / res))
+        transform = Affine.translation(mosaic_left, mosaic_top) * Affine.scale(res, -res)
+        rows, cols = Hyperspectral.window_indices(rasterio.windows.from_bounds(left, bottom, right, top, transform=transform), height, width)
+
+        if fill is None:
+            fill = sources[0].nodata if sources[0].nodata is not None else 0
+        img = np.full((sources[0].count, rows.size, cols.size), fill, dtype=sources[0].dtypes[0])
+        for src in sources:
+            row_off = int(round((mosaic_top - src.bounds.top) / res))
+            col_off = int(round((src.bounds.left - mosaic_left) / res))
+            row_mask = (rows >= row_off) & (rows < row_off + src.height)
+            col_mask = (cols >= col_off) & (cols < col_off + src.width)
+            if not row_mask.any() or not col_mask.any():
+                continue
+            local_rows = rows[row_mask] - row_off
+            local_cols = cols[col_mask] - col_off
+            window = rasterio.windows.Window(local_cols[0], local_rows[0], local_cols[-1] - local_cols[0] + 1, local_rows[-1] - local_rows[0] + 1)
+            block = src.read(window=window)
+            img[:, np.flatnonzero(row_mask)[:, None], np.flatnonzero(col_mask)] = block[:, local_rows - local_rows[0]][:, :, local_cols - local_cols[0]]
+
+        return img
+
+    def close(self):
+        for src in self.handles.values():
+            src.close()
+        self.handles = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,17 +1,36 @@
 #Utility functions for searching for NEON schema data given a bound or filename. Optionally generating .tif files from .h5 hyperspec files.
+import json
+import logging
 import os
 import math
 import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import uuid
 import h5py
+import numpy as np
+import rasterio
 from src import Hyperspectral
+from src import catalog
+
+logger = logging.getLogger(__name__)
 
 def bounds_to_geoindex(bounds):
     """Convert an extent into NEONs naming schema
     Args:
-        bounds: list of top, left, bottom, right bounds, usually from geopandas.total_bounds
+        bounds: list of top, left, bottom, right bounds, usually from geopandas.total_bounds, or a n x 4 array of bounds, e.g. geopandas.bounds.values
     Return:
-        geoindex: str {easting}_{northing}
+        geoindex: str {easting}_{northing}, or an array of n geoindex strings
     """
+    bounds = np.asarray(bounds, dtype=float)
+    if bounds.ndim == 2:
+        easting = np.floor(np.minimum(bounds[:, 0], bounds[:, 2]) / 1000).astype(int) * 1000
+        northing = np.floor(np.minimum(bounds[:, 1], bounds[:, 3]) / 1000).astype(int) * 1000
+        return np.array(["{}_{}".format(x, y) for x, y in zip(easting, northing)], dtype=object)
+    
     easting = min(bounds[0], bounds[2])
     northing = min(bounds[1], bounds[3])
 
@@ -22,68 +41,241 @@ def bounds_to_geoindex(bounds):
 
     return geoindex
 
+class TileIndex():
+    """Lookup of sensor tiles by geoindex, built once from a pool of paths.
+    Where a geoindex has several tiles, the latest year wins, the same as sorting the matching paths in reverse.
+    Args:
+        lookup_pool: list of sensor tile paths, e.g. from glob.glob
+        year: optional flight year, tiles from other years are left out
+    """
+    def __init__(self, lookup_pool, year=None):
+        self.tiles = {}
+        for path in sorted(lookup_pool, reverse=True):
+            if year and not year_from_path(path) == int(year):
+                continue
+            geo_index = geoindex_from_path(path)
+            if geo_index is None:
+                continue
+            self.tiles.setdefault(geo_index, []).append(path)
+    
+    def __len__(self):
+        return len(self.tiles)
+    
+    def __contains__(self, geo_index):
+        return geo_index in self.tiles
+    
+    def paths(self, geo_index, year=None):
+        """All tiles of a geoindex, latest first"""
+        paths = self.tiles.get(geo_index, [])
+        if year:
+            paths = [x for x in paths if year_from_path(x) == int(year)]
+        
+        return paths
+    
+    def find(self, geo_index=None, bounds=None, year=None):
+        """Latest tile for a geoindex, or for the geoindex of bounds
+        Raises:
+            ValueError: if no tile matches
+        """
+        if geo_index is None:
+            geo_index = bounds_to_geoindex(bounds)
+        paths = self.paths(geo_index, year=year)
+        if len(paths) == 0:
+            raise ValueError("No matches for geoindex {} in sensor pool".format(geo_index))
+        
+        return paths[0]
+    
+    def lookup(self, bounds, year=None):
+        """Latest tile for each row of a n x 4 array of bounds, None where no tile matches"""
+        geo_indices = bounds_to_geoindex(np.atleast_2d(bounds))
+        found = {x: self.paths(x, year=year) for x in set(geo_indices)}
+        
+        return [found[x][0] if found[x] else None for x in geo_indices]
+
 def find_sensor_path(lookup_pool, shapefile=None, bounds=None, geo_index=None):
     """Find a hyperspec path based on the shapefile using NEONs schema
     Args:
         bounds: Optional: list of top, left, bottom, right bounds, usually from geopandas.total_bounds. Instead of providing a shapefile
-        lookup_pool: glob string to search for matching files for geoindex
+        lookup_pool: list of paths to search for matching files for geoindex, or a TileIndex when looking up many tiles
     Returns:
         year_match: full path to sensor tile
     """
     if geo_index:
-        match = [x for x in lookup_pool if geo_index in x]
-        match.sort()
-        match = match[::-1]
-        try:
-            year_match = match[0]
-        except Exception as e:
-            raise ValueError("No matches for geoindex {} in sensor pool".format(geo_index))        
+        message = "No matches for geoindex {} in sensor pool".format(geo_index)
     elif shapefile is None:
         geo_index = bounds_to_geoindex(bounds=bounds)
-        match = [x for x in lookup_pool if geo_index in x]
-        match.sort()
-        match = match[::-1]
-        try:
-            year_match = match[0]
-        except Exception as e:
-            raise ValueError("No matches for geoindex {} in sensor pool with bounds {}".format(geo_index, bounds))
+        message = "No matches for geoindex {} in sensor pool with bounds {}".format(geo_index, bounds)
     else:
-
         #Get file metadata from name string
         basename = os.path.splitext(os.path.basename(shapefile))[0]
         geo_index = re.search("(\d+_\d+)_image", basename).group(1)
-        match = [x for x in lookup_pool if geo_index in x]
-        match.sort()
-        match = match[::-1]        
+        message = "No matches for geoindex {} in sensor pool".format(geo_index)
+
+    if isinstance(lookup_pool, TileIndex):
         try:
-            year_match = match[0]
-        except Exception as e:
-            raise ValueError("No matches for geoindex {} in sensor pool".format(geo_index))
+            return lookup_pool.find(geo_index=geo_index)
+        except ValueError:
+            raise ValueError(message)
+    
+    match = [x for x in lookup_pool if geo_index in x]
+    match.sort()
+    match = match[::-1]
+    try:
+        year_match = match[0]
+    except Exception as e:
+        raise ValueError(message)
 
     return year_match
 
-def convert_h5(hyperspectral_h5_path, rgb_path, savedir):
-    tif_basename = os.path.splitext(os.path.basename(rgb_path))[0] + "_hyperspectral.tif"
+def convert_h5(hyperspectral_h5_path, rgb_path, savedir, block_rows=50, layout=None, bin_size=1, tile_catalog=None, bands="no_water"):
+    """Convert a .h5 hyperspec tile to a .tif named after its matching rgb tile
+    Args:
+        block_rows: rows streamed per read, see Hyperspectral.stream_raster. None loads the full tile into memory
+        layout: optional tiling and compression of the .tif, see Hyperspectral.COG_LAYOUT
+        bin_size: number of adjacent bands averaged into each band, see Hyperspectral.band_bins
+        tile_catalog: optional tile metadata catalog, the .h5 header is taken from it instead of the tile, see catalog.build_catalog
+        bands: band selection, see Hyperspectral.select_bands
+    """
+    tif_basename = Hyperspectral.hyperspectral_name(rgb_path, bin_size, bands)
     tif_path = "{}/{}".format(savedir, tif_basename)
 
     Hyperspectral.generate_raster(h5_path=hyperspectral_h5_path,
                                   rgb_filename=rgb_path,
-                                  bands="no_water",
-                                  save_dir=savedir)
+                                  bands=bands,
+                                  save_dir=savedir,
+                                  block_rows=block_rows,
+                                  layout=layout,
+                                  bin_size=bin_size,
+                                  metadata=catalog.h5_metadata(tile_catalog, hyperspectral_h5_path) if tile_catalog else None)
 
     return tif_path
 
 
-def lookup_and_convert(rgb_pool, hyperspectral_pool, savedir, bounds = None, shapefile=None, geo_index=None):
-    hyperspectral_h5_path = find_sensor_path(shapefile=shapefile,lookup_pool=hyperspectral_pool, bounds=bounds, geo_index=geo_index)
-    rgb_path = find_sensor_path(shapefile=shapefile, lookup_pool=rgb_pool, bounds=bounds, geo_index=geo_index)
+def complete_tif(tif_path):
+    """Whether a .tif without a .done marker, written before markers existed, is complete. The last row of a partial file can't be read."""
+    try:
+        with rasterio.open(tif_path) as src:
+            src.read(window=rasterio.windows.Window(0, src.height - 1, src.width, 1))
+    except Exception:
+        return False
+
+    return True
+
+def conversion_settings(bin_size=1, layout=None, bands="no_water", **kwargs):
+    """Settings that change the converted .tif, recorded in its .done marker"""
+    return json.loads(json.dumps({"bin_size": bin_size, "layout": layout, "bands": bands}))
+
+def check_marker(done_path, settings):
+    """Raise if the .done marker records other settings than requested. Empty markers were written before settings were recorded and are accepted
+    Raises:
+        ValueError: if the .tif was converted with other settings
+    """
+    with open(done_path) as f:
+        content = f.read().strip()
+    if not content:
+        return
+    recorded = json.loads(content)
+    #Markers written before the band selection was recorded are from no_water conversions
+    recorded.setdefault("bands", "no_water")
+    if not recorded == settings:
+        raise ValueError("{} was converted with {}, not {}. Remove the .tif and its marker to convert again".format(done_path[:-len(".done")], content, json.dumps(settings)))
+
+def write_marker(done_path, settings):
+    with open(done_path, "w") as f:
+        f.write(json.dumps(settings))
+
+def release_lock(lock_path, token):
+    """Remove the lock only if it is still ours, a worker that found it stale may have taken it over"""
+    try:
+        with open(lock_path) as f:
+            owner = f.read()
+        if owner == token:
+            os.remove(lock_path)
+    except FileNotFoundError:
+        pass
 
-    #convert .h5 hyperspec tile if needed
-    tif_basename = os.path.splitext(os.path.basename(rgb_path))[0] + "_hyperspectral.tif"
+def touch_lock(lock_path, stop, interval):
+    """Refresh the lock mtime every interval seconds until stop is set, so a long conversion is never taken for a crashed one"""
+    while not stop.wait(interval):
+        try:
+            os.utime(lock_path)
+        except FileNotFoundError:
+            pass
+
+def convert_h5_once(hyperspectral_h5_path, rgb_path, savedir, stale=7200, poll=10, **kwargs):
+    """Convert a .h5 tile unless it is already converted, safe to call from many workers at once.
+    One worker takes a lock file next to the .tif and converts into a hidden temporary directory, then renames the .tif into place and writes a .done marker
+    with the conversion settings. The lock is refreshed while the conversion runs. The other workers wait for the marker and reuse the result. 
+    Args:
+        stale: seconds without a refresh after which a lock is treated as left behind by a crashed worker and removed
+        poll: seconds between checks while another worker converts
+        **kwargs: block_rows, layout, bin_size, tile_catalog and bands, see convert_h5
+    Returns:
+        tif_path: path of the converted .tif
+    Raises:
+        ValueError: if the .tif exists from a conversion with other settings
+    """
+    tif_basename = Hyperspectral.hyperspectral_name(rgb_path, kwargs.get("bin_size", 1), kwargs.get("bands", "no_water"))
     tif_path = "{}/{}".format(savedir, tif_basename)
+    done_path = "{}.done".format(tif_path)
+    lock_path = "{}.lock".format(tif_path)
+    settings = conversion_settings(**kwargs)
+    token = "{} {} {}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
 
-    if not os.path.exists(tif_path):
-        tif_path = convert_h5(hyperspectral_h5_path, rgb_path, savedir)
+    while not os.path.exists(done_path):
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > stale:
+                    logger.warning("Removing stale lock {}".format(lock_path))
+                    os.remove(lock_path)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(poll)
+            continue
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=touch_lock, args=(lock_path, stop, stale / 4), daemon=True)
+        try:
+            os.write(fd, token.encode())
+            os.close(fd)
+            heartbeat.start()
+            #Another worker may have finished between the check and the lock
+            if os.path.exists(done_path):
+                break
+            if os.path.exists(tif_path) and complete_tif(tif_path):
+                write_marker(done_path, settings)
+                break
+            tmpdir = tempfile.mkdtemp(dir=savedir, prefix=".convert_")
+            try:
+                convert_h5(hyperspectral_h5_path, rgb_path, tmpdir, **kwargs)
+                os.replace("{}/{}".format(tmpdir, tif_basename), tif_path)
+                write_marker(done_path, settings)
+            finally:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        finally:
+            stop.set()
+            if heartbeat.is_alive():
+                heartbeat.join()
+            release_lock(lock_path, token)
+    
+    check_marker(done_path, settings)
+
+    return tif_path
+
+def lookup_and_convert(rgb_pool, hyperspectral_pool, savedir, bounds = None, shapefile=None, geo_index=None, bin_size=1, tile_catalog=None):
+    """Find the .h5 and rgb tile of a location and convert the .h5 to a .tif in savedir if needed
+    tile_catalog: optional tile metadata catalog, see convert_h5
+    Returns:
+        tif_path: {rgb basename}_hyperspectral.tif, or _hyperspectral_bin{bin_size}.tif for binned bands, see Hyperspectral.hyperspectral_name
+    """
+    hyperspectral_h5_path = find_sensor_path(shapefile=shapefile,lookup_pool=hyperspectral_pool, bounds=bounds, geo_index=geo_index)
+    rgb_path = find_sensor_path(shapefile=shapefile, lookup_pool=rgb_pool, bounds=bounds, geo_index=geo_index)
+
+    #convert .h5 hyperspec tile if needed, concurrent lookups of the same tile wait for a single conversion
+    tif_path = convert_h5_once(hyperspectral_h5_path, rgb_path, savedir, bin_size=bin_size, tile_catalog=tile_catalog)
 
     return tif_path
 
@@ -99,10 +291,35 @@ def domain_from_path(path):
     
     return domain_name
 
-def elevation_from_tile(path):
+def year_from_path(path):
+    """NEON flight year from the directory schema (/2019/) or a year prefixed basename (2019_HARV_6_...)
+    Returns:
+        year: int, None if the path has no year
+    """
+    year = re.search("(?:^|/)(20\d{2})(?:/|_)", path)
+    if year is None:
+        return None
+    
+    return int(year.group(1))
+
+def geoindex_from_path(path):
+    """{easting}_{northing} of the 1km tile in a NEON filename, None if the name has no geoindex"""
+    basename = os.path.basename(path)
+    geo_index = re.search("(?<!\d)(\d+000_\d+000)(?!\d)", basename)
+    if geo_index is None:
+        return None
+    
+    return geo_index.group(1)
+
+def elevation_from_tile(path, tile_catalog=None):
+    """Mean surface elevation of a .h5 tile. If a tile catalog is given, see catalog.build_catalog, the file is only opened when it is missing from the catalog"""
+    if tile_catalog:
+        record = catalog.tile_metadata(tile_catalog, path)
+        if record is not None and record["elevation"] is not None:
+            return record["elevation"]
     try:
         h5 = h5py.File(path, 'r')
-        elevation = h5[list(h5.keys())[0]]["Reflectance"]["Metadata"]["Ancillary_Imagery"]["Smooth_Surface_Elevation"].value.mean()
+        elevation = h5[list(h5.keys())[0]]["Reflectance"]["Metadata"]["Ancillary_Imagery"]["Smooth_Surface_Elevation"][()].mean()
         h5.close()
     except Exception as e:
         raise IOError("{} failed to read elevation from tile:".format(path, e))
@@ -0,0 +1,92 @@
+#On disk table written one partition at a time. Long dask runs append each finished task as a parquet file,
+#so results don't pile up in memory and a restarted run skips the partitions that are already written.
+import glob
+import json
+import os
+import geopandas as gpd
+import pandas as pd
+import pyarrow.parquet as pq
+from src.atomic import atomic_write
+
+SETTINGS = "settings.json"
+
+def partition_path(directory, key):
+    return "{}/{}.parquet".format(directory, key)
+
+def completed(directory):
+    """Keys of the partitions written so far, an empty set if directory is None or doesn't exist"""
+    if directory is None:
+        return set()
+
+    return set([os.path.splitext(os.path.basename(x))[0] for x in glob.glob(partition_path(directory, "*"))])
+
+def reset(directory, settings=None, replace=False):
+    """Prepare a partition directory for a run. The partitions written so far are removed if replace is set,
+    or if they were written with other settings, so a run never reuses results it would compute differently. The settings are recorded for the next run.
+    Args:
+        directory: partition directory, nothing is done if None
+        settings: json serializable dict of the values the partitions depend on
+        replace: remove the partitions written so far
+    """
+    if directory is None:
+        return
+    os.makedirs(directory, exist_ok=True)
+    settings = json.loads(json.dumps(settings))
+    settings_path = "{}/{}".format(directory, SETTINGS)
+    previous = settings
+    if os.path.exists(settings_path):
+        with open(settings_path) as f:
+            previous = json.load(f)
+
+    if replace or not previous == settings:
+        done = completed(directory)
+        if len(done) > 0:
+            print("Removing {} partitions from {}, {}".format(len(done), directory, "replace is set" if replace else "written with {}".format(previous)))
+        for key in done:
+            os.remove(partition_path(directory, key))
+
+    with atomic_write(settings_path, suffix=".json") as tmp_path:
+        with open(tmp_path, "w") as f:
+            json.dump(settings, f)
+
+def write_partition(directory, key, df):
+    """Write a dataframe, or a geodataframe as GeoParquet, as the partition key. An empty or None df marks the key as done without rows
+    Returns:
+        path: parquet file
+    """
+    os.makedirs(directory, exist_ok=True)
+    if df is None or df.empty:
+        df = pd.DataFrame()
+
+    #Parquet columns have a single type, columns that mix types, e.g. box_id of predicted and fixed boxes, are stored as strings
+    df = df.copy()
+    for column in df.columns:
+        if df[column].dtype == object and df[column].dropna().map(type).nunique() > 1:
+            df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+
+    #Write to a temporary name and rename so a partial file is never read, hidden files are skipped by completed
+    path = partition_path(directory, key)
+    with atomic_write(path, suffix=".parquet") as tmp_path:
+        df.to_parquet(tmp_path)
+
+    return path
+
+def read_partition(path):
+    """Read a partition as a geodataframe if it was written from one"""
+    metadata = pq.read_schema(path).metadata or {}
+    if b"geo" in metadata:
+        return gpd.read_parquet(path)
+
+    return pd.read_parquet(path)
+
+def read_partitions(directory):
+    """Concatenate the partitions of a table, partitions without rows are skipped
+    Returns:
+        df: dataframe, or geodataframe for GeoParquet partitions, None if there are no rows
+    """
+    partitions = [read_partition(x) for x in sorted(glob.glob(partition_path(directory, "*")))]
+    partitions = [x for x in partitions if not x.empty]
+    if len(partitions) == 0:
+        return None
+
+    return pd.concat(partitions, ignore_index=True)
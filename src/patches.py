@@ -1,13 +1,31 @@
 #Patches
+import numpy as np
 import rasterio
+from src import cube
+from src import Hyperspectral
+
+def open_sensor(sensor_path):
+    """Open sensor data for windowed reads. NEON .h5 reflectance tiles are read directly, without .tif conversion, 
+    and .cube directories with the chunked reader, see cube.py"""
+    if sensor_path.endswith(".h5"):
+        return Hyperspectral.H5Reader(sensor_path)
+    if sensor_path.rstrip("/").endswith(".cube"):
+        return cube.CubeReader(sensor_path)
+    
+    return rasterio.open(sensor_path)
 
 def crop(bounds, sensor_path, savedir = None, basename = None):
-    """Given a 4 pointed bounding box, crop sensor data"""
+    """Given a 4 pointed bounding box, crop sensor data
+    sensor_path: path to a sensor tile, or a mosaic.MosaicReader for bounds that cross tile edges
+    """
     left, bottom, right, top = bounds 
     height = top - bottom
     width = right - left
-    src = rasterio.open(sensor_path)        
-    img = src.read(window=rasterio.windows.from_bounds(left, bottom, right, top, transform=src.transform))    
+    if hasattr(sensor_path, "read_bounds"):
+        img = sensor_path.read_bounds(bounds)
+    else:
+        with open_sensor(sensor_path) as src:
+            img = src.read(window=rasterio.windows.from_bounds(left, bottom, right, top, transform=src.transform))    
     if savedir:
         filename = "{}/{}.tif".format(savedir, basename)
         with rasterio.open(filename, "w", driver="GTiff",height=height, width=width, count = img.shape[0], dtype=img.dtype) as dst:
@@ -17,6 +35,114 @@ def crop(bounds, sensor_path, savedir = None, basename = None):
     else:
         return img    
     
+def windows_from_bounds(bounds, transform):
+    """Fractional pixel windows of many bounds in one inverse affine, the vectorized rasterio.windows.from_bounds of a north up raster
+    Args:
+        bounds: n x 4 array of left, bottom, right, top, e.g. geopandas.bounds.values
+        transform: affine transform of the raster
+    Returns:
+        col_off, row_off, width, height: arrays of length n
+    """
+    bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+    inverse = ~transform
+    col_left, row_top = inverse * (bounds[:, 0], bounds[:, 3])
+    col_right, row_bottom = inverse * (bounds[:, 2], bounds[:, 1])
+    
+    return col_left, row_top, np.maximum(col_right - col_left, 0), np.maximum(row_bottom - row_top, 0)
+
+def coalesce_windows(row_start, row_stop, col_start, col_stop, gap=8, max_size=256, max_ratio=4):
+    """Group pixel ranges into blocks that are read at once. Windows are swept once in row order and each joins an open block within gap pixels of it,
+    as long as the block stays at most max_size pixels a side and its area at most max_ratio times the area of its windows.
+    Dense plots are read in several compact blocks rather than chaining into one block the size of the tile.
+    Returns:
+        blocks: list of [row_start, row_stop, col_start, col_stop, indices of the windows in the block]
+    """
+    blocks = []
+    active = []
+    for index in np.lexsort((col_start, row_start)):
+        box_row_start, box_row_stop, box_col_start, box_col_stop = row_start[index], row_stop[index], col_start[index], col_stop[index]
+        area = (box_row_stop - box_row_start) * (box_col_stop - box_col_start)
+        #Blocks that end more than gap rows above the window can't be joined by it or any later window
+        active = [block for block in active if block[1] + gap >= box_row_start]
+        for block in active:
+            if box_col_start > block[3] + gap or block[2] > box_col_stop + gap:
+                continue
+            merged = [block[0], max(block[1], box_row_stop), min(block[2], box_col_start), max(block[3], box_col_stop)]
+            if merged[1] - merged[0] > max_size or merged[3] - merged[2] > max_size:
+                continue
+            if (merged[1] - merged[0]) * (merged[3] - merged[2]) > max_ratio * (block[5] + area):
+                continue
+            block[:4] = merged
+            block[4].append(index)
+            block[5] += area
+            break
+        else:
+            block = [box_row_start, box_row_stop, box_col_start, box_col_stop, [index], area]
+            blocks.append(block)
+            active.append(block)
+    
+    return [block[:5] for block in blocks]
+
+def crop_many(bounds, src, gap=8, max_size=256):
+    """Crop many bounds from an open sensor tile, neighboring crops are read together in one block
+    Each crop is the same as src.read(window=rasterio.windows.from_bounds(*bounds, transform=src.transform))
+    Args:
+        bounds: n x 4 array of left, bottom, right, top
+        src: rasterio dataset, Hyperspectral.H5Reader or cube.CubeReader, see open_sensor
+        gap: crops up to gap pixels apart share a read
+        max_size: largest block side in pixels, see coalesce_windows
+    Returns:
+        crops: list of bands x rows x cols arrays in the order of bounds
+    """
+    col_off, row_off, width, height = windows_from_bounds(bounds, src.transform)
+    indices = [Hyperspectral.window_indices(rasterio.windows.Window(*x), src.height, src.width) for x in zip(col_off, row_off, width, height)]
+    crops = [None] * len(indices)
+    
+    #Crops that fall outside the tile have no pixels to read
+    valid = [index for index, (rows, cols) in enumerate(indices) if rows.size > 0 and cols.size > 0]
+    for index in set(range(len(indices))) - set(valid):
+        rows, cols = indices[index]
+        crops[index] = np.zeros((src.count, rows.size, cols.size), dtype=src.dtypes[0])
+    if len(valid) == 0:
+        return crops
+    
+    row_start = np.array([indices[x][0][0] for x in valid])
+    row_stop = np.array([indices[x][0][-1] + 1 for x in valid])
+    col_start = np.array([indices[x][1][0] for x in valid])
+    col_stop = np.array([indices[x][1][-1] + 1 for x in valid])
+    for block_row_start, block_row_stop, block_col_start, block_col_stop, members in coalesce_windows(row_start, row_stop, col_start, col_stop, gap=gap, max_size=max_size):
+        block = src.read(window=rasterio.windows.Window(block_col_start, block_row_start, block_col_stop - block_col_start, block_row_stop - block_row_start))
+        for member in members:
+            rows, cols = indices[valid[member]]
+            crops[valid[member]] = block[:, rows - block_row_start][:, :, cols - block_col_start]
+    
+    return crops
+
+def crop_tile(bounds, sensor_path, savedir, basenames, gap=8):
+    """Crop and write many bounds from one sensor tile, the tile is opened once
+    Args:
+        bounds: n x 4 array of left, bottom, right, top
+        sensor_path: path to a sensor tile
+        savedir: location to save crops
+        basenames: output file is {basename}.tif for each bounds
+    Returns:
+        filenames: list of written files, None for bounds outside the tile
+    """
+    with open_sensor(sensor_path) as src:
+        crops = crop_many(bounds, src, gap=gap)
+    
+    filenames = []
+    for img, basename in zip(crops, basenames):
+        if img.shape[1] == 0 or img.shape[2] == 0:
+            filenames.append(None)
+            continue
+        filename = "{}/{}.tif".format(savedir, basename)
+        with rasterio.open(filename, "w", driver="GTiff",height=img.shape[1], width=img.shape[2], count = img.shape[0], dtype=img.dtype) as dst:
+            dst.write(img)
+        filenames.append(filename)
+    
+    return filenames
+    
 def row_col_from_bounds(bounds, src):
     """Given a geometry object and rasterio src, get the row col indices of all overlapping pixels
     Args:
@@ -24,19 +150,19 @@ def row_col_from_bounds(bounds, src):
         img_centroids: a list of (row, col) indices for the rasterio src object
     """
     left, bottom, right, top = bounds 
-    img_centroids = []
-    img = src.read(window=rasterio.windows.from_bounds(left, bottom, right, top, transform=src.transform))
-    win_transform = src.window_transform(window=rasterio.windows.from_bounds(left, bottom, right, top, transform=src.transform))
-    for row in range(img.shape[1]):
-        for col in range(img.shape[2]):
-            coords = rasterio.transform.xy(win_transform, row, col, offset='center')
-            row_col = rasterio.transform.rowcol(src.transform, coords[0], coords[1])
-            img_centroids.append(row_col)    
+    window = rasterio.windows.from_bounds(left, bottom, right, top, transform=src.transform)
+    #The pixels a read of the window returns, located by their centers in the tile
+    rows, cols = Hyperspectral.window_indices(window, src.height, src.width)
+    row_index = np.floor(window.row_off + np.arange(rows.size) + 0.5).astype(int)
+    col_index = np.floor(window.col_off + np.arange(cols.size) + 0.5).astype(int)
+    row_grid, col_grid = np.meshgrid(row_index, col_index, indexing="ij")
+    img_centroids = list(zip(row_grid.ravel().tolist(), col_grid.ravel().tolist()))
     
     return img_centroids
                     
 def bounds_to_pixel(bounds, img_path, savedir=None, basename=None,width=11, height=11):
-    """Given a crown box, create the pixel crops
+    """Given a crown box, create the pixel crops. Each crop starts at the pixel and extends width x height down and right,
+    all crops are views of a single padded read around the crown.
     Args:
          crown: a geometry object
          img_path: sensor data to crop
@@ -48,25 +174,29 @@ def bounds_to_pixel(bounds, img_path, savedir=None, basename=None,width=11, heig
          crops: [(row, col), image crop]
          filenames: filenames of written patches
     """
-    counter = 0
     filenames = []   
     crops = []
-    src = rasterio.open(img_path)    
-    img_centroids = row_col_from_bounds(bounds, src)
-    for indices in img_centroids:
-        row, col = indices
-        img = src.read(window = rasterio.windows.Window(col_off=col, row_off=row, width = width, height=height), boundless=True)
+    with rasterio.open(img_path) as src:
+        img_centroids = row_col_from_bounds(bounds, src)
+        if len(img_centroids) == 0:
+            return filenames if savedir else crops
+        indices = np.array(img_centroids)
+        row_start, col_start = indices.min(axis=0)
+        row_stop, col_stop = indices.max(axis=0) + (height, width)
+        block = src.read(window=rasterio.windows.Window(col_off=col_start, row_off=row_start, width=col_stop - col_start, height=row_stop - row_start), boundless=True)
+    
+    #bands x rows x cols x height x width view, the crop of a pixel is indexed by its offset in the block
+    windows = np.lib.stride_tricks.sliding_window_view(block, (height, width), axis=(1, 2))
+    for counter, (row, col) in enumerate(img_centroids):
+        img = windows[:, row - row_start, col - col_start]
         if savedir:
             filename = "{}/{}_{}.tif".format(savedir, basename, counter)
             with rasterio.open(filename, "w", driver="GTiff",height=height, width=width, count = img.shape[0], dtype=img.dtype) as dst:
                 dst.write(img)
-            counter = counter + 1
             filenames.append(filename)
-
         else:
             crops.append([(row,col),img])
     if savedir:
         return filenames
     else:
         return crops
-        
@@ -1,13 +1,17 @@
 #Predict
 from deepforest import main
-from deepforest.utilities import annotations_to_shapefile
-import glob
 import geopandas as gpd
 import numpy as np
 import os
 import rasterio
+import re
 from src.main import TreeModel
 from src.models import dead
+from src import catalog
+from src.crowns import tile_crowns
+from src import mosaic
+from src import neon_paths
+from src import patches
 from src.utils import preprocess_image
 from src.CHM import postprocess_CHM
 from torch.utils.data import Dataset
@@ -31,21 +35,43 @@ class on_the_fly_dataset(Dataset):
     Args:
        crowns: geodataframe of crown locations from a single rasterio src
        image_path: .tif file location
+       lookup_pool: optional list of sensor tiles, or a neon_paths.TileIndex, crowns that cross the edge of image_path are read from the neighboring tiles
     """
-    def __init__(self, crowns, image_path, data_type="HSI", config=None):
+    def __init__(self, crowns, image_path, data_type="HSI", config=None, lookup_pool=None):
         self.config = config 
         self.crowns = crowns
         self.image_size = config["image_size"]
         self.data_type = data_type
-        
         if data_type == "HSI":
-            self.HSI_src = rasterio.open(image_path)
+            self.src = patches.open_sensor(image_path)
+            #HSI crowns are read at their bounds, RGB crowns with a 1m margin
+            self.margin = 0
         elif data_type == "RGB":
-            self.RGB_src = rasterio.open(image_path)
+            self.src = rasterio.open(image_path)
             self.transform = RGB_transform(augment=False)
+            self.margin = 1
         else:
             raise ValueError("data_type is {}, only HSI and RGB data types are currently allowed".format(data_type))
         
+        #Only build a mosaic of the neighboring tiles if some crowns cross the edge of the tile
+        self.mosaic = None
+        if lookup_pool is not None and not crowns.empty and not self.inside(crowns.total_bounds):
+            self.mosaic = mosaic.MosaicReader(lookup_pool, year=neon_paths.year_from_path(image_path))
+    
+    def inside(self, bounds):
+        left, bottom, right, top = bounds
+        return left - self.margin >= self.src.bounds.left and bottom - self.margin >= self.src.bounds.bottom and \
+            right + self.margin <= self.src.bounds.right and top + self.margin <= self.src.bounds.top
+    
+    def read(self, bounds):
+        """Read bounds plus the margin from the tile, or from the mosaic if they cross its edge"""
+        left, bottom, right, top = bounds
+        bounds = (left - self.margin, bottom - self.margin, right + self.margin, top + self.margin)
+        if self.mosaic is not None and not self.inside((left, bottom, right, top)):
+            return self.mosaic.read_bounds(bounds)
+        
+        return self.src.read(window=rasterio.windows.from_bounds(*bounds, transform=self.src.transform))
+        
     def __len__(self):
         #0th based index
         return self.crowns.shape[0]
@@ -55,11 +81,10 @@ class on_the_fly_dataset(Dataset):
         #Load crown and crop
         geom = self.crowns.iloc[index].geometry
         individual = self.crowns.iloc[index].individual
-        left, bottom, right, top = geom.bounds
             
         #preprocess and batch
         if self.data_type =="HSI":
-            crop = self.HSI_src.read(window=rasterio.windows.from_bounds(left, bottom, right, top, transform=self.HSI_src.transform))             
+            crop = self.read(geom.bounds)
         
             if crop.size == 0:
                 return individual, None
@@ -73,7 +98,7 @@ class on_the_fly_dataset(Dataset):
         
         elif self.data_type=="RGB":
             #Expand RGB
-            box = self.RGB_src.read(window=rasterio.windows.from_bounds(left-1, bottom-1, right+1, top+1, transform=self.RGB_src.transform))             
+            box = self.read(geom.bounds)
             #Channels last
             box = np.rollaxis(box,0,3)
             image = self.transform(box.astype(np.float32))
@@ -89,19 +114,24 @@ def my_collate(batch):
 def predict_tile(PATH, dead_model_path, species_model_path, config):
     #get rgb from HSI path
     HSI_basename = os.path.basename(PATH)
-    if "hyperspectral" in HSI_basename:
-        rgb_name = "{}.tif".format(HSI_basename.split("_hyperspectral")[0])    
+    rgb_pool = catalog.find_files(config["rgb_sensor_pool"], config.get("file_catalog"))
+    if HSI_basename.endswith(".h5"):
+        #Reflectance is read directly from the NEON tile, match rgb by geo_index
+        geo_index = re.search("(\d+_\d+)_reflectance", HSI_basename).group(1)
+        rgb_path = neon_paths.find_sensor_path(lookup_pool=rgb_pool, geo_index=geo_index)
     else:
-        rgb_name = HSI_basename           
-    rgb_pool = glob.glob(config["rgb_sensor_pool"], recursive=True)
-    rgb_path = [x for x in rgb_pool if rgb_name in x][0]
-    crowns = predict_crowns(rgb_path)
+        if "hyperspectral" in HSI_basename:
+            rgb_name = "{}.tif".format(HSI_basename.split("_hyperspectral")[0])    
+        else:
+            rgb_name = HSI_basename           
+        rgb_path = [x for x in rgb_pool if rgb_name in x][0]
+    crowns = predict_crowns(rgb_path, crown_cache_dir=config.get("crown_cache_dir"))
     crowns["tile"] = PATH
     
     #CHM filter
     if config["CHM_pool"]:
-        CHM_pool = glob.glob(config["CHM_pool"], recursive=True)
-        crowns = postprocess_CHM(crowns, CHM_pool)
+        CHM_pool = catalog.find_files(config["CHM_pool"], config.get("file_catalog"))
+        crowns = postprocess_CHM(crowns, CHM_pool, cache_path=config.get("CHM_cache"))
         #Rename column
         filtered_crowns = crowns[crowns.CHM_height > 3]
     else:
@@ -119,7 +149,13 @@ def predict_tile(PATH, dead_model_path, species_model_path, config):
     
     #Load species model
     m = TreeModel.load_from_checkpoint(species_model_path)
-    trees, features = predict_species(HSI_path=PATH, crowns=filtered_crowns, m=m, config=config)
+    #Crowns on the tile edge are completed from the neighboring tiles in the same directory, converted tiles only from those with the same bands
+    if "_hyperspectral" in HSI_basename:
+        suffix = HSI_basename[HSI_basename.index("_hyperspectral"):]
+    else:
+        suffix = os.path.splitext(PATH)[1]
+    HSI_pool = catalog.find_files("{}/*{}".format(os.path.dirname(PATH), suffix), config.get("file_catalog"))
+    trees, features = predict_species(HSI_path=PATH, crowns=filtered_crowns, m=m, config=config, lookup_pool=HSI_pool)
     
     #Spatial smooth
     trees = smooth(trees=trees, features=features, size=config["neighbor_buffer_size"], alpha=config["neighborhood_strength"])
@@ -136,17 +172,17 @@ def predict_tile(PATH, dead_model_path, species_model_path, config):
         
     return trees
 
-def predict_crowns(PATH):
-    """Predict a set of tree crowns from RGB data"""
+def predict_crowns(PATH, crown_cache_dir=None):
+    """Predict a set of tree crowns from RGB data
+    Args:
+        PATH: rgb tile
+        crown_cache_dir: optional crown cache shared with generate.points_to_crowns, a tile seen before is not predicted again
+    """
     m = main.deepforest()
     if torch.cuda.is_available():
         m.config["gpus"] = 1
     m.use_release(check_release=False)
-    boxes = m.predict_tile(PATH)
-    r = rasterio.open(PATH)
-    transform = r.transform     
-    crs = r.crs
-    gdf = annotations_to_shapefile(boxes, transform=transform, crs=crs)
+    gdf = tile_crowns(PATH, m, cache_dir=crown_cache_dir)
     
     #Dummy variables for schema
     basename = os.path.splitext(os.path.basename(PATH))[0]
@@ -161,8 +197,8 @@ def predict_crowns(PATH):
     
     return gdf
 
-def predict_species(crowns, HSI_path, m, config):
-    ds = on_the_fly_dataset(crowns=crowns, image_path=HSI_path, config=config)
+def predict_species(crowns, HSI_path, m, config, lookup_pool=None):
+    ds = on_the_fly_dataset(crowns=crowns, image_path=HSI_path, config=config, lookup_pool=lookup_pool)
     data_loader = torch.utils.data.DataLoader(
         ds,
         batch_size=config["predict_batch_size"],
@@ -0,0 +1,195 @@
+#Sequential shard format for training crops too large to preload. Crops are preprocessed once and written in large shard files,
+#ShardDataset streams them in order, so training reads a few large files sequentially instead of opening one crop per sample.
+import glob
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import IterableDataset
+from src import augmentation
+from src.atomic import atomic_write
+from src import crop_store
+from src.utils import load_image
+
+INDEX = "index.csv"
+SOURCE = "source.txt"
+
+def shard_path(shard_dir, shard):
+    return "{}/shard-{:05d}.npz".format(shard_dir, shard)
+
+def shard_paths(shard_dir):
+    return sorted(glob.glob("{}/shard-*.npz".format(shard_dir)))
+
+def source_key(csv_file, crop_store_dir=None, settings=None):
+    """Hash of the annotations, of the crop store index the shards are written from and of the settings the crops are preprocessed with"""
+    key = hashlib.sha256()
+    key.update(json.dumps(settings, sort_keys=True).encode())
+    paths = [csv_file]
+    if crop_store_dir:
+        paths.append("{}/{}".format(crop_store_dir, crop_store.INDEX))
+    for path in paths:
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                key.update(f.read())
+    
+    return key.hexdigest()
+
+def is_current(shard_dir, csv_file, crop_store_dir=None, settings=None):
+    """Whether shard_dir was written from the current annotations and crop store with the same settings, see write_shards"""
+    path = "{}/{}".format(shard_dir, SOURCE)
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        return f.read().strip() == source_key(csv_file, crop_store_dir, settings)
+
+def write_shard(path, images, labels, sites, individuals):
+    """Write one shard, the renamed file is complete"""
+    with atomic_write(path, suffix=".npz") as tmp_path:
+        with open(tmp_path, "wb") as f:
+            np.savez(f, images=np.stack(images), labels=np.array(labels), sites=np.array(sites), individuals=np.array(individuals))
+
+def write_shards(csv_file, shard_dir, image_size, shard_size=512, crop_store_dir=None, seed=0, settings=None):
+    """Preprocess the crops of an annotations file and write them to shards, crops are shuffled once so each shard holds a mix of classes
+    Args:
+        csv_file: annotations with image_path, label and site, e.g. processed/train.csv
+        shard_dir: output directory
+        image_size: crops are resized as in TreeDataset
+        shard_size: samples per shard
+        crop_store_dir: optional crop store the image paths point to, see crop_store.py
+        seed: seed of the shuffle
+        settings: json serializable dict of the values the crops depend on, e.g. image_size and the band selection, recorded for is_current
+    Returns:
+        index: dataframe of shard, individual, label and site for each sample, also written to shard_dir/index.csv
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    source_path = "{}/{}".format(shard_dir, SOURCE)
+    if os.path.exists(source_path):
+        os.remove(source_path)
+    key = source_key(csv_file, crop_store_dir, settings)
+    for path in shard_paths(shard_dir):
+        os.remove(path)
+    annotations = pd.read_csv(csv_file)
+    annotations = annotations.sample(frac=1, random_state=seed).reset_index(drop=True)
+    crop_reader = crop_store.CropReader(crop_store_dir) if crop_store_dir else None
+
+    records = []
+    for shard, start in enumerate(range(0, annotations.shape[0], shard_size)):
+        rows = annotations.iloc[start:start + shard_size]
+        images = [load_image(x, image_size=image_size, crop_reader=crop_reader).numpy() for x in rows.image_path]
+        individuals = [os.path.basename(x.split(".tif")[0]) for x in rows.image_path]
+        write_shard(shard_path(shard_dir, shard), images, rows.label.values, rows.site.values, individuals)
+        records.append(pd.DataFrame({"shard": shard, "individual": individuals, "label": rows.label.values, "site": rows.site.values}))
+
+    index = pd.concat(records, ignore_index=True)
+    index.to_csv("{}/{}".format(shard_dir, INDEX), index=False)
+    
+    #Written last, an interrupted run is rewritten
+    with open(source_path, "w") as f:
+        f.write(key)
+
+    return index
+
+def read_index(shard_dir):
+    return pd.read_csv("{}/{}".format(shard_dir, INDEX))
+
+def balanced_rates(labels, max_frequency=50):
+    """Expected number of times each sample of a label is drawn per epoch, the streaming counterpart of the WeightedRandomSampler
+    in TreeData.train_dataloader. Each sample is weighted by 1 / min(class frequency, max_frequency) and an epoch draws as many samples as there are.
+    Returns:
+        rates: dict of label -> rate
+    """
+    counts = pd.Series(labels).value_counts()
+    weights = 1 / np.minimum(counts, max_frequency)
+    total = (weights * counts).sum()
+
+    return (weights * len(labels) / total).to_dict()
+
+class ShardDataset(IterableDataset):
+    """Stream preprocessed crops from a shard directory
+    Shards are split across DataLoader workers and read in order, samples are shuffled through a bounded buffer.
+    Args:
+        shard_dir: directory written by write_shards
+        image_size: only used for the augmentation, as in TreeDataset
+        train: yield labels and augment the crops
+        metadata: yield the site of each crop
+        buffer_size: number of samples held for shuffling, 0 or 1 streams in shard order
+        label_rates: optional dict of label -> expected draws per sample and epoch, see balanced_rates
+        seed: base seed of the shard order, the buffer and the draws. Each epoch adds the seed DataLoader gives its workers, or an epoch count without workers
+    """
+    def __init__(self, shard_dir, image_size=10, train=True, metadata=False, buffer_size=1000, label_rates=None, seed=0):
+        self.shard_dir = shard_dir
+        self.shards = shard_paths(shard_dir)
+        self.index = read_index(shard_dir)
+        self.train = train
+        self.metadata = metadata
+        self.buffer_size = buffer_size
+        self.label_rates = label_rates
+        self.seed = seed
+        self.epoch = 0
+        self.transformer = augmentation.train_augmentation(image_size=image_size)
+
+    def __len__(self):
+        """Expected samples per epoch, with label_rates the draws vary around it from epoch to epoch"""
+        if self.label_rates is None:
+            return self.index.shape[0]
+        
+        return int(round(sum([self.label_rates[x] for x in self.index.label])))
+
+    def samples(self, shards, rng):
+        """Samples of the shards in order, each repeated as often as its label rate draws"""
+        for path in shards:
+            with np.load(path) as shard:
+                images, labels, sites, individuals = shard["images"], shard["labels"], shard["sites"], shard["individuals"]
+            for index in range(images.shape[0]):
+                repeats = 1
+                if self.label_rates is not None:
+                    repeats = rng.poisson(self.label_rates[labels[index]])
+                #Copies, so the shuffle buffer doesn't keep whole shards alive
+                for repeat in range(repeats):
+                    yield individuals[index], images[index].copy(), labels[index], sites[index]
+
+    def shuffled(self, samples, rng):
+        """Reservoir of buffer_size samples, each new sample replaces a random one that is yielded"""
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.buffer_size:
+                buffer.append(sample)
+                continue
+            index = rng.integers(len(buffer))
+            yield buffer[index]
+            buffer[index] = sample
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield sample
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers, epoch_seed = 0, 1, self.epoch
+            self.epoch += 1
+        else:
+            #Workers are copies of the dataset, the base seed DataLoader draws for the epoch is shared by all of them
+            worker_id, num_workers, epoch_seed = worker_info.id, worker_info.num_workers, worker_info.seed - worker_info.id
+        
+        #Workers share the shard order of the epoch and each reads every num_workers-th shard
+        order = np.random.default_rng([self.seed, epoch_seed]).permutation(len(self.shards))
+        shards = [self.shards[x] for x in order[worker_id::num_workers]]
+        rng = np.random.default_rng([self.seed, epoch_seed, worker_id])
+
+        samples = self.samples(shards, rng)
+        if self.buffer_size > 1:
+            samples = self.shuffled(samples, rng)
+
+        for individual, image, label, site in samples:
+            inputs = {}
+            image = torch.from_numpy(image)
+            if self.metadata:
+                inputs["site"] = torch.tensor(site, dtype=torch.int)
+            if self.train:
+                inputs["HSI"] = self.transformer(image)
+                yield individual, inputs, torch.tensor(label, dtype=torch.long)
+            else:
+                inputs["HSI"] = image
+                yield individual, inputs
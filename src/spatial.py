@@ -2,7 +2,7 @@
 import numpy as np
 import geopandas as gpd
 from src.patches import crop
-from src.neon_paths import find_sensor_path
+from src.neon_paths import find_sensor_path, TileIndex
 from src.data import preprocess_image
 import torch
 from torchvision import transforms
@@ -14,13 +14,15 @@ def spatial_neighbors(gdf, buffer, data_dir, HSI_pool, model, image_size):
         gdf: a geodataframe
         buffer: distance from focal point in m to search for neighbors
         data_dir: directory where the plot boxes are stored
-        HSI_pool: path to search for sensor path
+        HSI_pool: list of sensor paths, or a neon_paths.TileIndex
         model: a trained main.TreeModel to predict neighbor box scores
         image_size: 
     Returns:
         neighbors: dictionary with keys -> index of the gdf, value of index of neighbors
     """
     model.model.eval()
+    if not isinstance(HSI_pool, TileIndex):
+        HSI_pool = TileIndex(HSI_pool)
     neighbors = {}
     for x in gdf.index:
         geom = gdf[gdf.index==x].geometry.centroid.buffer(buffer).iloc[0]
@@ -2,6 +2,7 @@
 import argparse
 import rasterio as rio
 import json
+import os
 import numpy as np
 from torchvision import transforms
 from sklearn import preprocessing
@@ -47,11 +48,18 @@ def preprocess_image(image, channel_is_first=False):
     
     return normalized
 
-def load_image(img_path, image_size):
-    """Load and preprocess an image for training/prediction"""
-    with warnings.catch_warnings():
-        warnings.simplefilter('ignore', rio.errors.NotGeoreferencedWarning)
-        image = rio.open(img_path).read()       
+def load_image(img_path, image_size, crop_reader=None):
+    """Load and preprocess an image for training/prediction
+    Args:
+        img_path: crop .tif, or the crop_store.crop_path of a crop if crop_reader is given
+        crop_reader: optional crop_store.CropReader, the crop is read from the store by the basename of img_path
+    """
+    if crop_reader is None:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', rio.errors.NotGeoreferencedWarning)
+            image = rio.open(img_path).read()       
+    else:
+        image = crop_reader.read(os.path.basename(img_path))
     image = preprocess_image(image, channel_is_first=True)
     
     #resize image
@@ -4,6 +4,8 @@ from deepforest.main import deepforest
 import geopandas as gpd
 import os
 import glob
+import h5py
+import numpy as np
 import rasterio as rio
 from src import data
 from src.models import Hang2020
@@ -54,6 +56,24 @@ def plot_data(ROOT, sample_crowns):
     
     return plot_data
 
+@pytest.fixture(scope="session")
+def neon_h5(tmpdir_factory):
+    """A small synthetic reflectance tile that follows the NEON .h5 schema"""
+    path = str(tmpdir_factory.mktemp("h5").join("NEON_D01_HARV_DP3_726000_4699000_reflectance.h5"))
+    rows, cols, bands = 27, 10, 426
+    reflectance = np.arange(rows * cols * bands).reshape(rows, cols, bands) % 10000
+    with h5py.File(path, "w") as f:
+        group = f.create_group("HARV/Reflectance")
+        data = group.create_dataset("Reflectance_Data", data=reflectance.astype(np.int16), chunks=(8, 10, bands))
+        data.attrs["Data_Ignore_Value"] = -9999.0
+        data.attrs["Scale_Factor"] = 10000.0
+        group["Metadata/Coordinate_System/EPSG Code"] = np.bytes_("32618")
+        group["Metadata/Coordinate_System/Map_Info"] = np.bytes_("UTM,  1.000,  1.000,  726499.00,  4699073.00,  1.0000000000e+00,  1.0000000000e+00, 18,  North, WGS-84, units=Meters, 0")
+        group["Metadata/Spectral_Data/Wavelength"] = np.linspace(383.9, 2511.9, bands)
+        group["Metadata/Ancillary_Imagery/Smooth_Surface_Elevation"] = np.full((rows, cols), 350.0)
+    
+    return path
+
 #Training module
 @pytest.fixture(scope="session")
 def dead_model_path(ROOT):
@@ -110,6 +130,12 @@ def config(ROOT, dead_model_path):
     config["dead_threshold"] = 1
     config["megaplot_dir"] = None
     config["RGB_crop_dir"] = tempfile.gettempdir()
+    config["file_catalog"] = None
+    config["CHM_cache"] = None
+    config["crown_cache_dir"] = None
+    config["checkpoint_dir"] = None
+    config["crop_store"] = None
+    config["shard_dir"] = None
     
     
     return config
@@ -1,9 +1,92 @@
 #Test CHM height rules
+import os
 import pandas as pd
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.transform import Affine
+from shapely.geometry import box, Point
+from concurrent.futures import ProcessPoolExecutor
 from src import CHM
 
 def test_height_rules():   
     df = pd.DataFrame({"CHM_height":[11,20,5, 0.5, 10, None],"height":[6, 19, 7, 5, None, 10]})
     df = CHM.height_rules(df, min_CHM_height=1, max_CHM_diff=4, CHM_height_limit=8)
     assert df.shape[0] == 3
-    
\ No newline at end of file
+    
+def test_segment_percentiles():
+    labels = np.array([2, 1, 2, 2, 1, 3])
+    values = np.array([5.0, 1.0, 2.0, 9.0, 4.0, 7.0])
+    unique_labels, percentiles = CHM.segment_percentiles(labels, values, quantiles=[50, 99])
+    assert list(unique_labels) == [1, 2, 3]
+    for index, label in enumerate(unique_labels):
+        np.testing.assert_allclose(percentiles[index], np.percentile(values[labels == label], [50, 99]))
+
+def test_zonal_quantiles(tmpdir):
+    path = "{}/CHM.tif".format(tmpdir)
+    height = np.arange(100, dtype=np.float32).reshape(10, 10) / 4
+    with rasterio.open(path, "w", driver="GTiff", height=10, width=10, count=1, dtype="float32", crs="EPSG:32617", transform=Affine.translation(400000, 3280010) * Affine.scale(1, -1), nodata=-9999) as dst:
+        dst.write(height, 1)
+    
+    #Overlapping boxes, a point and a box partly off the tile
+    geoms = gpd.GeoSeries([box(400001, 3280001, 400005, 3280005), box(400003, 3280003, 400008, 3280009), Point(400000.5, 3280009.5), box(399995, 3280000, 400002, 3280003)])
+    result = CHM.zonal_quantiles(geoms, path, quantiles=[50, 99])
+    np.testing.assert_allclose(result.q99[0], np.percentile(height[5:9, 1:5], 99))
+    np.testing.assert_allclose(result.q99[1], np.percentile(height[1:7, 3:8], 99))
+    #The only pixel under the point is ground
+    assert np.isnan(result.q99[2])
+    np.testing.assert_allclose(result.q50[3], np.percentile(height[7:10, 0:2], 50))
+
+def test_CHM_height(tmpdir, capsys):
+    #Two CHM tiles and a plot off both of them
+    for easting in [400000, 401000]:
+        height = np.full((1000, 1000), easting / 100000, dtype=np.float32)
+        with rasterio.open("{}/NEON_D03_OSBS_DP3_{}_3280000_CHM.tif".format(tmpdir, easting), "w", driver="GTiff", height=1000, width=1000, count=1, dtype="float32", crs="EPSG:32617", transform=Affine.translation(easting, 3281000) * Affine.scale(1, -1)) as dst:
+            dst.write(height, 1)
+    points = [Point(400100, 3280100), Point(400900, 3280900), Point(401500, 3280500), Point(402500, 3280500)]
+    shp = gpd.GeoDataFrame({"plotID": ["b", "a", "c", "d"], "height": [np.nan, 3, np.nan, 2]}, geometry=points)
+    serial = CHM.CHM_height(shp, "{}/*.tif".format(tmpdir))
+    assert "plotID d raised" in capsys.readouterr().out
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        parallel = CHM.CHM_height(shp, "{}/*.tif".format(tmpdir), client=executor)
+    pd.testing.assert_frame_equal(serial, parallel)
+    assert list(serial.plotID) == ["a", "b", "c"]
+    np.testing.assert_allclose(serial.CHM_height, [4, 4, 4.01])
+    np.testing.assert_allclose(serial.height, [3, 4, 4.01])
+
+def test_cached_CHM_height(tmpdir, capsys):
+    path = "{}/CHM.tif".format(tmpdir)
+    height = np.arange(100, dtype=np.float32).reshape(10, 10) / 4
+    with rasterio.open(path, "w", driver="GTiff", height=10, width=10, count=1, dtype="float32", crs="EPSG:32617", transform=Affine.translation(400000, 3280010) * Affine.scale(1, -1)) as dst:
+        dst.write(height, 1)
+    geoms = gpd.GeoSeries([box(400001, 3280001, 400005, 3280005), Point(400000.5, 3280009.5)])
+    cache_path = "{}/cache.sqlite".format(tmpdir)
+    
+    expected = CHM.cached_CHM_height(geoms, path)
+    np.testing.assert_array_equal(CHM.cached_CHM_height(geoms, path, cache_path), expected)
+    assert "0 hits, 2 misses" in capsys.readouterr().out
+    np.testing.assert_array_equal(CHM.cached_CHM_height(geoms, path, cache_path), expected)
+    assert "2 hits, 0 misses" in capsys.readouterr().out
+    
+    #A reprocessed tile is computed again
+    os.utime(path, (0, 0))
+    CHM.cached_CHM_height(geoms, path, cache_path)
+    assert "0 hits, 2 misses" in capsys.readouterr().out
+
+def test_cached_CHM_height_concurrent(tmpdir):
+    path = "{}/CHM.tif".format(tmpdir)
+    height = np.arange(10000, dtype=np.float32).reshape(100, 100) / 400
+    with rasterio.open(path, "w", driver="GTiff", height=100, width=100, count=1, dtype="float32", crs="EPSG:32617", transform=Affine.translation(400000, 3280100) * Affine.scale(1, -1)) as dst:
+        dst.write(height, 1)
+    cache_path = "{}/cache.sqlite".format(tmpdir)
+    
+    #Two workers write the cache at the same time
+    batches = [gpd.GeoSeries([box(400000 + x, 3280000 + y, 400002 + x, 3280002 + y) for x in range(0, 98, 2) for y in range(start, 98, 4)]) for start in [0, 2]]
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        heights = list(executor.map(CHM.cached_CHM_height, batches, [path] * 2, [cache_path] * 2))
+    for batch, batch_heights in zip(batches, heights):
+        np.testing.assert_array_equal(batch_heights, CHM.cached_CHM_height(batch, path))
+    
+    connection = CHM.connect_cache(cache_path)
+    assert connection.execute("SELECT COUNT(*) FROM CHM_heights").fetchone()[0] == sum(len(x) for x in batches)
+    connection.close()
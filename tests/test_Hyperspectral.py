@@ -0,0 +1,141 @@
+#test Hyperspectral
+from src import Hyperspectral
+import glob
+import os
+import shutil
+import numpy as np
+import rasterio
+import h5py
+
+def test_h5_metadata(neon_h5):
+    metadata, refl = Hyperspectral.h5refl2array(neon_h5)
+    assert metadata["shape"] == refl.shape
+    assert metadata["epsg"] == "32618"
+    assert metadata["extent"] == (726499.0, 726509.0, 4699046.0, 4699073.0)
+
+def test_generate_raster(neon_h5, tmpdir):
+    tilename = Hyperspectral.generate_raster(h5_path=neon_h5, save_dir=tmpdir, rgb_filename="2019_HARV_6_726000_4699000_image.tif")
+    src = rasterio.open("{}/{}".format(tmpdir, tilename))
+    assert src.count == 369
+    assert src.shape == (27, 10)
+
+def test_generate_raster_streaming(neon_h5, tmpdir):
+    in_memory = tmpdir.mkdir("in_memory")
+    streamed = tmpdir.mkdir("streamed")
+    tilename = Hyperspectral.generate_raster(h5_path=neon_h5, save_dir=in_memory, rgb_filename="2019_HARV_6_726000_4699000_image.tif")
+    Hyperspectral.generate_raster(h5_path=neon_h5, save_dir=streamed, rgb_filename="2019_HARV_6_726000_4699000_image.tif", block_rows=5)
+    a = rasterio.open("{}/{}".format(in_memory, tilename))
+    b = rasterio.open("{}/{}".format(streamed, tilename))
+    assert a.profile == b.profile
+    np.testing.assert_array_equal(a.read(), b.read())
+
+def test_H5Reader(neon_h5, tmpdir):
+    tilename = Hyperspectral.generate_raster(h5_path=neon_h5, save_dir=tmpdir, rgb_filename="2019_HARV_6_726000_4699000_image.tif")
+    tif = rasterio.open("{}/{}".format(tmpdir, tilename))
+    with Hyperspectral.H5Reader(neon_h5) as h5:
+        assert h5.transform == tif.transform
+        assert h5.bounds == tif.bounds
+        assert h5.count == tif.count
+        #Fractional and partially outside windows
+        for bounds in [(726500.3, 4699050.2, 726504.6, 4699055.9), (726497.0, 4699060.0, 726502.5, 4699075.0)]:
+            window = rasterio.windows.from_bounds(*bounds, transform=tif.transform)
+            np.testing.assert_array_equal(h5.read(window=window), tif.read(window=window))
+
+def test_generate_raster_tiled(neon_h5, tmpdir):
+    striped = tmpdir.mkdir("striped")
+    tiled = tmpdir.mkdir("tiled")
+    tilename = Hyperspectral.generate_raster(h5_path=neon_h5, save_dir=striped, rgb_filename="2019_HARV_6_726000_4699000_image.tif")
+    layout = dict(Hyperspectral.COG_LAYOUT)
+    layout["blocksize"] = 16
+    layout["overviews"] = [2]
+    Hyperspectral.generate_raster(h5_path=neon_h5, save_dir=tiled, rgb_filename="2019_HARV_6_726000_4699000_image.tif", block_rows=5, layout=layout)
+    a = rasterio.open("{}/{}".format(striped, tilename))
+    b = rasterio.open("{}/{}".format(tiled, tilename))
+    assert b.profile["tiled"]
+    assert b.profile["blockxsize"] == 16
+    assert b.compression.value == "DEFLATE"
+    assert b.overviews(1) == [2]
+    np.testing.assert_array_equal(a.read(), b.read())
+
+def test_stream_raster_strips(neon_h5, tmpdir, monkeypatch):
+    #Rechunk to 12 rows, strips hold whole h5 chunks and whole rows of 16 row tiles
+    h5_path = str(tmpdir.join(os.path.basename(neon_h5)))
+    shutil.copy(neon_h5, h5_path)
+    with h5py.File(h5_path, "a") as f:
+        refl = f["HARV/Reflectance/Reflectance_Data"]
+        data, attrs = refl[:], dict(refl.attrs)
+        del f["HARV/Reflectance/Reflectance_Data"]
+        refl = f["HARV/Reflectance"].create_dataset("Reflectance_Data", data=data, chunks=(12, data.shape[1], data.shape[2]))
+        refl.attrs.update(attrs)
+    
+    strips = []
+    read_bands = Hyperspectral.read_bands
+    def record(refl, rows, cols, band_index):
+        strips.append(rows)
+        return read_bands(refl, rows, cols, band_index)
+    monkeypatch.setattr(Hyperspectral, "read_bands", record)
+    layout = dict(Hyperspectral.COG_LAYOUT)
+    layout["blocksize"] = 16
+    Hyperspectral.generate_raster(h5_path=h5_path, save_dir=tmpdir, rgb_filename="2019_HARV_6_726000_4699000_image.tif", block_rows=5, layout=layout)
+    assert [(x.start, x.stop) for x in strips] == [(0, 27)]
+
+def test_band_bins():
+    band_index = Hyperspectral.select_bands("no_water")
+    assert len(Hyperspectral.band_bins(band_index, 2)) == 185
+    assert len(Hyperspectral.band_bins(band_index, 4)) == 93
+    assert Hyperspectral.band_count() == 369
+    assert Hyperspectral.band_count(bin_size=2) == 185
+
+def test_hyperspectral_suffix(tmpdir):
+    rgb_path = "2019_HARV_6_726000_4699000_image.tif"
+    for bin_size in [1, 2]:
+        tmpdir.join(Hyperspectral.hyperspectral_name(rgb_path, bin_size)).ensure()
+    
+    #A pool of one bin size never picks up the tiles of another
+    for bin_size in [1, 2]:
+        pool = glob.glob("{}/*{}".format(tmpdir, Hyperspectral.hyperspectral_suffix(bin_size)))
+        assert [os.path.basename(x) for x in pool] == [Hyperspectral.hyperspectral_name(rgb_path, bin_size)]
+
+def test_generate_raster_binned(neon_h5, tmpdir):
+    in_memory = tmpdir.mkdir("in_memory")
+    streamed = tmpdir.mkdir("streamed")
+    tilename = Hyperspectral.generate_raster(h5_path=neon_h5, save_dir=in_memory, rgb_filename="2019_HARV_6_726000_4699000_image.tif", bin_size=2)
+    Hyperspectral.generate_raster(h5_path=neon_h5, save_dir=streamed, rgb_filename="2019_HARV_6_726000_4699000_image.tif", block_rows=5, bin_size=2)
+    a = rasterio.open("{}/{}".format(in_memory, tilename))
+    b = rasterio.open("{}/{}".format(streamed, tilename))
+    assert tilename == "2019_HARV_6_726000_4699000_image_hyperspectral_bin2.tif"
+    assert a.count == 185
+    assert a.tags()["bands"] == "185"
+    assert a.tags()["bin_size"] == "2"
+    np.testing.assert_array_equal(a.read(), b.read())
+    
+    #First bin is the mean of the first two bands
+    metadata, refl = Hyperspectral.h5refl2array(neon_h5)
+    expected = np.round(refl[:, :, :2].astype(np.float32).mean(axis=2)).astype(refl.dtype)
+    np.testing.assert_array_equal(a.read(1), expected)
+
+def test_select_bands_wavelength(neon_h5):
+    metadata, refl = Hyperspectral.h5refl2array(neon_h5)
+    vnir = Hyperspectral.select_bands("vnir", metadata["wavelength"])
+    assert metadata["wavelength"][vnir].max() <= 1000
+    assert metadata["wavelength"][vnir].min() >= 380
+    ranges = Hyperspectral.select_bands([(400, 450), (800, 810)], metadata["wavelength"])
+    assert np.all(np.diff(ranges) > 0)
+
+def test_read_bands(tmpdir):
+    data = np.arange(6 * 5 * 20, dtype=np.int16).reshape(6, 5, 20)
+    band_index = np.array([1, 2, 3, 9, 15, 16])
+    for chunks in [None, (2, 2, 20), (2, 2, 4)]:
+        with h5py.File("{}/bands.h5".format(tmpdir), "w") as f:
+            dataset = f.create_dataset("refl", data=data, chunks=chunks)
+            block = Hyperspectral.read_bands(dataset, slice(1, 4), slice(0, 10), band_index)
+        np.testing.assert_array_equal(block, data[1:4, 0:10, band_index])
+
+def test_generate_raster_vnir(neon_h5, tmpdir):
+    tilename = Hyperspectral.generate_raster(h5_path=neon_h5, save_dir=tmpdir, rgb_filename="2019_HARV_6_726000_4699000_image.tif", bands="vnir")
+    assert tilename == "2019_HARV_6_726000_4699000_image_hyperspectral_vnir.tif"
+    metadata, refl = Hyperspectral.h5refl2array(neon_h5)
+    band_index = Hyperspectral.select_bands("vnir", metadata["wavelength"])
+    src = rasterio.open("{}/{}".format(tmpdir, tilename))
+    assert src.count == len(band_index)
+    np.testing.assert_array_equal(src.read(), np.moveaxis(refl[:, :, band_index], 2, 0))
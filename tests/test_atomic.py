@@ -0,0 +1,34 @@
+#Test atomic writes
+import os
+import pytest
+from src.atomic import atomic_write
+
+def test_atomic_write(tmpdir):
+    path = "{}/index.csv".format(tmpdir)
+    with atomic_write(path, suffix=".csv") as tmp_path:
+        assert not tmp_path == path
+        with open(tmp_path, "w") as f:
+            f.write("a,b\n")
+    with open(path) as f:
+        assert f.read() == "a,b\n"
+
+    #A failed write leaves the previous file and no temporary file
+    with pytest.raises(ValueError):
+        with atomic_write(path, suffix=".csv") as tmp_path:
+            with open(tmp_path, "w") as f:
+                f.write("partial")
+            raise ValueError()
+    with open(path) as f:
+        assert f.read() == "a,b\n"
+    assert os.listdir(tmpdir) == ["index.csv"]
+
+def test_atomic_write_directory(tmpdir):
+    path = "{}/tile.cube".format(tmpdir)
+    os.makedirs(path)
+    with open("{}/old".format(path), "w") as f:
+        f.write("old")
+    with atomic_write(path, directory=True) as tmp_path:
+        with open("{}/new".format(tmp_path), "w") as f:
+            f.write("new")
+    assert os.listdir(path) == ["new"]
+    assert os.listdir(tmpdir) == ["tile.cube"]
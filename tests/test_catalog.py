@@ -0,0 +1,87 @@
+#test tile catalog
+from src import catalog
+from src import Hyperspectral
+from src import neon_paths
+import glob
+import os
+import rasterio
+import sqlite3
+import numpy as np
+
+def test_build_catalog(tmpdir, ROOT, neon_h5):
+    catalog_path = "{}/catalog.sqlite".format(tmpdir)
+    pools = {"RGB": "{}/tests/data/*.tif".format(ROOT), "HSI": neon_h5}
+    counts = catalog.build_catalog(catalog_path, pools)
+    assert counts["added"] > 1
+    
+    hsi = catalog.tile_metadata(catalog_path, neon_h5)
+    assert hsi["bands"] == 426
+    assert hsi["geo_index"] == "726000_4699000"
+    assert len(hsi["wavelengths"]) == 426
+    assert neon_paths.elevation_from_tile(neon_h5, tile_catalog=catalog_path) == 350
+    
+    rgb = catalog.query(catalog_path, sensor="RGB", year=2019)
+    assert not rgb.empty
+    
+    #Only changed files are read again
+    os.utime(neon_h5, (0, 0))
+    counts = catalog.build_catalog(catalog_path, pools)
+    assert counts["updated"] == 1
+    assert counts["added"] == 0
+
+def test_convert_h5_tile_catalog(tmpdir, neon_h5, monkeypatch):
+    rgb_path = "2019_HARV_6_726000_4699000_image.tif"
+    expected = neon_paths.convert_h5(neon_h5, rgb_path, tmpdir.mkdir("header"))
+    catalog_path = "{}/catalog.sqlite".format(tmpdir)
+    catalog.build_catalog(catalog_path, {"HSI": neon_h5})
+    
+    #The .h5 header is not read when the tile is in the catalog
+    def h5_metadata(hdf5_file):
+        raise AssertionError("read the .h5 header")
+    monkeypatch.setattr(Hyperspectral, "h5_metadata", h5_metadata)
+    tif_path = neon_paths.convert_h5(neon_h5, rgb_path, tmpdir.mkdir("catalog"), tile_catalog=catalog_path)
+    with rasterio.open(expected) as a, rasterio.open(tif_path) as b:
+        assert a.transform == b.transform
+        assert a.crs == b.crs
+        np.testing.assert_array_equal(a.read(), b.read())
+        assert a.tags()["wavelength"] == b.tags()["wavelength"]
+
+def test_find_files(tmpdir):
+    catalog_path = "{}/catalog.sqlite".format(tmpdir)
+    root = tmpdir.mkdir("NeonData")
+    for path in ["HARV/2019/Camera/a.tif", "HARV/2019/Camera/nested/b.tif", "HARV/2019/Reflectance/c.h5", "OSBS/d.tif"]:
+        root.join(path).ensure()
+    for pattern in ["{}/*/2019/**/*.tif".format(root), "{}/**/*.tif".format(root), "{}/HARV/*/Reflectance/*.h5".format(root)]:
+        assert sorted(catalog.find_files(pattern, catalog_path)) == sorted(glob.glob(pattern, recursive=True))
+    
+    #New files are picked up by a refresh, only the changed directory is listed again
+    root.join("OSBS/e.tif").ensure()
+    pattern = "{}/**/*.tif".format(root)
+    assert len(catalog.find_files(pattern, catalog_path, max_age=3600)) == 3
+    assert sorted(catalog.find_files(pattern, catalog_path, max_age=0)) == sorted(glob.glob(pattern, recursive=True))
+    
+    root.join("HARV/2019/Camera/nested").remove()
+    assert sorted(catalog.find_files(pattern, catalog_path, max_age=0)) == sorted(glob.glob(pattern, recursive=True))
+
+def test_find_files_relative(tmpdir, monkeypatch):
+    catalog_path = "{}/catalog.sqlite".format(tmpdir)
+    tmpdir.join("tiles/a.tif").ensure()
+    monkeypatch.chdir(tmpdir)
+    assert catalog.find_files("tiles/*.tif", catalog_path) == glob.glob("tiles/*.tif") == ["tiles/a.tif"]
+    assert catalog.pattern_root(os.path.join(str(tmpdir), "*.tif")) == str(tmpdir)
+
+def test_find_files_walk_unlocked(tmpdir, monkeypatch):
+    catalog_path = "{}/catalog.sqlite".format(tmpdir)
+    tmpdir.join("tiles/a.tif").ensure()
+    catalog.connect(catalog_path).close()
+    
+    #Other workers can write to the catalog while the filesystem is walked
+    walk = catalog.walk
+    def walk_and_write(*args):
+        connection = sqlite3.connect(catalog_path, timeout=0)
+        connection.execute("BEGIN IMMEDIATE")
+        connection.rollback()
+        connection.close()
+        return walk(*args)
+    monkeypatch.setattr(catalog, "walk", walk_and_write)
+    assert catalog.find_files("{}/tiles/*.tif".format(tmpdir), catalog_path) == ["{}/tiles/a.tif".format(tmpdir)]
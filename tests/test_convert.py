@@ -0,0 +1,28 @@
+#test site conversion
+from src import convert
+import os
+import rasterio
+
+def test_match_tiles(neon_h5):
+    rgb_pool = ["/NeonData/HARV/DP3.30010.001/2019/FullSite/D01/2019_HARV_6/L3/Camera/Mosaic/2019_HARV_6_726000_4699000_image.tif",
+                "/NeonData/HARV/DP3.30010.001/2019/FullSite/D01/2019_HARV_6/L3/Camera/Mosaic/2019_HARV_6_727000_4699000_image.tif"]
+    hyperspectral_pool = ["/NeonData/HARV/DP3.30006.001/2019/FullSite/D01/2019_HARV_6/L3/Spectrometer/Reflectance/NEON_D01_HARV_DP3_726000_4699000_reflectance.h5"]
+    tiles = convert.match_tiles(rgb_pool, hyperspectral_pool, site="HARV", year="2019")
+    assert tiles == [(hyperspectral_pool[0], rgb_pool[0])]
+    assert convert.match_tiles(rgb_pool, hyperspectral_pool, year="2018") == []
+
+def test_convert_tiles(neon_h5, tmpdir):
+    tiles = [(neon_h5, "2019_HARV_6_726000_4699000_image.tif")]
+    converted = convert.convert_tiles(tiles, savedir=tmpdir, workers=1, memory=1)
+    assert len(converted) == 1
+    assert rasterio.open(converted[0]).count == 369
+    assert not any([x.startswith(".convert_") for x in os.listdir(tmpdir)])
+    
+    #Completed tiles are skipped on restart
+    assert convert.convert_tiles(tiles, savedir=tmpdir, workers=1) == []
+    
+    #Binned tiles are written next to, not over, the full band tile
+    binned = convert.convert_tiles(tiles, savedir=tmpdir, workers=1, memory=1, bin_size=2)
+    assert binned[0].endswith("_hyperspectral_bin2.tif")
+    assert rasterio.open(binned[0]).count == 185
+    assert rasterio.open(converted[0]).count == 369
@@ -0,0 +1,42 @@
+#Test crop store
+import os
+import pickle
+import numpy as np
+from src import crop_store
+
+def test_write_shard(tmpdir):
+    crops = [np.arange(3 * 4 * 5, dtype=np.int16).reshape(3, 4, 5), np.ones((3, 2, 2), dtype=np.int16)]
+    bounds = np.array([[0, 0, 5, 4], [10, 10, 12, 12]])
+    crop_store.write_shard(tmpdir, "726000_4699000", crops, ["a", "b"], "tile.tif", bounds)
+    reader = crop_store.CropReader(tmpdir)
+    assert len(reader) == 2
+    assert np.array_equal(reader.read("a"), crops[0])
+    assert np.array_equal(reader.read("b"), crops[1])
+    assert isinstance(reader.read("a").base, np.memmap)
+
+def test_consolidate(tmpdir):
+    first = [np.full((2, 3, 3), x, dtype=np.int16) for x in range(3)]
+    crop_store.write_shard(tmpdir, "726000_4699000", first, ["a", "b", "c"], "tile.tif", np.zeros((3, 4)))
+    index = crop_store.consolidate(tmpdir)
+    assert set(index.individual) == {"a", "b", "c"}
+    assert os.listdir("{}/shards".format(tmpdir)) == []
+
+    #Appending after consolidation, the newest crop of an individual wins
+    second = [np.full((2, 4, 4), 9, dtype=np.int16), np.full((2, 1, 1), 7, dtype=np.int16)]
+    crop_store.write_shard(tmpdir, "727000_4699000", second, ["c", "d"], "tile.tif", np.zeros((2, 4)))
+    reader = crop_store.CropReader(tmpdir)
+    assert np.array_equal(reader.read("c"), second[0])
+    index = crop_store.consolidate(tmpdir)
+    
+    #The replaced crop of c is compacted away
+    data_file = "{}/{}".format(tmpdir, index["file"].iloc[0])
+    assert index["file"].nunique() == 1
+    assert os.path.getsize(data_file) == sum(x.nbytes for x in first[:2] + second)
+    assert not os.path.exists("{}/{}".format(tmpdir, crop_store.DATA))
+
+    #Readers are pickled to DataLoader workers without their memory maps
+    reader = pickle.loads(pickle.dumps(crop_store.CropReader(tmpdir)))
+    assert len(reader) == 4
+    assert np.array_equal(reader.read("b"), first[1])
+    assert np.array_equal(reader.read("c"), second[0])
+    assert np.array_equal(reader.read(os.path.basename(crop_store.crop_path(str(tmpdir), "d"))), second[1])
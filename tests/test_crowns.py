@@ -0,0 +1,42 @@
+#Test crown cache
+import os
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from src import crowns
+from deepforest import main
+
+@pytest.fixture(scope="module")
+def deepforest_model():
+    m = main.deepforest()
+    m.use_release(check_release=False)
+
+    return m
+
+def test_tile_crowns(tmpdir, rgb_path, deepforest_model, monkeypatch):
+    boxes = crowns.tile_crowns(rgb_path, deepforest_model, cache_dir=tmpdir)
+    assert not boxes.empty
+    assert boxes.crs is not None
+    assert os.path.exists(crowns.cache_path(tmpdir, rgb_path, crowns.model_release(deepforest_model)))
+
+    #The second call is served from the cache
+    def fail(*args, **kwargs):
+        raise AssertionError("detection ran for a cached tile")
+    monkeypatch.setattr(crowns, "detect_tile", fail)
+    cached = crowns.tile_crowns(rgb_path, deepforest_model, cache_dir=tmpdir)
+    assert cached.shape[0] == boxes.shape[0]
+    assert np.allclose(cached.total_bounds, boxes.total_bounds)
+
+def test_window_crowns():
+    geometry = [shapely.geometry.box(x, 0, x + 2, 2) for x in range(0, 20, 4)]
+    tile_boxes = gpd.GeoDataFrame(pd.DataFrame({"score": np.linspace(0.5, 0.9, 5), "box_id": np.arange(5)}), geometry=geometry, crs="EPSG:32617")
+    neighbor = gpd.GeoDataFrame(pd.DataFrame({"score": [0.6], "box_id": [0]}), geometry=[shapely.geometry.box(21, 0, 23, 2)], crs="EPSG:32617")
+
+    boxes = crowns.window_crowns([tile_boxes, neighbor], bounds=(7, 0, 22, 2))
+    assert boxes.shape[0] == 4
+    assert list(boxes.box_id) == [0, 1, 2, 3]
+    assert boxes.crs == tile_boxes.crs
+
+    assert crowns.window_crowns([tile_boxes], bounds=(100, 100, 110, 110)) is None
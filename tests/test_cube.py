@@ -0,0 +1,25 @@
+#test chunked cube store
+from src import cube
+from src import Hyperspectral
+from src import patches
+import numpy as np
+import rasterio
+
+def test_h5_to_cube(neon_h5, tmpdir):
+    cubename = cube.h5_to_cube(neon_h5, save_dir=tmpdir, rgb_filename="2019_HARV_6_726000_4699000_image.tif", chunk_size=8)
+    reader = cube.CubeReader("{}/{}".format(tmpdir, cubename))
+    with Hyperspectral.H5Reader(neon_h5) as h5:
+        assert reader.transform == h5.transform
+        assert reader.bounds == h5.bounds
+        assert reader.count == 369
+        np.testing.assert_array_equal(reader.read(), h5.read())
+        #Windows that straddle chunks and the tile edge
+        for bounds in [(726500.3, 4699050.2, 726507.6, 4699065.9), (726497.0, 4699060.0, 726502.5, 4699075.0)]:
+            window = rasterio.windows.from_bounds(*bounds, transform=h5.transform)
+            np.testing.assert_array_equal(reader.read(window=window), h5.read(window=window))
+    reader.close()
+    
+def test_crop_cube(neon_h5, tmpdir):
+    cubename = cube.h5_to_cube(neon_h5, save_dir=tmpdir, rgb_filename="2019_HARV_6_726000_4699000_image.tif")
+    img = patches.crop(bounds=(726500.3, 4699050.2, 726504.6, 4699055.9), sensor_path="{}/{}".format(tmpdir, cubename))
+    assert img.shape == (369, 6, 4)
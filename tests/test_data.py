@@ -29,3 +29,9 @@ def test_TreeDataset(dm, config,tmpdir, ROOT):
     annotations = pd.read_csv("{}/tests/data/processed/test.csv".format(ROOT))
     
     assert len(data_loader) == annotations.shape[0]
+
+def test_TreeDataset_old_config(dm, config, ROOT):
+    #Configs written before the crop store have no crop_store key
+    old_config = {key: value for key, value in config.items() if not key == "crop_store"}
+    data_loader = data.TreeDataset(csv_file="{}/tests/data/processed/train.csv".format(ROOT), config=old_config, image_size=config["image_size"])
+    assert data_loader.crop_reader is None
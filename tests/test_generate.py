@@ -1,8 +1,15 @@
 #Test generate
 from src import generate
+from src import crop_store
+from src import partitions
 import glob
+import numpy as np
+import os
 import geopandas as gpd
 import pandas as pd
+import pytest
+import rasterio
+import shapely
 from deepforest import main
 
 def test_predict_trees(rgb_path, plot_data):
@@ -11,6 +18,33 @@ def test_predict_trees(rgb_path, plot_data):
     boxes = generate.predict_trees(deepforest_model=m, rgb_path=rgb_path, bounds=plot_data.total_bounds)
     assert not boxes.empty 
 
+def test_predict_batch(rgb_path):
+    m = main.deepforest()
+    m.use_release(check_release=False)
+    img = rasterio.open(rgb_path).read()
+    images = [img[:, :200, :200], img[:, 100:300, 50:250], img[:, :150, :300], img[:, :0, :0]]
+    results = generate.predict_batch(m, images)
+    assert results[3] is None
+    
+    #Same boxes as deepforest predicting each image on its own
+    for image, boxes in zip(images[:3], results[:3]):
+        expected = m.predict_image(image=np.rollaxis(image, 0, 3).astype("float32"), return_plot=False)
+        pd.testing.assert_frame_equal(boxes, expected)
+
+def test_predict_trees_batch(rgb_path, plot_data):
+    m = main.deepforest()
+    m.use_release(check_release=False)
+    bounds = plot_data.total_bounds
+    shifted = bounds + [10, 10, 10, 10]
+    results = generate.predict_trees_batch(deepforest_model=m, windows=[(rgb_path, bounds), (rgb_path, shifted), (rgb_path, bounds)], batch_size=2)
+    assert len(results) == 3
+    
+    #Same boxes as a window predicted on its own
+    boxes = generate.predict_trees(deepforest_model=m, rgb_path=rgb_path, bounds=bounds)
+    assert results[0].shape[0] == boxes.shape[0]
+    assert results[0].total_bounds == pytest.approx(boxes.total_bounds, abs=0.5)
+    assert results[2].shape[0] == boxes.shape[0]
+
 def test_empty_plot(rgb_path, plot_data):
     #DeepForest prediction
     deepforest_model = main.deepforest()
@@ -29,18 +63,28 @@ def test_empty_plot(rgb_path, plot_data):
     merged_boxes= generate.create_boxes(plot_data)
         
     #If there are multiple boxes, take the center box
-    grouped = merged_boxes.groupby("individual")
-    
-    cleaned_boxes = []
-    for value, group in grouped:
-        choosen_box = generate.choose_box(group, plot_data)
-        cleaned_boxes.append(choosen_box)
-    
-    merged_boxes = gpd.GeoDataFrame(pd.concat(cleaned_boxes),crs=merged_boxes.crs)
+    merged_boxes = generate.associate_boxes(merged_boxes, plot_data)
     merged_boxes = merged_boxes.drop(columns=["xmin","xmax","ymin","ymax"])
     
     assert not merged_boxes.empty
     
+def test_associate_boxes():
+    stems = gpd.GeoDataFrame({
+        "individual": ["a", "b", "c"], "plotID": "PLOT_1", "height": [10, 20, 15], "CHM_height": [11, 19, 14]},
+        geometry=gpd.points_from_xy([1, 5, 20], [1, 5, 20]), crs="EPSG:32617")
+    boxes = gpd.GeoDataFrame({"box_id": [0, 1, 2], "xmin": 0, "xmax": 0, "ymin": 0, "ymax": 0},
+        geometry=[shapely.geometry.box(0, 0, 6, 6), shapely.geometry.box(0, 0, 3, 3), shapely.geometry.box(18, 18, 22, 22)], crs="EPSG:32617")
+    merged_boxes = gpd.sjoin(boxes, stems)
+    associated = generate.associate_boxes(merged_boxes, stems)
+    
+    #a takes the closer box 1, b and c keep their only boxes
+    assert associated.set_index("individual").box_id.to_dict() == {"a": 1, "b": 0, "c": 2}
+    
+    #Stems that share a box keep the tallest
+    shared = merged_boxes[merged_boxes.box_id == 0]
+    associated = generate.associate_boxes(shared, stems)
+    assert list(associated.individual) == ["b"]
+
 def test_process_plot(rgb_pool, sample_crowns):
     df = gpd.read_file(sample_crowns)
     deepforest_model = main.deepforest()
@@ -63,6 +107,18 @@ def test_run(tmpdir, sample_crowns, rgb_pool):
     
     assert len(glob.glob("{}/*.shp".format(tmpdir))) > 0
 
+def test_load_deepforest():
+    #Loaded once per process
+    assert generate.load_deepforest() is generate.load_deepforest()
+
+def test_run_tile(tmpdir, sample_crowns, rgb_pool):
+    df = gpd.read_file(sample_crowns)
+    plots = list(df.plotID.unique())
+    results = generate.run_tile(plots=plots, df=df, rgb_pool=rgb_pool, savedir=tmpdir, raw_box_savedir=None, batch_size=2)
+    
+    assert 0 < len(results) <= len(plots)
+    assert len(glob.glob("{}/*.shp".format(tmpdir))) == len(results)
+
 def test_generate_crops(tmpdir, ROOT, rgb_path):
     data_path = "{}/tests/data/crown.shp".format(ROOT)
     gdf = gpd.read_file(data_path)
@@ -73,4 +129,61 @@ def test_generate_crops(tmpdir, ROOT, rgb_path):
     
     assert not annotations.empty
     assert all([x in ["image_path","label","site","siteID","plotID","individualID","taxonID","point_id","box_id","RGB_tile"] for x in annotations.columns])
-    assert len(annotations.box_id.unique()) == annotations.shape[0]
\ No newline at end of file
+    assert len(annotations.box_id.unique()) == annotations.shape[0]
+
+def test_generate_crops_checkpoint(tmpdir, ROOT, rgb_path, monkeypatch):
+    data_path = "{}/tests/data/crown.shp".format(ROOT)
+    gdf = gpd.read_file(data_path)
+    gdf["RGB_tile"] = rgb_path
+    checkpoint_dir = "{}/checkpoint".format(tmpdir)
+    annotations = generate.generate_crops(
+        gdf=gdf, rgb_glob="{}/tests/data/*.tif".format(ROOT),
+        convert_h5=False, sensor_glob="{}/tests/data/*.tif".format(ROOT), savedir=tmpdir, checkpoint_dir=checkpoint_dir)
+    assert not annotations.empty
+    
+    #A restart reads finished tiles back without cropping again
+    def fail(*args, **kwargs):
+        raise AssertionError("a finished tile was cropped again")
+    monkeypatch.setattr(generate, "write_tile_crops", fail)
+    resumed = generate.generate_crops(
+        gdf=gdf, rgb_glob="{}/tests/data/*.tif".format(ROOT),
+        convert_h5=False, sensor_glob="{}/tests/data/*.tif".format(ROOT), savedir=tmpdir, checkpoint_dir=checkpoint_dir)
+    assert resumed.shape[0] == annotations.shape[0]
+
+def test_generate_crops_checkpoint_replace(tmpdir, ROOT, rgb_path, monkeypatch):
+    data_path = "{}/tests/data/crown.shp".format(ROOT)
+    gdf = gpd.read_file(data_path)
+    gdf["RGB_tile"] = rgb_path
+    checkpoint_dir = "{}/checkpoint".format(tmpdir)
+    partitions.reset(checkpoint_dir)
+    annotations = generate.generate_crops(
+        gdf=gdf, rgb_glob="{}/tests/data/*.tif".format(ROOT),
+        convert_h5=False, sensor_glob="{}/tests/data/*.tif".format(ROOT), savedir=tmpdir, checkpoint_dir=checkpoint_dir)
+    
+    #A replace run crops the checkpointed tiles again
+    cropped = []
+    write_tile_crops = generate.write_tile_crops
+    def count(*args, **kwargs):
+        cropped.append(kwargs["key"])
+        return write_tile_crops(*args, **kwargs)
+    monkeypatch.setattr(generate, "write_tile_crops", count)
+    partitions.reset(checkpoint_dir, replace=True)
+    replaced = generate.generate_crops(
+        gdf=gdf, rgb_glob="{}/tests/data/*.tif".format(ROOT),
+        convert_h5=False, sensor_glob="{}/tests/data/*.tif".format(ROOT), savedir=tmpdir, checkpoint_dir=checkpoint_dir)
+    assert len(cropped) == len(partitions.completed(checkpoint_dir)) > 0
+    assert replaced.shape[0] == annotations.shape[0]
+
+def test_generate_crops_store(tmpdir, ROOT, rgb_path):
+    data_path = "{}/tests/data/crown.shp".format(ROOT)
+    gdf = gpd.read_file(data_path)
+    gdf["RGB_tile"] = rgb_path
+    store = "{}/crop_store".format(tmpdir)
+    annotations = generate.generate_crops(
+        gdf=gdf, rgb_glob="{}/tests/data/*.tif".format(ROOT),
+        convert_h5=False, sensor_glob="{}/tests/data/*.tif".format(ROOT), savedir=tmpdir, crop_store=store)
+    
+    reader = crop_store.CropReader(store)
+    assert len(reader) == annotations.shape[0]
+    assert len(glob.glob("{}/*.tif".format(tmpdir))) == 0
+    assert reader.read(os.path.basename(annotations.image_path.iloc[0])).shape[0] == 3
@@ -0,0 +1,61 @@
+#test mosaic
+from src import mosaic
+from src import patches
+from src import predict
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.transform import Affine
+import pytest
+from shapely.geometry import box
+
+def write_tile(path, data, left, top):
+    transform = Affine.translation(left, top) * Affine.scale(1, -1)
+    with rasterio.open(path, "w", driver="GTiff", height=data.shape[1], width=data.shape[2], count=data.shape[0], dtype=data.dtype, crs="EPSG:32618", transform=transform) as dst:
+        dst.write(data)
+
+@pytest.fixture()
+def tiles(tmpdir):
+    """Four 10 x 10 tiles around the corner of four 1km tiles, and a single raster of the same area to compare against"""
+    data = np.arange(3 * 20 * 20, dtype=np.int16).reshape(3, 20, 20)
+    write_tile("{}/reference.tif".format(tmpdir), data, 726990, 4699010)
+    paths = []
+    for row, northing in [(0, 4699000), (10, 4698000)]:
+        for col, easting in [(0, 726000), (10, 727000)]:
+            path = "{}/2019_HARV_6_{}_{}_image.tif".format(tmpdir, easting, northing)
+            write_tile(path, data[:, row:row + 10, col:col + 10], 726990 + col, 4699010 - row)
+            paths.append(path)
+    
+    return paths, "{}/reference.tif".format(tmpdir)
+
+def test_read_bounds(tiles):
+    paths, reference = tiles
+    src = rasterio.open(reference)
+    with mosaic.MosaicReader(paths) as reader:
+        for bounds in [(726995, 4699002, 727004, 4699006), (726995.4, 4698996.2, 727003.7, 4699004.9), (726992, 4699002, 726998, 4699008), (726985, 4698995, 727005, 4699015)]:
+            expected = src.read(window=rasterio.windows.from_bounds(*bounds, transform=src.transform))
+            np.testing.assert_array_equal(reader.read_bounds(bounds), expected)
+            np.testing.assert_array_equal(patches.crop(bounds=bounds, sensor_path=reader), expected)
+
+def test_read_bounds_missing_tile(tiles):
+    paths, reference = tiles
+    with mosaic.MosaicReader(paths[:3]) as reader:
+        img = reader.read_bounds((726995, 4698995, 727005, 4699005))
+    assert img.shape == (3, 10, 10)
+    assert np.all(img[:, 5:, 5:] == 0)
+
+def test_on_the_fly_dataset_edge(tiles):
+    paths, reference = tiles
+    config = {"image_size": 5}
+    inside = gpd.GeoDataFrame({"individual": ["a"]}, geometry=[box(726992, 4699002, 726998, 4699008)])
+    ds = predict.on_the_fly_dataset(crowns=inside, image_path=paths[0], config=config, lookup_pool=paths)
+    assert ds.mosaic is None
+    
+    #A crown across the tile edge is completed from the neighboring tiles
+    crowns = gpd.GeoDataFrame({"individual": ["a", "b"]}, geometry=[box(726992, 4699002, 726998, 4699008), box(726995, 4698995, 727005, 4699005)])
+    ds = predict.on_the_fly_dataset(crowns=crowns, image_path=paths[0], config=config, lookup_pool=paths)
+    assert ds.mosaic is not None
+    src = rasterio.open(reference)
+    for geom in crowns.geometry:
+        expected = src.read(window=rasterio.windows.from_bounds(*geom.bounds, transform=src.transform))
+        np.testing.assert_array_equal(ds.read(geom.bounds), expected)
@@ -0,0 +1,100 @@
+#test neon_paths
+from src import neon_paths
+import json
+import numpy as np
+import pytest
+import os
+import rasterio
+import threading
+import time
+from src import Hyperspectral
+from concurrent.futures import ProcessPoolExecutor
+
+def test_bounds_to_geoindex():
+    bounds = np.array([[726500.5, 4699050.1, 726510.0, 4699060.0], [727999.9, 4700000.0, 728001.0, 4700010.0]])
+    geo_index = neon_paths.bounds_to_geoindex(bounds)
+    assert list(geo_index) == ["726000_4699000", "727000_4700000"]
+    assert neon_paths.bounds_to_geoindex(bounds[0]) == geo_index[0]
+
+def test_TileIndex():
+    lookup_pool = [
+        "/NeonData/HARV/2018/FullSite/NEON_D01_HARV_DP3_726000_4699000_image.tif",
+        "/NeonData/HARV/2019/FullSite/NEON_D01_HARV_DP3_726000_4699000_image.tif",
+        "/NeonData/HARV/2019/FullSite/NEON_D01_HARV_DP3_1726000_4699000_image.tif",
+        "/NeonData/HARV/2019/FullSite/NEON_D01_HARV_DP3_727000_4699000_image.tif"]
+    index = neon_paths.TileIndex(lookup_pool)
+    
+    #Latest year wins, the same as the linear scan
+    for geo_index in ["726000_4699000", "727000_4699000"]:
+        assert index.find(geo_index=geo_index) == neon_paths.find_sensor_path(lookup_pool=lookup_pool, geo_index=geo_index)
+        assert neon_paths.find_sensor_path(lookup_pool=index, geo_index=geo_index) == index.find(geo_index=geo_index)
+    assert index.find(geo_index="726000_4699000", year=2018) == lookup_pool[0]
+    assert neon_paths.TileIndex(lookup_pool, year=2018).find(geo_index="726000_4699000") == lookup_pool[0]
+    assert index.lookup([[726500, 4699500, 726510, 4699510], [0, 0, 1, 1]]) == [lookup_pool[1], None]
+    with pytest.raises(ValueError):
+        neon_paths.find_sensor_path(lookup_pool=index, bounds=[0, 0, 1, 1])
+
+def test_convert_h5_once(neon_h5, tmpdir):
+    rgb_path = "2019_HARV_6_726000_4699000_image.tif"
+    #A lock left behind by a crashed worker is removed once stale
+    lock_path = "{}/2019_HARV_6_726000_4699000_image_hyperspectral.tif.lock".format(tmpdir)
+    open(lock_path, "w").close()
+    os.utime(lock_path, (0, 0))
+    
+    with ProcessPoolExecutor(max_workers=3) as executor:
+        futures = [executor.submit(neon_paths.convert_h5_once, neon_h5, rgb_path, str(tmpdir), poll=0.1) for x in range(3)]
+        tif_paths = [x.result() for x in futures]
+    assert len(set(tif_paths)) == 1
+    assert os.path.exists("{}.done".format(tif_paths[0]))
+    assert sorted(os.listdir(tmpdir)) == sorted([os.path.basename(tif_paths[0]), os.path.basename(tif_paths[0]) + ".done"])
+    assert rasterio.open(tif_paths[0]).count == 369
+    
+    #Converted tiles are reused
+    mtime = os.path.getmtime(tif_paths[0])
+    assert neon_paths.convert_h5_once(neon_h5, rgb_path, str(tmpdir)) == tif_paths[0]
+    assert os.path.getmtime(tif_paths[0]) == mtime
+
+def test_convert_h5_once_settings(neon_h5, tmpdir):
+    rgb_path = "2019_HARV_6_726000_4699000_image.tif"
+    tif_path = neon_paths.convert_h5_once(neon_h5, rgb_path, str(tmpdir))
+    
+    #Binned bands are a different tile, another layout of the same tile is not silently reused
+    binned_path = neon_paths.convert_h5_once(neon_h5, rgb_path, str(tmpdir), bin_size=2)
+    assert not binned_path == tif_path
+    assert rasterio.open(binned_path).count == 185
+    with pytest.raises(ValueError):
+        neon_paths.convert_h5_once(neon_h5, rgb_path, str(tmpdir), layout=Hyperspectral.COG_LAYOUT)
+    
+    #Other band selections never overwrite the no_water tile
+    vnir_path = neon_paths.convert_h5_once(neon_h5, rgb_path, str(tmpdir), bands="vnir")
+    assert not vnir_path == tif_path
+    assert rasterio.open(tif_path).count == 369
+    
+    #Markers written before the band selection was recorded are no_water conversions
+    with open("{}.done".format(tif_path), "w") as f:
+        f.write(json.dumps({"bin_size": 1, "layout": None}))
+    assert neon_paths.convert_h5_once(neon_h5, rgb_path, str(tmpdir)) == tif_path
+    with open("{}.done".format(tif_path), "w") as f:
+        f.write(json.dumps({"bin_size": 1, "layout": None, "bands": "vnir"}))
+    with pytest.raises(ValueError):
+        neon_paths.convert_h5_once(neon_h5, rgb_path, str(tmpdir))
+
+def test_lock_heartbeat(tmpdir):
+    lock_path = "{}/tile.tif.lock".format(tmpdir)
+    with open(lock_path, "w") as f:
+        f.write("other worker")
+    os.utime(lock_path, (0, 0))
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=neon_paths.touch_lock, args=(lock_path, stop, 0.01))
+    heartbeat.start()
+    time.sleep(0.1)
+    stop.set()
+    heartbeat.join()
+    assert time.time() - os.path.getmtime(lock_path) < 10
+    
+    #A lock taken over by another worker is left in place, a missing lock is ignored
+    neon_paths.release_lock(lock_path, "this worker")
+    assert os.path.exists(lock_path)
+    neon_paths.release_lock(lock_path, "other worker")
+    assert not os.path.exists(lock_path)
+    neon_paths.release_lock(lock_path, "other worker")
@@ -0,0 +1,42 @@
+#Test on disk partitioned table
+import geopandas as gpd
+import pandas as pd
+import shapely
+from src import partitions
+
+def test_write_partition(tmpdir):
+    crowns = gpd.GeoDataFrame({"box_id": [0, "fixed_box_1"], "score": [0.5, None], "plotID": "PLOT_1"},
+                              geometry=[shapely.geometry.box(0, 0, 1, 1), shapely.geometry.box(2, 2, 3, 3)], crs="EPSG:32617")
+    partitions.write_partition(tmpdir, "726000_4699000", crowns)
+    partitions.write_partition(tmpdir, "727000_4699000", None)
+    assert partitions.completed(tmpdir) == {"726000_4699000", "727000_4699000"}
+    assert partitions.completed(None) == set()
+
+    #Empty partitions mark a key as done without rows
+    results = partitions.read_partitions(tmpdir)
+    assert isinstance(results, gpd.GeoDataFrame)
+    assert results.shape[0] == 2
+    assert results.crs == crowns.crs
+    assert list(results.box_id) == ["0", "fixed_box_1"]
+
+def test_read_partitions(tmpdir):
+    assert partitions.read_partitions(tmpdir) is None
+    partitions.write_partition(tmpdir, "a", pd.DataFrame({"image_path": ["a.tif", "b.tif"]}))
+    partitions.write_partition(tmpdir, "b", pd.DataFrame({"image_path": ["c.tif"]}))
+    annotations = partitions.read_partitions(tmpdir)
+    assert list(annotations.image_path) == ["a.tif", "b.tif", "c.tif"]
+
+def test_reset(tmpdir):
+    partitions.write_partition(tmpdir, "a", pd.DataFrame({"image_path": ["a.tif"]}))
+    partitions.reset(tmpdir, settings={"min_CHM_height": 1})
+    assert partitions.completed(tmpdir) == {"a"}
+    
+    #Same settings resume, other settings or replace start over
+    partitions.reset(tmpdir, settings={"min_CHM_height": 1})
+    assert partitions.completed(tmpdir) == {"a"}
+    partitions.reset(tmpdir, settings={"min_CHM_height": 2})
+    assert partitions.completed(tmpdir) == set()
+    partitions.write_partition(tmpdir, "a", pd.DataFrame({"image_path": ["a.tif"]}))
+    partitions.reset(tmpdir, settings={"min_CHM_height": 2}, replace=True)
+    assert partitions.completed(tmpdir) == set()
+    partitions.reset(None)
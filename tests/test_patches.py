@@ -3,6 +3,7 @@ import os
 from src import patches
 from src import __file__ as ROOT
 import geopandas as gpd
+import numpy as np
 import rasterio
 
 ROOT = os.path.dirname(os.path.dirname(ROOT))
@@ -25,4 +26,60 @@ def test_crop_hsi(tmpdir):
     gdf = gpd.read_file("{}/tests/data/crown.shp".format(ROOT))
     patch = patches.crop(bounds=gdf.geometry[0].bounds,sensor_path="{}/tests/data/hsi/2019_HARV_6_726000_4699000_image_crop_hyperspectral.tif".format(ROOT), savedir=tmpdir, basename="test")
     img = rasterio.open(patch).read()
-    assert img.shape[0] == 369    
\ No newline at end of file
+    assert img.shape[0] == 369    
+
+def test_crop_h5(neon_h5):
+    bounds = (726500.3, 4699050.2, 726504.6, 4699055.9)
+    img = patches.crop(bounds=bounds, sensor_path=neon_h5)
+    assert img.shape == (369, 6, 4)
+
+def test_crop_many():
+    path = "{}/tests/data/hsi/2019_HARV_6_726000_4699000_image_crop_hyperspectral.tif".format(ROOT)
+    src = rasterio.open(path)
+    left, bottom = src.bounds.left, src.bounds.bottom
+    #Neighboring crowns, a fractional window and a crown off the tile
+    bounds = np.array([[left + 2, bottom + 2, left + 6, bottom + 7], [left + 5, bottom + 4, left + 9, bottom + 8],
+                       [left + 10.4, bottom + 3.3, left + 13.8, bottom + 6.1], [left - 20, bottom - 20, left - 15, bottom - 15]])
+    crops = patches.crop_many(bounds, src)
+    for crop, (crop_left, crop_bottom, crop_right, crop_top) in zip(crops, bounds):
+        expected = src.read(window=rasterio.windows.from_bounds(crop_left, crop_bottom, crop_right, crop_top, transform=src.transform))
+        assert crop.shape == expected.shape
+        assert np.array_equal(crop, expected)
+
+def test_crop_many_dense():
+    path = "{}/tests/data/2019_D01_HARV_DP3_726000_4699000_image_crop.tif".format(ROOT)
+    src = rasterio.open(path)
+    left, top = src.bounds.left, src.bounds.top
+    #A grid of 1m crowns 0.5m apart over the whole tile, each is within gap of the next
+    x, y = np.meshgrid(np.arange(0, 39, 1.5), np.arange(0, 39, 1.5))
+    bounds = np.stack([left + x.ravel(), top - y.ravel() - 1, left + x.ravel() + 1, top - y.ravel()], axis=1)
+    col_off, row_off, width, height = patches.windows_from_bounds(bounds, src.transform)
+    blocks = patches.coalesce_windows(row_off, row_off + height, col_off, col_off + width, gap=8, max_size=100)
+    assert len(blocks) > 1
+    assert sorted(np.concatenate([block[4] for block in blocks])) == list(range(bounds.shape[0]))
+    for block in blocks:
+        assert block[1] - block[0] <= 100
+        assert block[3] - block[2] <= 100
+    
+    crops = patches.crop_many(bounds, src, max_size=100)
+    for crop, (crop_left, crop_bottom, crop_right, crop_top) in zip(crops, bounds):
+        expected = src.read(window=rasterio.windows.from_bounds(crop_left, crop_bottom, crop_right, crop_top, transform=src.transform))
+        assert np.array_equal(crop, expected)
+
+def test_crop_tile(tmpdir):
+    gdf = gpd.read_file("{}/tests/data/crown.shp".format(ROOT))
+    filenames = patches.crop_tile(bounds=gdf.bounds.values, sensor_path="{}/tests/data/hsi/2019_HARV_6_726000_4699000_image_crop_hyperspectral.tif".format(ROOT), savedir=tmpdir, basenames=gdf.individual)
+    assert len(filenames) == gdf.shape[0]
+    img = rasterio.open(filenames[0]).read()
+    assert img.shape[0] == 369
+
+def test_bounds_to_pixel_crops():
+    path = "{}/tests/data/2019_D01_HARV_DP3_726000_4699000_image_crop.tif".format(ROOT)
+    src = rasterio.open(path)
+    #A crown on the tile edge, the patches of its last pixels extend past the tile
+    bounds = (src.bounds.right - 1.3, src.bounds.bottom + 5.2, src.bounds.right + 2, src.bounds.bottom + 6.7)
+    crops = patches.bounds_to_pixel(bounds, img_path=path)
+    assert len(crops) == len(patches.row_col_from_bounds(bounds, src))
+    for (row, col), img in crops:
+        expected = src.read(window=rasterio.windows.Window(col_off=col, row_off=row, width=11, height=11), boundless=True)
+        assert np.array_equal(img, expected)
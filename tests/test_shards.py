@@ -0,0 +1,65 @@
+#Test shard format
+from src import shards
+import numpy as np
+import pandas as pd
+import torch
+
+def test_write_shards(dm, config, tmpdir, ROOT):
+    csv_file = "{}/tests/data/processed/train.csv".format(ROOT)
+    index = shards.write_shards(csv_file, tmpdir, image_size=config["image_size"], shard_size=2)
+    annotations = pd.read_csv(csv_file)
+    assert index.shape[0] == annotations.shape[0]
+    assert len(shards.shard_paths(tmpdir)) == index.shard.nunique()
+
+def test_ShardDataset(dm, config, tmpdir, ROOT):
+    csv_file = "{}/tests/data/processed/train.csv".format(ROOT)
+    shards.write_shards(csv_file, tmpdir, image_size=config["image_size"], shard_size=2)
+    ds = shards.ShardDataset(tmpdir, image_size=config["image_size"], buffer_size=4)
+    samples = list(ds)
+    assert len(samples) == len(ds)
+    individual, inputs, label = samples[0]
+    assert inputs["HSI"].shape == (3, config["image_size"], config["image_size"])
+    
+    #Every sample once per epoch, in a new order
+    assert sorted([x[0] for x in samples]) == sorted(ds.index.individual)
+    
+    #Workers split the shards between them
+    data_loader = torch.utils.data.DataLoader(ds, batch_size=1, num_workers=2)
+    assert sorted([x[0][0] for x in data_loader]) == sorted(ds.index.individual)
+
+def test_balanced_rates():
+    labels = [0] * 200 + [1] * 10 + [2] * 40
+    rates = shards.balanced_rates(labels)
+    #An epoch draws as many samples as there are, classes above 50 samples are undersampled
+    assert abs(sum([rates[x] for x in labels]) - 250) < 1e-6
+    assert abs(rates[1] * 10 - rates[2] * 40) < 1e-6
+    assert rates[0] < 1
+
+def test_is_current(dm, config, tmpdir, ROOT):
+    csv_file = "{}/tests/data/processed/train.csv".format(ROOT)
+    annotations = pd.read_csv(csv_file)
+    annotations.to_csv(tmpdir.join("train.csv"), index=False)
+    shard_dir = tmpdir.join("shards")
+    settings = {"image_size": config["image_size"], "bands": config["bands"], "bin_size": 1}
+    assert not shards.is_current(shard_dir, tmpdir.join("train.csv"), settings=settings)
+    shards.write_shards(tmpdir.join("train.csv"), shard_dir, image_size=config["image_size"], shard_size=2, settings=settings)
+    assert shards.is_current(shard_dir, tmpdir.join("train.csv"), settings=settings)
+    
+    #Shards written with another image size or band selection are stale
+    assert not shards.is_current(shard_dir, tmpdir.join("train.csv"), settings=dict(settings, image_size=config["image_size"] * 2))
+    assert not shards.is_current(shard_dir, tmpdir.join("train.csv"), settings=dict(settings, bin_size=2))
+    
+    #A new crop index invalidates the shards
+    annotations.head(2).to_csv(tmpdir.join("train.csv"), index=False)
+    assert not shards.is_current(shard_dir, tmpdir.join("train.csv"), settings=settings)
+
+def test_ShardDataset_len(dm, config, tmpdir, ROOT):
+    csv_file = "{}/tests/data/processed/train.csv".format(ROOT)
+    index = shards.write_shards(csv_file, tmpdir, image_size=config["image_size"], shard_size=2)
+    label_rates = {label: 2 for label in index.label.unique()}
+    ds = shards.ShardDataset(tmpdir, image_size=config["image_size"], buffer_size=0, label_rates=label_rates)
+    assert len(ds) == 2 * index.shape[0]
+    
+    #Draws are Poisson around the expected length
+    counts = [len(list(ds)) for x in range(20)]
+    assert abs(np.mean(counts) - len(ds)) < len(ds) / 2
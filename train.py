@@ -1,7 +1,7 @@
 #Train
 import comet_ml
-import glob
 import geopandas as gpd
+from src import catalog
 from src import main
 from src import data
 from src import start_cluster
@@ -72,7 +72,7 @@ trainer.fit(m, datamodule=data_module)
 trainer.save_checkpoint("/blue/ewhite/b.weinstein/DeepTreeAttention/snapshots/{}.pl".format(comet_logger.experiment.id))
 results = m.evaluate_crowns(data_module.val_dataloader(), experiment=comet_logger.experiment)
 
-rgb_pool = glob.glob(data_module.config["rgb_sensor_pool"], recursive=True)
+rgb_pool = catalog.find_files(data_module.config["rgb_sensor_pool"], data_module.config["file_catalog"])
 
 visualize.confusion_matrix(
     comet_experiment=comet_logger.experiment,